@@ -0,0 +1,179 @@
+import gzip
+import json
+import time
+from collections import Counter
+from threading import Lock
+from typing import Dict, Iterator, Optional
+from urllib.parse import urlparse, parse_qs, urlencode
+
+import requests
+
+from benchmarks.synthetic import SyntheticSubmission
+from exporter.compression import gzip_bytes
+
+
+class _Response:
+    def __init__(self, status_code: int, body: Optional[Dict]):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self) -> Dict:
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f'HTTP {self.status_code}', response=self)
+
+
+# fields of each projection of an entity, as defined by ingest-core
+PROJECTIONS = {
+    'exporter': ['type', 'uuid', 'content', 'dcpVersion', 'submissionDate', 'updateDate', 'dataFileUuid', 'fileName',
+                 'cloudUrl', 'fileContentType', 'size', 'checksums', '_links']
+}
+
+
+class SyntheticIngestAPI:
+    """
+    Local stand-in for IngestApi serving a SyntheticSubmission, in the style of tests.mocks.ingest.MockIngestAPI.
+    Every simulated HTTP request sleeps for `latency_sec` and is counted per endpoint. Response bodies are serialised,
+    gzip-compressed if `compression` is 'gzip', sent at `bandwidth_mb_per_sec` if given, and parsed again, with the
+    bytes sent counted.
+
+    Relation pages are `page_size` entities by default, and at most `max_page_size`, as in Spring Data REST. Unless
+    `projections` is False, the projections in PROJECTIONS are served; otherwise asking for one is a bad request.
+    """
+
+    def __init__(self, submission: SyntheticSubmission, latency_sec: float = 0, page_size: int = 20,
+                 max_page_size: int = 1000, projections: bool = True, compression: Optional[str] = None,
+                 bandwidth_mb_per_sec: Optional[float] = None):
+        self.submission = submission
+        self.latency_sec = latency_sec
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+        self.projections = projections
+        self.compression = compression
+        self.bandwidth_mb_per_sec = bandwidth_mb_per_sec
+        self.url = submission.base_url
+
+        self.request_counts = Counter()
+        self.response_bytes = 0
+        self._lock = Lock()
+
+    def reset_request_counts(self):
+        with self._lock:
+            self.request_counts = Counter()
+            self.response_bytes = 0
+
+    def total_requests(self) -> int:
+        with self._lock:
+            return sum(self.request_counts.values())
+
+    def get_entity_by_uuid(self, entity_type: str, uuid: str) -> Dict:
+        self._request(f'GET /{entity_type}/search/findByUuid')
+        if entity_type == 'submissionEnvelopes':
+            return self._sent(self.submission.submission())
+        return self._sent(self.submission.get_entity(entity_type, uuid))
+
+    def get_entity_by_callback_link(self, callback_link: str) -> Dict:
+        self._request('GET /{collection}/{id}')
+        collection, entity_uuid = callback_link.strip('/').split('/')[-2:]
+        return self._sent(self.submission.get_entity(collection, entity_uuid))
+
+    def get_related_entities(self, relation: str, entity: Dict, entity_type: str) -> Iterator[Dict]:
+        if relation in entity["_links"]:
+            related = self.submission.get_related(entity["_links"][relation]["href"])
+            for page_start in range(0, max(len(related), 1), self.page_size):
+                self._request(f'GET /{{collection}}/{{id}}/{relation}')
+                yield from self._sent(related[page_start:page_start + self.page_size])
+
+    def get(self, url: str, **kwargs) -> _Response:
+        parsed = urlparse(url)
+        params = dict((k, v[0]) for k, v in parse_qs(parsed.query).items())
+        params.update(kwargs.get('params') or {})
+        href = f'{parsed.scheme}://{parsed.netloc}{parsed.path}'
+        path = parsed.path.strip('/').split('/')
+
+        if len(path) == 3:
+            relation = path[2]
+            self._request(f'GET /{{collection}}/{{id}}/{relation}')
+            if params.get('projection') and not self.projections:
+                return self._respond(_Response(400, {"message": f'Unknown projection {params["projection"]}'}))
+            return self._respond(_Response(200, self._relation_page(href, path[0], relation, params)))
+        elif len(path) == 2:
+            self._request('GET /{collection}/{id}')
+            entity = self.submission.get_entity(path[0], path[1])
+            return self._respond(_Response(200, entity) if entity else _Response(404, None))
+        else:
+            self._request('GET /')
+            return self._respond(_Response(404, None))
+
+    def get_headers(self) -> Dict:
+        return {'Content-type': 'application/json'}
+
+    def get_full_url(self, callback_link: str) -> str:
+        return f'{self.url}{callback_link}'
+
+    def get_schemas(self, latest_only=True, high_level_entity=None, domain_entity=None, concrete_entity=None):
+        self._request('GET /schemas/search')
+        schemas = [{
+            "_links": {"json-schema": {"href": f'https://schema.humancellatlas.org/system/1.0.0/{entity}'}},
+            "schemaVersion": "1.0.0",
+            "highLevelEntity": "system",
+            "concreteEntity": entity
+        } for entity in ['file_descriptor', 'links', 'provenance']]
+        return [schema for schema in schemas
+                if (not high_level_entity or schema["highLevelEntity"] == high_level_entity)
+                and (not concrete_entity or schema["concreteEntity"] == concrete_entity)]
+
+    def create_bundle_manifest(self, bundle_manifest) -> Dict:
+        self._request('POST /bundleManifests')
+        return {"_links": {"self": {"href": f'{self.url}/bundleManifests/{self.total_requests()}'}}}
+
+    def patch(self, url: str, patch: Dict) -> _Response:
+        self._request('PATCH')
+        return _Response(200, patch)
+
+    def _relation_page(self, href: str, collection: str, relation: str, params: Dict) -> Dict:
+        related = self.submission.get_related(href)
+        page_size = min(int(params.get('size', self.page_size)), self.max_page_size)
+        page_number = int(params.get('page', 0))
+        entities = related[page_number * page_size:(page_number + 1) * page_size]
+        projection = PROJECTIONS.get(params.get('projection'))
+        if projection:
+            entities = [dict((field, entity[field]) for field in projection if field in entity) for entity in entities]
+        entity_type = entities[0]["type"].lower() if entities else None
+        embedded_type = (entity_type + 'es' if entity_type.endswith('s') else entity_type + 's') if entity_type else relation
+        links = {"self": {"href": href}}
+        if (page_number + 1) * page_size < len(related):
+            links["next"] = {"href": f'{href}?{urlencode(dict(params, page=page_number + 1, size=page_size))}'}
+        return {
+            "_embedded": {embedded_type: entities},
+            "_links": links,
+            "page": {
+                "size": page_size,
+                "totalElements": len(related),
+                "totalPages": (len(related) + page_size - 1) // page_size,
+                "number": page_number
+            }
+        }
+
+    def _respond(self, response: _Response) -> _Response:
+        return _Response(response.status_code, self._sent(response.body))
+
+    def _sent(self, body):
+        data = json.dumps(body).encode('utf-8')
+        if self.compression == 'gzip':
+            data = gzip_bytes(data)
+        with self._lock:
+            self.response_bytes += len(data)
+        if self.bandwidth_mb_per_sec:
+            time.sleep(len(data) / (self.bandwidth_mb_per_sec * 1024 * 1024))
+        if self.compression == 'gzip':
+            data = gzip.decompress(data)
+        return json.loads(data.decode('utf-8'))
+
+    def _request(self, endpoint: str):
+        with self._lock:
+            self.request_counts[endpoint] += 1
+        if self.latency_sec > 0:
+            time.sleep(self.latency_sec)
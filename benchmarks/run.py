@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+End-to-end export benchmark over a synthetic submission.
+
+Runs the crawl, manifest generation and Terra staging stages against a SyntheticIngestAPI and the local storage
+emulator, and reports wall time, request counts, peak memory and throughput per stage as JSON. Results record the
+commit and the full submission spec, so that runs with the same arguments can be compared across commits, e.g.
+
+    python -m benchmarks.run --donors 20 --depth 3 --fan-out 4 --output after.json --compare before.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from typing import Callable, Dict, List, Optional
+
+from benchmarks.ingest import SyntheticIngestAPI
+from benchmarks.synthetic import SubmissionSpec, SyntheticSubmission, synthetic_schema
+from exporter.graph.graph_crawler import GraphCrawler
+from exporter.metadata import MetadataService, MetadataResource
+from exporter.schema import SchemaService
+from exporter.terra.dcp_staging_client import DcpStagingClient
+from exporter.terra.dry_run import DryRunStorage
+from exporter.terra.serialization import ProcessPoolRenderer
+from exporter.terra.validation import DocumentValidator, SchemaCache
+from exporter.terra.emulator import LocalGcsClient, LocalTransferClient, LocalGcsXferStorage
+from exporter.terra.gcs import GcsStorage
+from exporter.terra.terra_export_job import TerraExportJobService
+from exporter.terra.terra_exporter import TerraExporter
+from manifest.exporter import ManifestExporter
+from manifest.generator import ManifestGenerator
+
+STAGES = ['crawl', 'manifest', 'manifest_batch', 'staging', 'dry_run']
+
+
+@dataclass
+class StageResult:
+    assays: int
+    wall_time_sec: float
+    assays_per_sec: float
+    requests: int
+    requests_per_assay: float
+    peak_memory_mb: Optional[float]
+    requests_by_endpoint: Dict[str, int]
+    response_mb: float
+    uploaded_mb: float
+
+
+class ExportBenchmark:
+
+    def __init__(self, submission: SyntheticSubmission, ingest_api: SyntheticIngestAPI, workers: int = 1,
+                 trace_memory: bool = True, batch_size: int = 50, render_processes: int = 0,
+                 relation_page_size: Optional[int] = None, projection: Optional[str] = None, gzip_uploads: bool = False,
+                 validate: bool = False):
+        self.submission = submission
+        self.ingest_api = ingest_api
+        self.workers = workers
+        self.trace_memory = trace_memory
+        self.batch_size = batch_size
+        self.render_processes = render_processes
+        self.relation_page_size = relation_page_size
+        self.projection = projection
+        self.gzip_uploads = gzip_uploads
+        self.validate = validate
+        self.gcs_client: Optional[LocalGcsClient] = None
+
+    def run(self, stages: List[str], assay_limit: Optional[int] = None) -> Dict[str, StageResult]:
+        process_uuids = self.submission.assay_process_uuids[:assay_limit]
+        return dict((stage, self.run_stage(stage, process_uuids)) for stage in stages)
+
+    def run_stage(self, stage: str, process_uuids: List[str]) -> StageResult:
+        export_assay = getattr(self, f'_{stage}_stage')()
+        work_items = process_uuids
+        if stage == 'manifest_batch':
+            work_items = [process_uuids[i:i + self.batch_size] for i in range(0, len(process_uuids), self.batch_size)]
+
+        self.ingest_api.reset_request_counts()
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(export_assay, work_items))
+        wall_time_sec = time.perf_counter() - start
+        peak_memory_mb = None
+        if self.trace_memory:
+            peak_memory_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            tracemalloc.stop()
+
+        requests = self.ingest_api.total_requests()
+        return StageResult(assays=len(process_uuids),
+                           wall_time_sec=wall_time_sec,
+                           assays_per_sec=len(process_uuids) / wall_time_sec if wall_time_sec > 0 else 0,
+                           requests=requests,
+                           requests_per_assay=requests / len(process_uuids) if process_uuids else 0,
+                           peak_memory_mb=peak_memory_mb,
+                           requests_by_endpoint=dict(self.ingest_api.request_counts),
+                           response_mb=self.ingest_api.response_bytes / (1024 * 1024),
+                           uploaded_mb=self.uploaded_bytes() / (1024 * 1024))
+
+    def uploaded_bytes(self) -> int:
+        if self.gcs_client is None:
+            return 0
+        return sum(stored.size for _, stored in self.gcs_client.store.list('benchmark-bucket'))
+
+    def _metadata_service(self) -> MetadataService:
+        return MetadataService(self.ingest_api, page_size=self.relation_page_size, projection=self.projection)
+
+    def _validator(self) -> Optional[DocumentValidator]:
+        return DocumentValidator(SchemaCache(synthetic_schema)) if self.validate else None
+
+    def _crawl_stage(self) -> Callable[[str], None]:
+        graph_crawler = GraphCrawler(self._metadata_service())
+        project = MetadataResource.from_dict(self.submission.get_entity('projects', self.submission.project_uuid))
+
+        def crawl(process_uuid: str):
+            process = MetadataResource.from_dict(self.submission.get_entity('processes', process_uuid))
+            graph_crawler.generate_complete_experiment_graph(process, project)
+
+        return crawl
+
+    def _manifest_stage(self) -> Callable[[str], None]:
+        manifest_generator = ManifestGenerator(self.ingest_api, GraphCrawler(self._metadata_service()))
+        manifest_exporter = ManifestExporter(self.ingest_api, manifest_generator)
+        return lambda process_uuid: manifest_exporter.export(process_uuid, self.submission.submission_uuid)
+
+    def _manifest_batch_stage(self) -> Callable[[List[str]], None]:
+        manifest_generator = ManifestGenerator(self.ingest_api, GraphCrawler(self._metadata_service()))
+        manifest_exporter = ManifestExporter(self.ingest_api, manifest_generator)
+        return lambda process_uuids: manifest_exporter.export_batch(process_uuids, self.submission.submission_uuid)
+
+    def _staging_stage(self) -> Callable[[str], None]:
+        metadata_service = self._metadata_service()
+        gcs_client = self.gcs_client = LocalGcsClient()
+        dcp_staging_client = (DcpStagingClient
+                              .Builder()
+                              .with_ingest_client(self.ingest_api)
+                              .with_schema_service(SchemaService(self.ingest_api))
+                              .with_gcs_storage(GcsStorage(gcs_client, 'benchmark-bucket', 'benchmark',
+                                                           gzip_uploads=self.gzip_uploads))
+                              .with_gcs_xfer_storage(LocalGcsXferStorage(LocalTransferClient('.', gcs_client), '', '',
+                                                                         'benchmark', 'benchmark-bucket', 'benchmark'))
+                              .with_validator(self._validator())
+                              .build())
+        terra_exporter = TerraExporter(self.ingest_api, metadata_service, GraphCrawler(metadata_service),
+                                       dcp_staging_client, TerraExportJobService(self.ingest_api))
+        return lambda process_uuid: terra_exporter.export(process_uuid, self.submission.submission_uuid, 'benchmark-job')
+
+    def _dry_run_stage(self) -> Callable[[str], None]:
+        # serialises everything staging would write, into a tar stream that is discarded, to measure crawl and
+        # serialisation throughput without any storage latency
+        metadata_service = self._metadata_service()
+        dry_run_storage = DryRunStorage('benchmark', tar_stream=open(os.devnull, 'wb'))
+        renderer = ProcessPoolRenderer(self.render_processes, validate=self.validate, fetch=synthetic_schema) \
+            if self.render_processes > 0 else None
+        dcp_staging_client = DcpStagingClient(dry_run_storage, None, SchemaService(self.ingest_api), self.ingest_api,
+                                              renderer=renderer, validator=self._validator())
+        terra_exporter = TerraExporter(self.ingest_api, metadata_service, GraphCrawler(metadata_service),
+                                       dcp_staging_client, TerraExportJobService(self.ingest_api))
+        return lambda process_uuid: terra_exporter.export_metadata(process_uuid, self.submission.submission_uuid)
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return 'unknown'
+
+
+def compare(results: Dict, baseline: Dict) -> List[str]:
+    lines = [f'Comparing {results["commit"][:10]} against baseline {baseline["commit"][:10]}']
+    if results["spec"] != baseline["spec"] or results["latency_sec"] != baseline["latency_sec"]:
+        lines.append('WARNING: submission spec or latency differ from the baseline run')
+    for stage, result in results["stages"].items():
+        baseline_result = baseline["stages"].get(stage)
+        if baseline_result:
+            speedup = baseline_result["wall_time_sec"] / result["wall_time_sec"] if result["wall_time_sec"] else 0
+            lines.append(f'{stage}: {speedup:.2f}x wall time, '
+                         f'{baseline_result["requests"]} -> {result["requests"]} requests, '
+                         f'{baseline_result.get("response_mb", 0):.2f} -> {result["response_mb"]:.2f} MB received, '
+                         f'{baseline_result.get("uploaded_mb", 0):.2f} -> {result["uploaded_mb"]:.2f} MB uploaded')
+    return lines
+
+
+def main(argv: List[str]) -> Dict:
+    p = argparse.ArgumentParser(description='Benchmark crawl, manifest generation and staging on a synthetic submission')
+    p.add_argument('--donors', type=int, default=SubmissionSpec.donors)
+    p.add_argument('--depth', type=int, default=SubmissionSpec.depth)
+    p.add_argument('--fan-out', type=int, default=SubmissionSpec.fan_out)
+    p.add_argument('--pooling', type=int, default=SubmissionSpec.pooling)
+    p.add_argument('--files-per-assay', type=int, default=SubmissionSpec.files_per_assay)
+    p.add_argument('--seed', type=int, default=SubmissionSpec.seed)
+    p.add_argument('--latency-ms', type=float, default=0, help='simulated latency of each ingest request')
+    p.add_argument('--assays', type=int, default=None, help='limit the number of assays exported per stage')
+    p.add_argument('--workers', type=int, default=1, help='number of assays exported concurrently')
+    p.add_argument('--batch-size', type=int, default=50, help='number of assays per batch in the manifest_batch stage')
+    p.add_argument('--render-processes', type=int, default=0,
+                   help='render staged documents on this many processes in the dry_run stage')
+    p.add_argument('--relation-page-size', type=int, default=None,
+                   help='page size asked of ingest for relations, rather than its default of 20')
+    p.add_argument('--projection', type=str, default=None, help='projection asked of ingest for relations')
+    p.add_argument('--ingest-compression', choices=['gzip'], default=None,
+                   help='compress ingest responses, as ingest-core does when asked with Accept-Encoding')
+    p.add_argument('--bandwidth-mbps', type=float, default=None,
+                   help='simulated bandwidth from ingest in MB/s, on top of the latency of each request')
+    p.add_argument('--gzip-uploads', action='store_true', help='stage documents gzip-encoded in the staging stage')
+    p.add_argument('--validate', action='store_true',
+                   help='validate staged documents against synthetic schemas in the staging and dry_run stages')
+    p.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    p.add_argument('--no-trace-memory', action='store_true', help='do not trace peak memory, which slows the run')
+    p.add_argument('--output', type=str, help='write results as JSON to this file')
+    p.add_argument('--compare', type=str, help='results JSON of a baseline run to compare against')
+    args = p.parse_args(argv)
+
+    spec = SubmissionSpec(donors=args.donors, depth=args.depth, fan_out=args.fan_out, pooling=args.pooling,
+                          files_per_assay=args.files_per_assay, seed=args.seed)
+    submission = SyntheticSubmission(spec)
+    ingest_api = SyntheticIngestAPI(submission, latency_sec=args.latency_ms / 1000, compression=args.ingest_compression,
+                                    bandwidth_mb_per_sec=args.bandwidth_mbps)
+    benchmark = ExportBenchmark(submission, ingest_api, args.workers, not args.no_trace_memory, args.batch_size,
+                                args.render_processes, args.relation_page_size, args.projection, args.gzip_uploads, args.validate)
+
+    stage_results = benchmark.run(args.stages, args.assays)
+    results = {
+        "commit": current_commit(),
+        "python": platform.python_version(),
+        "spec": spec.to_dict(),
+        "latency_sec": ingest_api.latency_sec,
+        "ingest_compression": ingest_api.compression,
+        "bandwidth_mb_per_sec": ingest_api.bandwidth_mb_per_sec,
+        "workers": args.workers,
+        "entities": submission.entity_count(),
+        "total_assays": len(submission.assay_process_uuids),
+        "stages": dict((stage, asdict(result)) for stage, result in stage_results.items())
+    }
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline:
+            print('\n'.join(compare(results, json.load(baseline))))
+    return results
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+    main(sys.argv[1:])
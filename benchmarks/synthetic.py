@@ -0,0 +1,264 @@
+"""
+Generator for synthetic HCA submissions of configurable size and shape.
+
+A submission is made of `donors` donor organisms, each of which is the root of a tree of biomaterials `depth` processes
+deep, where every process derives `fan_out` biomaterials from its input. Leaf biomaterials are pooled `pooling` at a
+time into assay processes, each of which derives `files_per_assay` sequence files.
+"""
+import random
+import uuid
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Tuple
+
+_DCP_VERSION = '2020-01-01T00:00:00.000Z'
+
+_SCHEMA_BASE_URL = 'https://schema.humancellatlas.org/type'
+
+_COLLECTIONS = {
+    'Biomaterial': 'biomaterials',
+    'File': 'files',
+    'Process': 'processes',
+    'Project': 'projects',
+    'Protocol': 'protocols'
+}
+
+
+@dataclass
+class SubmissionSpec:
+    donors: int = 2
+    depth: int = 2
+    fan_out: int = 2
+    pooling: int = 1
+    files_per_assay: int = 2
+    protocols_per_process: int = 2
+    protocol_pool_size: int = 10
+    supplementary_files: int = 2
+    seed: int = 0
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+class SyntheticSubmission:
+
+    def __init__(self, spec: SubmissionSpec, base_url: str = 'http://synthetic-ingest-api'):
+        self.spec = spec
+        self.base_url = base_url
+        self.submission_uuid = ''
+        self.project_uuid = ''
+        self.assay_process_uuids: List[str] = []
+
+        # (collection, uuid) -> entity
+        self.entities: Dict[Tuple[str, str], Dict] = dict()
+        # relation href -> [(collection, uuid)]
+        self.relations: Dict[str, List[Tuple[str, str]]] = dict()
+
+        self._random = random.Random(spec.seed)
+        self._counter = 0
+        self._generate()
+
+    def entity_count(self) -> int:
+        return len(self.entities)
+
+    def get_entity(self, collection: str, entity_uuid: str) -> Dict:
+        return self.entities.get((collection, entity_uuid))
+
+    def get_related(self, relation_href: str) -> List[Dict]:
+        return [self.entities[key] for key in self.relations.get(relation_href, [])]
+
+    def submission(self) -> Dict:
+        return {
+            "uuid": {"uuid": self.submission_uuid},
+            "submitActions": ["Export metadata"],
+            "stagingDetails": {"stagingAreaLocation": {"value": f's3://synthetic-upload/{self.submission_uuid}/'}},
+            "_links": {"self": {"href": f'{self.base_url}/submissionEnvelopes/{self.submission_uuid}'}}
+        }
+
+    def _generate(self):
+        spec = self.spec
+        self.submission_uuid = self._uuid()
+        project = self._entity('Project', 'project', 'project', ['supplementaryFiles'])
+        self.project_uuid = project["uuid"]["uuid"]
+        for _ in range(spec.supplementary_files):
+            supplementary_file = self._file('supplementary_file')
+            self._relate(project, 'supplementaryFiles', supplementary_file)
+
+        protocol_pool = [self._entity('Protocol', 'protocol', 'collection_protocol', []) for _ in range(spec.protocol_pool_size)]
+
+        leaves = []
+        for _ in range(spec.donors):
+            generation = [self._biomaterial('donor_organism')]
+            for level in range(spec.depth):
+                concrete_type = 'cell_suspension' if level == spec.depth - 1 else 'specimen_from_organism'
+                next_generation = []
+                for parent in generation:
+                    process = self._process(protocol_pool)
+                    self._relate(process, 'inputBiomaterials', parent)
+                    self._relate(parent, 'inputToProcesses', process)
+                    for _ in range(spec.fan_out):
+                        child = self._biomaterial(concrete_type)
+                        self._relate(process, 'derivedBiomaterials', child)
+                        self._relate(child, 'derivedByProcesses', process)
+                        next_generation.append(child)
+                generation = next_generation
+            leaves.extend(generation)
+
+        for i in range(0, len(leaves), spec.pooling):
+            assay_process = self._process(protocol_pool)
+            self.assay_process_uuids.append(assay_process["uuid"]["uuid"])
+            for pooled in leaves[i:i + spec.pooling]:
+                self._relate(assay_process, 'inputBiomaterials', pooled)
+                self._relate(pooled, 'inputToProcesses', assay_process)
+            for _ in range(spec.files_per_assay):
+                sequence_file = self._file('sequence_file')
+                self._relate(assay_process, 'derivedFiles', sequence_file)
+                self._relate(sequence_file, 'derivedByProcesses', assay_process)
+
+    def _process(self, protocol_pool: List[Dict]) -> Dict:
+        process = self._entity('Process', 'process', 'process',
+                               ['inputBiomaterials', 'inputFiles', 'derivedBiomaterials', 'derivedFiles', 'protocols', 'projects'])
+        for protocol in self._random.sample(protocol_pool, min(self.spec.protocols_per_process, len(protocol_pool))):
+            self._relate(process, 'protocols', protocol)
+        self._relate(process, 'projects', self.entities[('projects', self.project_uuid)])
+        return process
+
+    def _biomaterial(self, concrete_type: str) -> Dict:
+        return self._entity('Biomaterial', 'biomaterial', concrete_type, ['derivedByProcesses', 'inputToProcesses'])
+
+    def _file(self, concrete_type: str) -> Dict:
+        file = self._entity('File', 'file', concrete_type, ['derivedByProcesses', 'inputToProcesses'])
+        file_name = f'{file["uuid"]["uuid"]}.fastq.gz'
+        file.update({
+            "dataFileUuid": self._uuid(),
+            "fileName": file_name,
+            "cloudUrl": f's3://synthetic-upload/{self.submission_uuid}/{file_name}',
+            "fileContentType": "application/gzip",
+            "size": self._random.randint(1, 10 ** 9),
+            "checksums": {
+                "sha256": f'{self._random.getrandbits(256):064x}',
+                "crc32c": f'{self._random.getrandbits(32):08x}',
+                "sha1": f'{self._random.getrandbits(160):040x}',
+                "s3_etag": f'{self._random.getrandbits(128):032x}'
+            }
+        })
+        return file
+
+    def _entity(self, entity_type: str, schema_type: str, concrete_type: str, relations: List[str]) -> Dict:
+        entity_uuid = self._uuid()
+        collection = _COLLECTIONS[entity_type]
+        self_href = f'{self.base_url}/{collection}/{entity_uuid}'
+        self._counter += 1
+        entity = {
+            "type": entity_type,
+            "uuid": {"uuid": entity_uuid},
+            "content": {
+                "describedBy": f'{_SCHEMA_BASE_URL}/{schema_type}/1.2.3/{concrete_type}',
+                "schema_type": schema_type,
+                f'{schema_type}_core': {f'{schema_type}_id': f'{concrete_type}_{self._counter}'}
+            },
+            "dcpVersion": _DCP_VERSION,
+            "submissionDate": _DCP_VERSION,
+            "updateDate": _DCP_VERSION,
+            # returned by ingest-core but not read by the exporter
+            "user": "anonymousUser",
+            "lastModifiedUser": "anonymousUser",
+            "events": [],
+            "accession": None,
+            "validationState": "Valid",
+            "validationErrors": [],
+            "validationId": None,
+            "_links": dict([("self", {"href": self_href}),
+                            (schema_type, {"href": self_href, "title": f'A single {schema_type}'}),
+                            ("submissionEnvelopes", {"href": f'{self_href}/submissionEnvelopes',
+                                                     "title": "Access or create new submission envelopes"})] +
+                           [(relation, {"href": f'{self_href}/{relation}'}) for relation in relations])
+        }
+        self.entities[(collection, entity_uuid)] = entity
+        return entity
+
+    def _relate(self, entity: Dict, relation: str, related: Dict):
+        related_key = (_COLLECTIONS[related["type"]], related["uuid"]["uuid"])
+        self.relations.setdefault(entity["_links"][relation]["href"], []).append(related_key)
+
+    def _uuid(self) -> str:
+        return str(uuid.UUID(int=self._random.getrandbits(128), version=4))
+
+
+_DRAFT_07 = 'http://json-schema.org/draft-07/schema#'
+
+_SYSTEM_SCHEMAS = {
+    'provenance': {
+        "type": "object",
+        "required": ["document_id", "submission_date", "update_date"],
+        "properties": {
+            "document_id": {"type": "string", "pattern": "^[a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12}$"},
+            "submission_date": {"type": "string"},
+            "update_date": {"type": "string"},
+            "schema_major_version": {"type": "integer"},
+            "schema_minor_version": {"type": "integer"}
+        }
+    },
+    'file_descriptor': {
+        "type": "object",
+        "required": ["describedBy", "schema_type", "file_id", "file_version", "file_name", "content_type", "size",
+                     "sha1", "sha256", "crc32c"],
+        "properties": {
+            "describedBy": {"type": "string"},
+            "schema_version": {"type": "string"},
+            "schema_type": {"enum": ["file_descriptor"]},
+            "file_id": {"type": "string"},
+            "file_version": {"type": "string"},
+            "file_name": {"type": "string"},
+            "content_type": {"type": "string"},
+            "size": {"type": "integer"},
+            "sha1": {"type": "string", "pattern": "^[a-f0-9]{40}$"},
+            "sha256": {"type": "string", "pattern": "^[a-f0-9]{64}$"},
+            "crc32c": {"type": "string", "pattern": "^[a-f0-9]{8}$"},
+            "s3_etag": {"type": "string"}
+        }
+    },
+    'links': {
+        "type": "object",
+        "required": ["describedBy", "schema_type", "links"],
+        "properties": {
+            "describedBy": {"type": "string"},
+            "schema_version": {"type": "string"},
+            "schema_type": {"enum": ["links"]},
+            "links": {"type": "array", "items": {"type": "object", "required": ["link_type"]}}
+        }
+    }
+}
+
+
+def synthetic_schema(url: str) -> Dict:
+    """
+    A JSON schema for the documents of a SyntheticSubmission, in the layout of the HCA metadata schemas: a type
+    schema per concrete type referring to a core schema per schema type and to the provenance system schema
+    """
+    path = url.split('://', 1)[1].split('/')[1:]
+    if path[0] == 'system':
+        return dict(_SYSTEM_SCHEMAS[path[-1]], **{"$schema": _DRAFT_07, "$id": url})
+    if path[0] == 'core':
+        schema_type = path[1]
+        return {
+            "$schema": _DRAFT_07,
+            "$id": url,
+            "type": "object",
+            "required": [f'{schema_type}_id'],
+            "properties": {f'{schema_type}_id': {"type": "string", "minLength": 1}}
+        }
+    schema_type = path[1]
+    schema_base_url = _SCHEMA_BASE_URL.rsplit('/', 1)[0]
+    return {
+        "$schema": _DRAFT_07,
+        "$id": url,
+        "type": "object",
+        "required": ["describedBy", "schema_type", f'{schema_type}_core'],
+        "additionalProperties": False,
+        "properties": {
+            "describedBy": {"type": "string", "pattern": f'^{_SCHEMA_BASE_URL}/{schema_type}/'},
+            "schema_type": {"enum": [schema_type]},
+            f'{schema_type}_core': {"$ref": f'{schema_base_url}/core/{schema_type}/1.0.0/{schema_type}_core'},
+            "provenance": {"$ref": f'{schema_base_url}/system/1.0.0/provenance'}
+        }
+    }
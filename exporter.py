@@ -1,28 +1,30 @@
 #!/usr/bin/env python
+import argparse
+import json
 import logging
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
+from typing import List, Optional, TYPE_CHECKING
 
-from ingest.api.ingestapi import IngestApi
-from exporter.metadata import MetadataService
-from exporter.graph.graph_crawler import GraphCrawler
-from exporter.terra.dcp_staging_client import DcpStagingClient
-from exporter.schema import SchemaService
-from exporter.terra.terra_listener import TerraListener
-from exporter.terra.terra_export_job import TerraExportJobService
-from exporter.amqp import AmqpConnConfig, QueueConfig
+from exporter import metrics
+from exporter.profiling import SlowMessageProfiler
 
-from kombu import Connection, Exchange, Queue
-
-from manifest.exporter import ManifestExporter
-from manifest.receiver import ManifestReceiver
-from manifest.generator import ManifestGenerator
-
-from exporter.terra.terra_exporter import TerraExporter
+# The pipelines are imported where they are built, so that a replica only loads the libraries of its role
+if TYPE_CHECKING:
+    from ingest.api.ingestapi import IngestApi
+    from exporter.batch import ExportTasks
+    from exporter.limiter import AdaptiveLimiter
+    from exporter.metadata import MetadataService
+    from exporter.terra.terra_exporter import TerraExporter
+    from manifest.exporter import ManifestExporter
 
 DISABLE_MANIFEST = os.environ.get('DISABLE_MANIFEST', False)
 
+# all, manifest or terra
+EXPORTER_ROLE = os.environ.get('EXPORTER_ROLE', 'all').lower()
+
 DEFAULT_RABBIT_URL = os.path.expandvars(
     os.environ.get('RABBIT_URL', 'amqp://localhost:5672'))
 
@@ -39,6 +41,14 @@ ASSAY_COMPLETED_ROUTING_KEY = 'ingest.exporter.manifest.completed'
 EXPERIMENT_COMPLETED_ROUTING_KEY = 'ingest.exporter.experiment.exported'
 
 
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+PROFILE_THRESHOLD_SEC = float(os.environ.get('PROFILE_THRESHOLD_SEC', '60'))
+
+
+def setup_profiler() -> SlowMessageProfiler:
+    return SlowMessageProfiler(PROFILE_DIR, PROFILE_THRESHOLD_SEC)
+
+
 RETRY_POLICY = {
     'interval_start': 0,
     'interval_step': 2,
@@ -47,8 +57,59 @@ RETRY_POLICY = {
 }
 
 
+def build_limiter(service: str) -> Optional['AdaptiveLimiter']:
+    from exporter.limiter import AdaptiveLimiter
+
+    if os.environ.get('ADAPTIVE_CONCURRENCY', 'false').lower() != 'true':
+        return None
+    env_prefix = service.upper()
+    return AdaptiveLimiter(service,
+                           initial_limit=int(os.environ.get(f'{env_prefix}_INITIAL_CONCURRENCY', '8')),
+                           max_limit=int(os.environ.get(f'{env_prefix}_MAX_CONCURRENCY', '64')))
+
+
+def build_metadata_service(ingest_client: 'IngestApi', limiter: Optional['AdaptiveLimiter'] = None) -> 'MetadataService':
+    from exporter.metadata import MetadataService
+
+    # ingest-core caps page sizes at its own maximum; the projection, if any, must be defined by ingest-core
+    return MetadataService(ingest_client, limiter,
+                           page_size=int(os.environ.get('INGEST_RELATION_PAGE_SIZE', '500')),
+                           projection=os.environ.get('INGEST_RELATION_PROJECTION'))
+
+
+_ingest_client: Optional['IngestApi'] = None
+
+
+def shared_ingest_client() -> 'IngestApi':
+    """
+    One client for both pipelines, as creating one fetches the ingest API index
+    """
+    global _ingest_client
+    if _ingest_client is None:
+        from ingest.api.ingestapi import IngestApi
+        from exporter.compression import negotiate_compression
+        _ingest_client = IngestApi()
+        metrics.instrument_session(_ingest_client.session, 'ingest')
+        negotiate_compression(_ingest_client.session, 'ingest')
+    return _ingest_client
+
+
+def build_manifest_exporter(ingest_client: 'IngestApi') -> 'ManifestExporter':
+    from exporter.graph.graph_crawler import GraphCrawler
+    from manifest.exporter import ManifestExporter
+    from manifest.generator import ManifestGenerator
+
+    manifest_generator = ManifestGenerator(ingest_client, GraphCrawler(build_metadata_service(ingest_client, build_limiter('ingest'))))
+    stream_threshold = int(os.environ['MANIFEST_STREAM_THRESHOLD']) if 'MANIFEST_STREAM_THRESHOLD' in os.environ else None
+    return ManifestExporter(ingest_api=ingest_client, manifest_generator=manifest_generator,
+                            stream_threshold=stream_threshold)
+
+
 def setup_manifest_receiver() -> Thread:
-    ingest_client = IngestApi()
+    from kombu import Connection, Exchange, Queue
+    from manifest.receiver import ManifestReceiver
+
+    ingest_client = shared_ingest_client()
 
     with Connection(DEFAULT_RABBIT_URL) as conn:
         bundle_exchange = Exchange(EXCHANGE, type=EXCHANGE_TYPE)
@@ -64,39 +125,111 @@ def setup_manifest_receiver() -> Thread:
             'retry_policy': RETRY_POLICY
         }
 
-        manifest_generator = ManifestGenerator(ingest_client, GraphCrawler(MetadataService(ingest_client)))
-        exporter = ManifestExporter(ingest_api=ingest_client, manifest_generator=manifest_generator)
-        manifest_receiver = ManifestReceiver(conn, bundle_queues, exporter=exporter, publish_config=conf)
+        exporter = build_manifest_exporter(ingest_client)
+        manifest_workers = int(os.environ.get('MANIFEST_WORKERS', '4'))
+        manifest_prefetch = int(os.environ.get('MANIFEST_PREFETCH', str(manifest_workers)))
+        manifest_receiver = ManifestReceiver(conn, bundle_queues, exporter=exporter, publish_config=conf,
+                                             profiler=setup_profiler(),
+                                             executor=ThreadPoolExecutor(max_workers=manifest_workers),
+                                             prefetch_count=manifest_prefetch,
+                                             batch_window_sec=float(os.environ.get('MANIFEST_BATCH_WINDOW_SEC', '0')),
+                                             batch_size=int(os.environ.get('MANIFEST_BATCH_SIZE', '50')))
         manifest_process = Thread(target=manifest_receiver.run)
         manifest_process.start()
 
         return manifest_process
 
 
-def setup_terra_exporter() -> Thread:
-    ingest_api_url = os.environ.get('INGEST_API', 'localhost:8080')
-    aws_access_key_id = os.environ['AWS_ACCESS_KEY_ID']
-    aws_access_key_secret = os.environ['AWS_ACCESS_KEY_SECRET']
-    gcs_svc_credentials_path = os.environ['GCP_SVC_ACCOUNT_KEY_PATH']
-    gcp_project = os.environ['GCP_PROJECT']
+def build_terra_exporter(ingest_client: 'IngestApi') -> 'TerraExporter':
+    from exporter.graph.graph_crawler import GraphCrawler
+    from exporter.schema import SchemaService
+    from exporter.terra.dcp_staging_client import DcpStagingClient
+    from exporter.terra.gcs import GcsStorage
+    from exporter.terra.terra_export_job import TerraExportJobService
+    from exporter.terra.terra_exporter import TerraExporter
+    from exporter.terra.transfer_poller import TransferStatusPoller, TokenBucket
+
+    storage_backend = os.environ.get('STORAGE_BACKEND', 'gcs')
+    aws_access_key_id = os.environ.get('AWS_ACCESS_KEY_ID', '') if storage_backend == 'local' else os.environ['AWS_ACCESS_KEY_ID']
+    aws_access_key_secret = os.environ.get('AWS_ACCESS_KEY_SECRET', '') if storage_backend == 'local' else os.environ['AWS_ACCESS_KEY_SECRET']
+    gcp_project = os.environ.get('GCP_PROJECT', 'local') if storage_backend == 'local' else os.environ['GCP_PROJECT']
     terra_bucket_name = os.environ['TERRA_BUCKET_NAME']
     terra_bucket_prefix = os.environ['TERRA_BUCKET_PREFIX']
+    transfer_poll_interval_sec = float(os.environ.get('TRANSFER_POLL_INTERVAL_SEC', '10'))
+    transfer_poll_requests_per_sec = float(os.environ.get('TRANSFER_POLL_REQUESTS_PER_SEC', '1'))
+    # staged JSON is stored gzip-encoded, and transcoded by GCS for readers that do not accept gzip
+    gzip_uploads = os.environ.get('TERRA_GZIP_UPLOADS', 'false').lower() == 'true'
 
-    ingest_client = IngestApi(ingest_api_url)
+    ingest_limiter = build_limiter('ingest')
+    gcs_limiter = build_limiter('gcs')
 
-    metadata_service = MetadataService(ingest_client)
-    schema_service = SchemaService(ingest_client)
+    metadata_service = build_metadata_service(ingest_client, ingest_limiter)
+    schema_service = SchemaService(ingest_client).prefetch()
     graph_crawler = GraphCrawler(metadata_service)
-    dcp_staging_client = (DcpStagingClient
-                          .Builder()
-                          .with_ingest_client(ingest_client)
-                          .with_schema_service(schema_service)
-                          .with_gcs_info(gcs_svc_credentials_path, gcp_project, terra_bucket_name, terra_bucket_prefix)
-                          .with_gcs_xfer(gcs_svc_credentials_path, gcp_project, terra_bucket_name, terra_bucket_prefix, aws_access_key_id, aws_access_key_secret)
-                          .build())
+    dcp_staging_client_builder = (DcpStagingClient
+                                  .Builder()
+                                  .with_ingest_client(ingest_client)
+                                  .with_schema_service(schema_service))
+
+    if storage_backend == 'local':
+        from exporter.terra.emulator import FaultInjection, LocalGcsClient, LocalTransferClient, LocalGcsXferStorage, local_object_store
+
+        faults = FaultInjection(latency_sec=float(os.environ.get('LOCAL_STORAGE_LATENCY_SEC', '0')),
+                                failure_rate=float(os.environ.get('LOCAL_STORAGE_FAILURE_RATE', '0')))
+        gcs_client = LocalGcsClient(local_object_store(os.environ.get('LOCAL_STORAGE_ROOT')), faults)
+        transfer_client = LocalTransferClient(os.environ['LOCAL_S3_ROOT'], gcs_client,
+                                              float(os.environ.get('LOCAL_TRANSFER_DELAY_SEC', '0')))
+        status_poller = TransferStatusPoller(lambda: transfer_client, gcp_project, interval_sec=transfer_poll_interval_sec,
+                                             rate_limiter=TokenBucket(rate=transfer_poll_requests_per_sec, capacity=5))
+        dcp_staging_client_builder = (dcp_staging_client_builder
+                                      .with_gcs_storage(GcsStorage(gcs_client, terra_bucket_name, terra_bucket_prefix, gcs_limiter,
+                                                                   gzip_uploads=gzip_uploads))
+                                      .with_gcs_xfer_storage(LocalGcsXferStorage(transfer_client, aws_access_key_id, aws_access_key_secret, gcp_project,
+                                                                                 terra_bucket_name, terra_bucket_prefix, status_poller)))
+    else:
+        gcs_svc_credentials_path = os.environ['GCP_SVC_ACCOUNT_KEY_PATH']
+        dcp_staging_client_builder = (dcp_staging_client_builder
+                                      .with_gcs_info(gcs_svc_credentials_path, gcp_project, terra_bucket_name, terra_bucket_prefix, gcs_limiter,
+                                                     gzip_uploads)
+                                      .with_gcs_xfer(gcs_svc_credentials_path, gcp_project, terra_bucket_name, terra_bucket_prefix, aws_access_key_id, aws_access_key_secret,
+                                                     transfer_poll_interval_sec, transfer_poll_requests_per_sec))
+    render_processes = int(os.environ.get('TERRA_RENDER_PROCESSES', '0'))
+    validate_documents = os.environ.get('TERRA_VALIDATE_DOCUMENTS', 'false').lower() == 'true'
+    validator = None
+    if validate_documents:
+        from exporter.terra.validation import DocumentValidator
+        # the latest schemas are fetched and compiled at startup rather than by the first exports
+        validator = DocumentValidator().prefetch(schema_service.schema_urls())
+        dcp_staging_client_builder = dcp_staging_client_builder.with_validator(validator)
+    if render_processes > 0:
+        from exporter.terra.serialization import ProcessPoolRenderer
+        # workers start with the schemas already fetched by this process
+        schemas = validator.schema_cache.documents() if validator is not None else None
+        dcp_staging_client_builder = dcp_staging_client_builder.with_renderer(ProcessPoolRenderer(render_processes,
+                                                                                                  validate=validate_documents,
+                                                                                                  schemas=schemas))
+    dcp_staging_client = dcp_staging_client_builder.build()
+
+    data_file_verifier = None
+    if os.environ.get('TERRA_VERIFY_DATA_FILES', 'false').lower() == 'true':
+        from exporter.terra.verification import DataFileVerifier
+        data_file_verifier = DataFileVerifier(dcp_staging_client.gcs_storage)
+
+    terra_job_service = TerraExportJobService(ingest_client, ingest_limiter)
+    return TerraExporter(ingest_client, metadata_service, graph_crawler, dcp_staging_client, terra_job_service,
+                         data_file_verifier=data_file_verifier)
+
 
-    terra_job_service = TerraExportJobService(ingest_client)
-    terra_exporter = TerraExporter(ingest_client, metadata_service, graph_crawler, dcp_staging_client, terra_job_service)
+def setup_terra_exporter() -> Thread:
+    from exporter.amqp import AmqpConnConfig, QueueConfig
+    from exporter.sharding import HashRing, ShardRouter, shard_index_from_hostname, shard_queue_config
+    from exporter.terra.scheduler import FairScheduler
+    from exporter.terra.terra_listener import TerraListener
+
+    ingest_client = shared_ingest_client()
+
+    terra_exporter = build_terra_exporter(ingest_client)
+    terra_job_service = terra_exporter.job_service
 
     rabbit_host = os.environ.get('RABBIT_HOST', 'localhost')
     rabbit_port = int(os.environ.get('RABBIT_PORT', '5672'))
@@ -104,7 +237,26 @@ def setup_terra_exporter() -> Thread:
     experiment_queue_config = QueueConfig(EXPERIMENT_QUEUE_TERRA, EXPERIMENT_ROUTING_KEY, EXCHANGE, EXCHANGE_TYPE, False, None)
     publish_queue_config = QueueConfig(None, EXPERIMENT_COMPLETED_ROUTING_KEY, EXCHANGE, EXCHANGE_TYPE, True, RETRY_POLICY)
 
-    terra_listener = TerraListener(amqp_conn_config, terra_exporter, terra_job_service, experiment_queue_config, publish_queue_config)
+    shard_count = int(os.environ.get('SHARD_COUNT', '1'))
+    if shard_count > 1:
+        shard_index = int(os.environ['SHARD_INDEX']) if 'SHARD_INDEX' in os.environ \
+            else shard_index_from_hostname(os.environ.get('HOSTNAME', ''))
+        if shard_index is None or not 0 <= shard_index < shard_count:
+            raise ValueError(f'SHARD_INDEX must be between 0 and {shard_count - 1} when SHARD_COUNT is {shard_count}')
+        shard_router = ShardRouter(amqp_conn_config, HashRing(shard_count), experiment_queue_config)
+        Thread(target=shard_router.run).start()
+        experiment_queue_config = shard_queue_config(experiment_queue_config, shard_index)
+
+    scheduler = None
+    if os.environ.get('TERRA_FAIR_SCHEDULING', 'false').lower() == 'true':
+        terra_workers = int(os.environ.get('TERRA_WORKERS', '8'))
+        max_per_submission = int(os.environ['TERRA_MAX_PER_SUBMISSION']) if 'TERRA_MAX_PER_SUBMISSION' in os.environ else None
+        scheduler = FairScheduler(terra_workers, max_per_submission,
+                                  aging_sec=float(os.environ.get('TERRA_PRIORITY_AGING_SEC', '300'))).start()
+    terra_prefetch = int(os.environ.get('TERRA_PREFETCH', '100' if scheduler is not None else '1'))
+
+    terra_listener = TerraListener(amqp_conn_config, terra_exporter, terra_job_service, experiment_queue_config, publish_queue_config,
+                                   setup_profiler(), scheduler, terra_prefetch)
 
     terra_exporter_listener_process = Thread(target=lambda: terra_listener.run())
     terra_exporter_listener_process.start()
@@ -112,16 +264,103 @@ def setup_terra_exporter() -> Thread:
     return terra_exporter_listener_process
 
 
+def build_dry_run_terra_exporter(ingest_client: 'IngestApi', dry_run_root: str) -> 'TerraExporter':
+    from exporter.graph.graph_crawler import GraphCrawler
+    from exporter.schema import SchemaService
+    from exporter.terra.dcp_staging_client import DcpStagingClient
+    from exporter.terra.dry_run import DryRunStorage
+    from exporter.terra.terra_export_job import TerraExportJobService
+    from exporter.terra.terra_exporter import TerraExporter
+
+    metadata_service = build_metadata_service(ingest_client)
+    dry_run_storage = DryRunStorage(os.environ.get('TERRA_BUCKET_PREFIX', ''), root=dry_run_root)
+    dcp_staging_client = DcpStagingClient(dry_run_storage, None, SchemaService(ingest_client), ingest_client)
+    return TerraExporter(ingest_client, metadata_service, GraphCrawler(metadata_service), dcp_staging_client,
+                         TerraExportJobService(ingest_client))
+
+
+def batch_export_tasks(modes: List[str], submission_uuid: str, export_job_id: Optional[str],
+                       dry_run_root: Optional[str] = None) -> 'ExportTasks':
+    from ingest.api.ingestapi import IngestApi
+    from exporter.batch import AssayProcess
+    from exporter.compression import negotiate_compression
+
+    ingest_client = IngestApi(os.environ.get('INGEST_API', 'localhost:8080'))
+    negotiate_compression(ingest_client.session, 'ingest')
+    tasks = dict()
+    if dry_run_root:
+        terra_exporter = build_dry_run_terra_exporter(ingest_client, dry_run_root)
+        # a dry run is a single export of the submission
+        tasks['terra'] = lambda process: terra_exporter.export_metadata(process.uuid, export_job_id or submission_uuid)
+        return tasks
+
+    if 'manifest' in modes:
+        manifest_exporter = build_manifest_exporter(ingest_client)
+        tasks['manifest'] = lambda process: manifest_exporter.export(process.uuid, submission_uuid)
+    if 'terra' in modes:
+        terra_exporter = build_terra_exporter(ingest_client)
+
+        def export_terra(process: AssayProcess):
+            terra_exporter.export(process.uuid, submission_uuid, export_job_id)
+            terra_exporter.job_service.create_export_entity(export_job_id, process.id)
+
+        tasks['terra'] = export_terra
+    return tasks
+
+
+def batch_export(argv: List[str]):
+    from ingest.api.ingestapi import IngestApi
+    from exporter.batch import BatchExport, Checkpoint, assay_processes
+    from exporter.terra.dry_run import DryRunReport
+
+    p = argparse.ArgumentParser(prog='exporter.py export-submission',
+                                description='Export the assays of a submission without going through RabbitMQ')
+    p.add_argument('submission_uuid', type=str)
+    p.add_argument('--mode', nargs='+', choices=['manifest', 'terra'], default=['manifest'])
+    p.add_argument('--export-job-id', type=str, help='the export job to record Terra exports against')
+    p.add_argument('--workers', type=int, default=4, help='number of worker processes')
+    p.add_argument('--checkpoint', type=str, help='file recording exported assays, used to resume an interrupted run')
+    p.add_argument('--dry-run', type=str, metavar='DIR',
+                   help='stage Terra metadata, descriptors and links to this directory instead of GCS, without '
+                        'transferring data files, and report object counts and sizes')
+    args = p.parse_args(argv)
+    if args.dry_run:
+        args.mode = ['terra']
+    elif 'terra' in args.mode and not args.export_job_id:
+        p.error('--export-job-id is required for Terra exports')
+
+    ingest_client = IngestApi(os.environ.get('INGEST_API', 'localhost:8080'))
+    processes = assay_processes(ingest_client, args.submission_uuid)
+    result = BatchExport(batch_export_tasks, (args.mode, args.submission_uuid, args.export_job_id, args.dry_run),
+                         args.workers, Checkpoint(args.checkpoint)).run(processes, args.mode)
+    if args.dry_run:
+        report = DryRunReport.for_directory(args.dry_run, os.environ.get('TERRA_BUCKET_PREFIX', '')).to_dict()
+        print(json.dumps(report, indent=2))
+    return 1 if result.failed else 0
+
+
 if __name__ == '__main__':
     logging.getLogger('ingest').setLevel(logging.INFO)
     logging.getLogger('manifest').setLevel(logging.INFO)
+    logging.getLogger('exporter.metrics').setLevel(logging.INFO)
 
     format = ' %(asctime)s  - %(name)s - %(levelname)s in %(filename)s:' \
              '%(lineno)s %(funcName)s(): %(message)s'
     logging.basicConfig(stream=sys.stdout, level=logging.WARNING,
                         format=format)
 
-    if not DISABLE_MANIFEST:
+    if len(sys.argv) > 1 and sys.argv[1] == 'export-submission':
+        sys.exit(batch_export(sys.argv[2:]))
+
+    if 'METRICS_PORT' in os.environ:
+        metrics.MetricsServer(int(os.environ['METRICS_PORT'])).start()
+    metrics.registry.trace_logging_enabled = os.environ.get('TRACE_LOG', 'false').lower() == 'true'
+
+    if EXPORTER_ROLE not in ('all', 'manifest', 'terra'):
+        sys.exit(f'Unknown EXPORTER_ROLE {EXPORTER_ROLE}, expected all, manifest or terra')
+
+    if EXPORTER_ROLE == 'manifest' or (EXPORTER_ROLE == 'all' and not DISABLE_MANIFEST):
         setup_manifest_receiver()
 
-    setup_terra_exporter()
+    if EXPORTER_ROLE in ('all', 'terra'):
+        setup_terra_exporter()
@@ -0,0 +1,157 @@
+"""
+Exports the assays of a whole submission outside of the AMQP listeners, e.g. to backfill or re-export a submission.
+
+Assays are exported on a pool of worker processes, each of which builds its own exporters with a factory. Every
+completed (mode, process) pair is recorded in a checkpoint file, so an interrupted run can be resumed without
+repeating finished work.
+"""
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from multiprocessing import Pool
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from ingest.api.ingestapi import IngestApi
+
+# mode -> function exporting one assay process
+ExportTasks = Dict[str, Callable[['AssayProcess'], None]]
+
+
+@dataclass
+class AssayProcess:
+    uuid: str
+    id: str
+
+    @staticmethod
+    def from_dict(data: Dict) -> 'AssayProcess':
+        return AssayProcess(data['uuid']['uuid'], data['_links']['self']['href'].split('/')[-1])
+
+
+def assay_processes(ingest_api: IngestApi, submission_uuid: str, workers: int = 8) -> List[AssayProcess]:
+    """
+    Finds the assay processes of a submission, i.e. its processes with both input biomaterials and derived files
+    """
+    submission = ingest_api.get_submission_by_uuid(submission_uuid)
+    processes = list(ingest_api.get_related_entities('processes', submission, 'processes'))
+
+    def is_assay(process: Dict) -> bool:
+        return bool(ingest_api.get_related_entities_count('derivedFiles', process, 'files')) and \
+               bool(ingest_api.get_related_entities_count('inputBiomaterials', process, 'biomaterials'))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return [AssayProcess.from_dict(process)
+                for process, assay in zip(processes, executor.map(is_assay, processes)) if assay]
+
+
+class Checkpoint:
+    """
+    A JSON lines file with one {"mode": ..., "process": ...} line per completed export, appended as each completes,
+    so recording an export costs the same however many came before it. A line cut short by an interrupted run is
+    ignored when the checkpoint is read back.
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.completed: Dict[str, Set[str]] = dict()
+        self._line_start = ''
+        if path and os.path.exists(path):
+            with open(path) as checkpoint_file:
+                line = '\n'
+                for line in checkpoint_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.completed.setdefault(entry['mode'], set()).add(entry['process'])
+                if not line.endswith('\n'):
+                    self._line_start = '\n'
+
+    def is_complete(self, mode: str, process_uuid: str) -> bool:
+        return process_uuid in self.completed.get(mode, ())
+
+    def mark_complete(self, mode: str, process_uuid: str):
+        self.completed.setdefault(mode, set()).add(process_uuid)
+        if self.path:
+            with open(self.path, 'a') as checkpoint_file:
+                checkpoint_file.write(self._line_start + json.dumps({'mode': mode, 'process': process_uuid}) + '\n')
+            self._line_start = ''
+
+
+@dataclass
+class BatchResult:
+    exported: int
+    failed: int
+    skipped: int
+
+
+_worker_tasks: Optional[ExportTasks] = None
+
+
+def _init_worker(tasks_factory: Callable[..., ExportTasks], factory_args: Tuple):
+    global _worker_tasks
+    _worker_tasks = tasks_factory(*factory_args)
+
+
+def _export_process(work: Tuple[AssayProcess, List[str]]) -> Tuple[AssayProcess, Dict[str, Optional[str]]]:
+    process, modes = work
+    errors = dict()
+    for mode in modes:
+        try:
+            _worker_tasks[mode](process)
+            errors[mode] = None
+        except Exception as e:
+            logging.getLogger(__name__).exception(f'Failed to export {mode} for process {process.uuid}')
+            errors[mode] = f'{type(e).__name__}: {str(e)}'
+    return process, errors
+
+
+class BatchExport:
+
+    def __init__(self, tasks_factory: Callable[..., ExportTasks], factory_args: Tuple = (), workers: int = 1,
+                 checkpoint: Optional[Checkpoint] = None, progress: Callable[[str], None] = print):
+        self.tasks_factory = tasks_factory
+        self.factory_args = factory_args
+        self.workers = workers
+        self.checkpoint = checkpoint if checkpoint is not None else Checkpoint(None)
+        self.progress = progress
+
+    def run(self, processes: Iterable[AssayProcess], modes: List[str]) -> BatchResult:
+        processes = list(processes)
+        pending = [(process, [mode for mode in modes if not self.checkpoint.is_complete(mode, process.uuid)])
+                   for process in processes]
+        pending = [(process, pending_modes) for process, pending_modes in pending if pending_modes]
+        result = BatchResult(exported=0, failed=0, skipped=len(processes) - len(pending))
+        self.progress(f'Exporting {len(pending)} assays ({", ".join(modes)}) with {self.workers} workers, '
+                      f'{result.skipped} already exported')
+
+        start = time.perf_counter()
+        for done, (process, errors) in enumerate(self._export(pending), start=1):
+            for mode, error in errors.items():
+                if error is None:
+                    self.checkpoint.mark_complete(mode, process.uuid)
+
+            failures = dict((mode, error) for mode, error in errors.items() if error is not None)
+            if failures:
+                result.failed += 1
+            else:
+                result.exported += 1
+            elapsed_sec = time.perf_counter() - start
+            remaining_sec = elapsed_sec / done * (len(pending) - done)
+            status = '; '.join(f'{mode} failed: {error}' for mode, error in failures.items()) or 'ok'
+            self.progress(f'[{done}/{len(pending)}] {process.uuid} {status} '
+                          f'({done / elapsed_sec:.2f} assays/s, ~{remaining_sec:.0f}s remaining)')
+
+        self.progress(f'Exported {result.exported}, failed {result.failed}, skipped {result.skipped} assays '
+                      f'in {time.perf_counter() - start:.1f}s')
+        return result
+
+    def _export(self, pending: List[Tuple[AssayProcess, List[str]]]):
+        if self.workers <= 1:
+            _init_worker(self.tasks_factory, self.factory_args)
+            yield from map(_export_process, pending)
+        else:
+            with Pool(self.workers, initializer=_init_worker, initargs=(self.tasks_factory, self.factory_args)) as pool:
+                yield from pool.imap_unordered(_export_process, pending)
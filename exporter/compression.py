@@ -0,0 +1,41 @@
+"""
+Compression on the wire: of responses from ingest, and of JSON documents staged in GCS.
+"""
+import gzip
+from io import BytesIO
+
+from requests import Session
+from urllib3.util.request import ACCEPT_ENCODING
+
+from exporter import metrics
+
+
+def negotiate_compression(session: Session, service: str) -> Session:
+    """
+    Asks for responses in every encoding urllib3 can decode (gzip and deflate, and brotli when a brotli package is
+    installed), and counts the bytes received before they are decoded
+    """
+    session.headers['Accept-Encoding'] = ', '.join(ACCEPT_ENCODING.split(','))
+    session.hooks['response'].append(wire_bytes_hook(service))
+    return session
+
+
+def wire_bytes_hook(service: str):
+    def count_wire_bytes(response, *args, **kwargs):
+        # Content-Length is the length of the encoded body; chunked responses are not counted
+        content_length = response.headers.get('Content-Length')
+        if content_length is not None and content_length.isdigit():
+            metrics.inc('http_response_wire_bytes_total',
+                        {"service": service, "encoding": response.headers.get('Content-Encoding', 'identity')},
+                        int(content_length))
+        return response
+
+    return count_wire_bytes
+
+
+def gzip_bytes(data: bytes, level: int = 6) -> bytes:
+    # without a timestamp, the same document always compresses to the same bytes
+    buffer = BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=level, mtime=0) as gzip_file:
+        gzip_file.write(data)
+    return buffer.getvalue()
@@ -1,7 +1,7 @@
 from exporter.metadata import MetadataResource
 
 from copy import deepcopy
-from typing import List, Set, Dict, Iterable, Any, Union
+from typing import List, Set, Dict, Iterable, Iterator, Any, Union
 from dataclasses import dataclass
 
 
@@ -183,6 +183,12 @@ class MetadataNodeSet:
     def get_nodes(self) -> List[MetadataResource]:
         return [deepcopy(obj) for obj in self.objs]
 
+    def iter_nodes(self) -> Iterator[MetadataResource]:
+        """
+        Iterates over the nodes in insertion order without copying them. Nodes must be treated as read-only.
+        """
+        return iter(self.objs)
+
 
 class ExperimentGraph:
     links: LinkSet
@@ -196,7 +202,7 @@ class ExperimentGraph:
         for link in graph.links.get_links():
             self.links.add_link(link)
 
-        for node in graph.nodes.get_nodes():
+        for node in graph.nodes.iter_nodes():
             self.nodes.add_node(node)
 
         return self
@@ -0,0 +1,169 @@
+"""
+A compact process graph for the manifest batch crawl of large submissions.
+
+UUIDs are interned to dense integer ids, and edges are kept in flat integer arrays, one row per process, instead of
+sets and lists of UUID strings. The CachingGraphCrawler keeps the shape of everything it has crawled here, and turns
+a process back into a ProcessLink only when it assembles an assay's experiment graph.
+"""
+from array import array
+from typing import Dict, Iterable, List, Tuple
+
+from exporter.graph.experiment_graph import Input, Output, ProcessLink, ProtocolLink
+
+TypedUuid = Tuple[str, str]
+
+
+class UuidInterner:
+
+    def __init__(self):
+        self._ids: Dict[str, int] = dict()
+        self._uuids: List[str] = []
+
+    def id_for(self, uuid: str) -> int:
+        node_id = self._ids.get(uuid)
+        if node_id is None:
+            node_id = self._ids[uuid] = len(self._uuids)
+            self._uuids.append(uuid)
+        return node_id
+
+    def get(self, uuid: str) -> int:
+        return self._ids.get(uuid, -1)
+
+    def uuid_of(self, node_id: int) -> str:
+        return self._uuids[node_id]
+
+    def __contains__(self, uuid: str) -> bool:
+        return uuid in self._ids
+
+    def __len__(self) -> int:
+        return len(self._uuids)
+
+
+class _Adjacency:
+    """
+    Rows of node ids, stored back to back in one array, with each node's row located by its start and length
+    """
+
+    def __init__(self):
+        self.targets = array('l')
+        self.starts = array('l')
+        self.lengths = array('l')
+
+    def set_row(self, node_id: int, targets: Iterable[int]):
+        self._grow(node_id + 1)
+        self.starts[node_id] = len(self.targets)
+        self.targets.extend(targets)
+        self.lengths[node_id] = len(self.targets) - self.starts[node_id]
+
+    def has_row(self, node_id: int) -> bool:
+        return 0 <= node_id < len(self.starts) and self.starts[node_id] >= 0
+
+    def row(self, node_id: int) -> array:
+        if not self.has_row(node_id):
+            return array('l')
+        start = self.starts[node_id]
+        return self.targets[start:start + self.lengths[node_id]]
+
+    def _grow(self, size: int):
+        missing = size - len(self.starts)
+        if missing > 0:
+            self.starts.extend([-1] * missing)
+            self.lengths.extend([0] * missing)
+
+
+class ProcessGraph:
+    """
+    Processes with their inputs, outputs and protocols, and the processes upstream (deriving their inputs) and
+    downstream (taking their outputs) of them.
+
+    `experiment_processes` gives the processes of an assay's experiment graph in the order the GraphCrawler would
+    crawl them: a depth-first walk upstream from the assay, then downstream.
+
+    It is not thread-safe: a graph shared by several threads must be read, as well as written, under one lock.
+    """
+
+    def __init__(self):
+        self.ids = UuidInterner()
+        self._types: List[str] = []
+        self._type_ids: Dict[str, int] = dict()
+        self._node_types = array('l')
+
+        self._inputs = _Adjacency()
+        self._outputs = _Adjacency()
+        self._protocols = _Adjacency()
+        self._upstream = _Adjacency()
+        self._downstream = _Adjacency()
+
+    def add_process(self, process: TypedUuid, inputs: Iterable[TypedUuid], outputs: Iterable[TypedUuid],
+                    protocols: Iterable[TypedUuid]):
+        process_id = self._intern(process)
+        self._inputs.set_row(process_id, [self._intern(i) for i in inputs])
+        self._outputs.set_row(process_id, [self._intern(o) for o in outputs])
+        self._protocols.set_row(process_id, [self._intern(p) for p in protocols])
+
+    def set_upstream(self, process_uuid: str, upstream_uuids: Iterable[str]):
+        self._upstream.set_row(self.ids.id_for(process_uuid), [self.ids.id_for(uuid) for uuid in upstream_uuids])
+
+    def set_downstream(self, process_uuid: str, downstream_uuids: Iterable[str]):
+        self._downstream.set_row(self.ids.id_for(process_uuid), [self.ids.id_for(uuid) for uuid in downstream_uuids])
+
+    def has_process(self, process_uuid: str) -> bool:
+        return self._inputs.has_row(self.ids.get(process_uuid))
+
+    def has_upstream(self, process_uuid: str) -> bool:
+        return self._upstream.has_row(self.ids.get(process_uuid))
+
+    def has_downstream(self, process_uuid: str) -> bool:
+        return self._downstream.has_row(self.ids.get(process_uuid))
+
+    def experiment_processes(self, process_uuid: str) -> List[str]:
+        process_id = self.ids.get(process_uuid)
+        if process_id < 0:
+            return []
+        visited = bytearray(len(self.ids))
+        upstream = self._walk(process_id, self._upstream)
+        for node_id in upstream:
+            visited[node_id] = 1
+        downstream = [node_id for node_id in self._walk(process_id, self._downstream) if not visited[node_id]]
+        return [self.ids.uuid_of(node_id) for node_id in upstream + downstream]
+
+    def process_link(self, process_uuid: str) -> ProcessLink:
+        process_id = self.ids.get(process_uuid)
+        return ProcessLink(process_uuid, self._type_of(process_id),
+                           [Input(self._type_of(i), self.ids.uuid_of(i)) for i in self._inputs.row(process_id)],
+                           [Output(self._type_of(o), self.ids.uuid_of(o)) for o in self._outputs.row(process_id)],
+                           [ProtocolLink(self._type_of(p), self.ids.uuid_of(p)) for p in self._protocols.row(process_id)])
+
+    def _walk(self, start_id: int, adjacency: _Adjacency) -> List[int]:
+        """
+        Depth-first pre-order walk, children in row order
+        """
+        if start_id < 0:
+            return []
+        visited = bytearray(len(self.ids))
+        order = []
+        stack = [start_id]
+        while stack:
+            node_id = stack.pop()
+            if visited[node_id]:
+                continue
+            visited[node_id] = 1
+            order.append(node_id)
+            stack.extend(reversed(adjacency.row(node_id)))
+        return order
+
+    def _intern(self, typed_uuid: TypedUuid) -> int:
+        concrete_type, uuid = typed_uuid
+        node_id = self.ids.id_for(uuid)
+        type_id = self._type_ids.get(concrete_type)
+        if type_id is None:
+            type_id = self._type_ids[concrete_type] = len(self._types)
+            self._types.append(concrete_type)
+        missing = node_id + 1 - len(self._node_types)
+        if missing > 0:
+            self._node_types.extend([-1] * missing)
+        self._node_types[node_id] = type_id
+        return node_id
+
+    def _type_of(self, node_id: int) -> str:
+        return self._types[self._node_types[node_id]]
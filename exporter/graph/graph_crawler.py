@@ -1,11 +1,14 @@
+from exporter import metrics
 from exporter.metadata import MetadataResource, MetadataService
 from exporter.graph.experiment_graph import ExperimentGraph, ProcessLink, Input, Output, ProtocolLink, SupplementaryFileLink, SupplementedEntity, SupplementaryFile
-from typing import List, Iterable, Optional, Callable
+from exporter.graph.graph_core import ProcessGraph
+from typing import List, Iterable, Optional, Callable, Dict, Tuple, Any
 from functools import reduce
 from operator import iconcat
 from dataclasses import dataclass
 
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
 
 
 @dataclass
@@ -14,6 +17,9 @@ class ProcessInfo:
     inputs: List[MetadataResource]
     outputs: List[MetadataResource]
     protocols: List[MetadataResource]
+    # lookups of the processes deriving each input, or taking each output, started as the materials' pages arrived
+    upstream: Optional[List[Future]] = None
+    downstream: Optional[List[Future]] = None
 
 
 @dataclass
@@ -25,16 +31,19 @@ class SupplementaryFilesInfo:
 class GraphCrawler:
     def __init__(self, metadata_service: MetadataService):
         self.metadata_service = metadata_service
+        # looks up the processes linked through each crawled input or output
+        self.lookups = ThreadPoolExecutor(max_workers=8, thread_name_prefix='crawl-lookup')
 
     def generate_complete_experiment_graph(self, process: MetadataResource, project: MetadataResource) -> ExperimentGraph:
-        experiment_process_graph = self.generate_experiment_graph(process)
-        supplementary_files_graph = self.generate_supplementary_files_graph(project)
+        with metrics.span('crawl'):
+            experiment_process_graph = self.generate_experiment_graph(process)
+            supplementary_files_graph = self.generate_supplementary_files_graph(project)
 
-        return experiment_process_graph.extend(supplementary_files_graph)
+            return experiment_process_graph.extend(supplementary_files_graph)
 
     def generate_experiment_graph(self, process: MetadataResource) -> ExperimentGraph:
-        upward_graph = self._crawl(process, self._crawl_inputs)
-        downward_graph = self._crawl(process, self._crawl_outputs)
+        upward_graph = self._crawl(process, upstream=True)
+        downward_graph = self._crawl(process, upstream=False)
         initial_graph = ExperimentGraph()
 
         return reduce(lambda g1, g2: g1.extend(g2),
@@ -61,24 +70,32 @@ class GraphCrawler:
             graph.nodes.add_node(project)
             return graph
 
-    def _crawl(self, process: MetadataResource, crawl_strategy_func: Callable) -> ExperimentGraph:
+    def _crawl(self, process: MetadataResource, upstream: bool) -> ExperimentGraph:
         partial_graph = ExperimentGraph()
 
-        process_info = self.process_info(process)
+        process_info = self.process_info(process, follow_inputs=upstream, follow_outputs=not upstream)
         partial_graph.nodes.add_nodes(process_info.inputs + process_info.outputs + process_info.protocols + [process])
         partial_graph.links.add_link(GraphCrawler.process_link_for(process_info))
 
-        processes_to_crawl = crawl_strategy_func(process_info)
+        processes_to_crawl = self._crawl_inputs(process_info) if upstream else self._crawl_outputs(process_info)
 
         return reduce(lambda g1, g2: g1.extend(g2),
-                      map(lambda proc: self._crawl(proc, crawl_strategy_func), processes_to_crawl),
+                      map(lambda proc: self._crawl(proc, upstream), processes_to_crawl),
                       partial_graph)
 
-    def _crawl_inputs(self, process_info: ProcessInfo) -> ExperimentGraph:
-        return GraphCrawler.flatten([self.metadata_service.get_derived_by_processes(i) for i in process_info.inputs])
+    def _crawl_inputs(self, process_info: ProcessInfo) -> List[MetadataResource]:
+        return self._linked_processes(process_info.inputs, process_info.upstream,
+                                      self.metadata_service.get_derived_by_processes)
 
-    def _crawl_outputs(self, process_info: ProcessInfo) -> ExperimentGraph:
-        return GraphCrawler.flatten([self.metadata_service.get_input_to_processes(i) for i in process_info.outputs])
+    def _crawl_outputs(self, process_info: ProcessInfo) -> List[MetadataResource]:
+        return self._linked_processes(process_info.outputs, process_info.downstream,
+                                      self.metadata_service.get_input_to_processes)
+
+    def _linked_processes(self, materials: List[MetadataResource], lookups: Optional[List[Future]],
+                          lookup: Callable[[MetadataResource], List[MetadataResource]]) -> List[MetadataResource]:
+        if lookups is None:
+            lookups = [self.lookups.submit(lookup, material) for material in materials]
+        return GraphCrawler.flatten([linked.result() for linked in lookups])
 
 
     @staticmethod
@@ -103,18 +120,39 @@ class GraphCrawler:
     def flatten(list_of_lists: Iterable[Iterable]) -> List:
         return reduce(iconcat, list_of_lists, [])
 
-    def process_info(self, process: MetadataResource) -> ProcessInfo:
-        with ThreadPoolExecutor() as executor:
-            _input_biomaterials = executor.submit(lambda: self.metadata_service.get_input_biomaterials(process))
-            _input_files = executor.submit(lambda: self.metadata_service.get_input_files(process))
-            _output_biomaterials = executor.submit(lambda: self.metadata_service.get_derived_biomaterials(process))
-            _output_files = executor.submit(lambda: self.metadata_service.get_derived_files(process))
+    def process_info(self, process: MetadataResource, follow_inputs: bool = False,
+                     follow_outputs: bool = False) -> ProcessInfo:
+        """
+        With `follow_inputs` or `follow_outputs`, the processes linked to each input or output are looked up as soon
+        as its page of the relation arrives, rather than once the whole relation has been fetched
+        """
+        derived_by = self.metadata_service.get_derived_by_processes if follow_inputs else None
+        taken_by = self.metadata_service.get_input_to_processes if follow_outputs else None
+        with metrics.span('process_info'), ThreadPoolExecutor() as executor:
+            _input_biomaterials = executor.submit(self._materials, 'inputBiomaterials', process, 'biomaterials', derived_by)
+            _input_files = executor.submit(self._materials, 'inputFiles', process, 'files', derived_by)
+            _output_biomaterials = executor.submit(self._materials, 'derivedBiomaterials', process, 'biomaterials', taken_by)
+            _output_files = executor.submit(self._materials, 'derivedFiles', process, 'files', taken_by)
             _protocols = executor.submit(lambda: self.metadata_service.get_protocols(process))
 
-            inputs = _input_biomaterials.result() + _input_files.result()
-            outputs = _output_biomaterials.result() + _output_files.result()
+            input_biomaterials, input_biomaterial_lookups = _input_biomaterials.result()
+            input_files, input_file_lookups = _input_files.result()
+            output_biomaterials, output_biomaterial_lookups = _output_biomaterials.result()
+            output_files, output_file_lookups = _output_files.result()
             protocols = _protocols.result()
-            return ProcessInfo(process, inputs, outputs, protocols)
+            return ProcessInfo(process, input_biomaterials + input_files, output_biomaterials + output_files, protocols,
+                               upstream=input_biomaterial_lookups + input_file_lookups if follow_inputs else None,
+                               downstream=output_biomaterial_lookups + output_file_lookups if follow_outputs else None)
+
+    def _materials(self, relation: str, process: MetadataResource, entity_type: str,
+                   lookup: Optional[Callable[[MetadataResource], List[MetadataResource]]]) -> Tuple[List[MetadataResource], List[Future]]:
+        if lookup is None:
+            return self.metadata_service.get_related(relation, process, entity_type), []
+        materials, lookups = [], []
+        for page in self.metadata_service.iter_related(relation, process, entity_type):
+            materials.extend(page)
+            lookups.extend(self.lookups.submit(lookup, material) for material in page)
+        return materials, lookups
 
     def supplementary_files_info(self, metadata: MetadataResource) -> Optional[SupplementaryFilesInfo]:
         files = self.metadata_service.get_supplementary_files(metadata)
@@ -122,3 +160,91 @@ class GraphCrawler:
             return SupplementaryFilesInfo(metadata, files)
         else:
             return None
+
+
+class CachingGraphCrawler(GraphCrawler):
+    """
+    A GraphCrawler that remembers the metadata it has fetched for each process and project, so that crawling
+    several assays of the same submission only fetches the processes and projects they share once.
+    Meant to be short-lived, e.g. for the duration of a batch of exports.
+
+    The shape of the crawled graph is kept in a ProcessGraph, so an assay's experiment graph is extracted from
+    integer arrays rather than rebuilt by merging one partial graph per process.
+    """
+
+    def __init__(self, metadata_service: MetadataService):
+        super().__init__(metadata_service)
+        self.process_graph = ProcessGraph()
+        self._cache: Dict[Tuple[str, str], Any] = dict()
+        self._lock = Lock()
+
+    def generate_experiment_graph(self, process: MetadataResource) -> ExperimentGraph:
+        self._expand(process, upstream=True)
+        self._expand(process, upstream=False)
+
+        # other threads' crawls may be growing the graph, so it is only read under the lock
+        with self._lock:
+            experiment = [(self._cache[('process_info', process_uuid)], self.process_graph.process_link(process_uuid))
+                          for process_uuid in self.process_graph.experiment_processes(process.uuid)]
+
+        graph = ExperimentGraph()
+        for process_info, link in experiment:
+            graph.nodes.add_nodes(process_info.inputs + process_info.outputs + process_info.protocols + [process_info.process])
+            graph.links.add_link(link)
+        return graph
+
+    def _expand(self, process: MetadataResource, upstream: bool):
+        """
+        Fetches every process reachable from this one, upstream or downstream, if not fetched already
+        """
+        expanded = set()
+        processes = [process]
+        while processes:
+            next_process = processes.pop()
+            if next_process.uuid not in expanded:
+                expanded.add(next_process.uuid)
+                process_info = self.process_info(next_process, follow_inputs=upstream, follow_outputs=not upstream)
+                processes.extend(self._crawl_inputs(process_info) if upstream else self._crawl_outputs(process_info))
+
+    def process_info(self, process: MetadataResource, follow_inputs: bool = False,
+                     follow_outputs: bool = False) -> ProcessInfo:
+        return self._cached('process_info', process.uuid, lambda: self._record(
+            super(CachingGraphCrawler, self).process_info(process, follow_inputs, follow_outputs)))
+
+    def supplementary_files_info(self, metadata: MetadataResource) -> Optional[SupplementaryFilesInfo]:
+        return self._cached('supplementary_files', metadata.uuid,
+                            lambda: super(CachingGraphCrawler, self).supplementary_files_info(metadata))
+
+    def _crawl_inputs(self, process_info: ProcessInfo) -> List[MetadataResource]:
+        upstream = self._cached('crawl_inputs', process_info.process.uuid,
+                                lambda: super(CachingGraphCrawler, self)._crawl_inputs(process_info))
+        with self._lock:
+            if not self.process_graph.has_upstream(process_info.process.uuid):
+                self.process_graph.set_upstream(process_info.process.uuid, [p.uuid for p in upstream])
+        return upstream
+
+    def _crawl_outputs(self, process_info: ProcessInfo) -> List[MetadataResource]:
+        downstream = self._cached('crawl_outputs', process_info.process.uuid,
+                                  lambda: super(CachingGraphCrawler, self)._crawl_outputs(process_info))
+        with self._lock:
+            if not self.process_graph.has_downstream(process_info.process.uuid):
+                self.process_graph.set_downstream(process_info.process.uuid, [p.uuid for p in downstream])
+        return downstream
+
+    def _record(self, process_info: ProcessInfo) -> ProcessInfo:
+        with self._lock:
+            if not self.process_graph.has_process(process_info.process.uuid):
+                self.process_graph.add_process((process_info.process.concrete_type(), process_info.process.uuid),
+                                               [(i.concrete_type(), i.uuid) for i in process_info.inputs],
+                                               [(o.concrete_type(), o.uuid) for o in process_info.outputs],
+                                               [(p.concrete_type(), p.uuid) for p in process_info.protocols])
+        return process_info
+
+    def _cached(self, kind: str, uuid: str, fetch: Callable[[], Any]) -> Any:
+        key = (kind, uuid)
+        with self._lock:
+            if key in self._cache:
+                return self._cache[key]
+        value = fetch()
+        with self._lock:
+            return self._cache.setdefault(key, value)
@@ -0,0 +1,39 @@
+import json
+from threading import Lock
+from typing import Dict
+
+from exporter.graph.experiment_graph import LinkSet, Link
+
+
+class LinkIndex:
+    """
+    Serialised links of a submission, by process (or supplemented entity) uuid.
+
+    Assays of the same submission share most of their upstream process links. Each link is serialised the first
+    time it is seen, and a links document is assembled from the serialised fragments of the links in its LinkSet.
+    The index assumes links don't change while the submission is being exported, so it should only be kept for the
+    duration of an export.
+    """
+
+    def __init__(self):
+        self._fragments: Dict[str, str] = dict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._fragments)
+
+    def fragment(self, link_uuid: str, link: Link) -> str:
+        fragment = self._fragments.get(link_uuid)
+        if fragment is None:
+            fragment = json.dumps(link.to_dict())
+            with self._lock:
+                fragment = self._fragments.setdefault(link_uuid, fragment)
+        return fragment
+
+    def links_json(self, link_set: LinkSet, document_fields: Dict) -> str:
+        """
+        :return: the same JSON as `json.dumps(dict(link_set.to_dict(), **document_fields))`
+        """
+        fragments = ', '.join(self.fragment(link_uuid, link) for link_uuid, link in link_set.links.items())
+        fields = json.dumps(document_fields)[1:-1]
+        return f'{{"links": [{fragments}]{", " + fields if fields else ""}}}'
@@ -0,0 +1,116 @@
+"""
+Adaptive concurrency limits for calls to downstream services.
+
+An AdaptiveLimiter bounds the number of concurrent calls to a service and adjusts the bound with AIMD (additive
+increase, multiplicative decrease): after every window of calls, it raises the limit by one if the window was busy
+and its p95 latency stayed close to the best latency seen, and cuts it if latency rose or the service signalled
+overload (5xx or 429 responses, timeouts, connection errors).
+"""
+import logging
+import math
+import time
+from threading import Condition
+from typing import Any, Callable, List, Optional
+
+import requests
+from google.api_core import exceptions as google_exceptions
+
+from exporter import metrics
+
+_OVERLOAD_EXCEPTIONS = (requests.ConnectionError,
+                        requests.Timeout,
+                        google_exceptions.ServerError,
+                        google_exceptions.TooManyRequests)
+
+
+def is_overload(error: Optional[BaseException] = None, response: Any = None) -> bool:
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        response = error.response
+    elif error is not None:
+        return isinstance(error, _OVERLOAD_EXCEPTIONS)
+    status_code = getattr(response, 'status_code', None)
+    return isinstance(status_code, int) and (status_code == 429 or status_code >= 500)
+
+
+class AdaptiveLimiter:
+
+    def __init__(self, name: str, initial_limit: int = 8, min_limit: int = 1, max_limit: int = 64,
+                 window_size: int = 50, latency_tolerance: float = 2.0, backoff_ratio: float = 0.7,
+                 baseline_drift: float = 0.05, clock: Callable[[], float] = time.perf_counter):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.window_size = window_size
+        self.latency_tolerance = latency_tolerance
+        self.backoff_ratio = backoff_ratio
+        # the baseline latency follows lower latencies immediately, and higher ones slowly
+        self.baseline_drift = baseline_drift
+        self.clock = clock
+
+        self.limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self.in_flight = 0
+        self.baseline_sec: Optional[float] = None
+
+        self._latencies: List[float] = []
+        self._overloaded = False
+        self._max_in_flight = 0
+        self._slots = Condition()
+
+        self.logger = logging.getLogger(__name__)
+        self._publish()
+
+    def call(self, fn: Callable[[], Any]) -> Any:
+        self._acquire()
+        start = self.clock()
+        try:
+            result = fn()
+        except Exception as e:
+            self._release(self.clock() - start, is_overload(error=e))
+            raise
+        self._release(self.clock() - start, is_overload(response=result))
+        return result
+
+    def _acquire(self):
+        with self._slots:
+            self._slots.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+            self._max_in_flight = max(self._max_in_flight, self.in_flight)
+
+    def _release(self, latency_sec: float, overloaded: bool):
+        with self._slots:
+            self.in_flight -= 1
+            self._latencies.append(latency_sec)
+            self._overloaded = self._overloaded or overloaded
+            if overloaded or len(self._latencies) >= self.window_size:
+                self._adjust()
+            self._slots.notify_all()
+
+    def _adjust(self):
+        latencies = sorted(self._latencies)
+        p95_sec = latencies[max(0, math.ceil(len(latencies) * 0.95) - 1)]
+        busy = self._max_in_flight >= int(self.limit)
+        previous_limit = self.limit
+
+        if self._overloaded or (self.baseline_sec is not None and p95_sec > self.baseline_sec * self.latency_tolerance):
+            self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+        elif busy:
+            self.limit = min(self.max_limit, self.limit + 1)
+
+        if not self._overloaded:
+            self.baseline_sec = p95_sec if self.baseline_sec is None else \
+                min(p95_sec, self.baseline_sec * (1 + self.baseline_drift))
+
+        if int(self.limit) != int(previous_limit):
+            self.logger.debug(f'{self.name} concurrency limit {int(previous_limit)} -> {int(self.limit)} '
+                              f'(p95 {p95_sec:.3f}s, overloaded: {self._overloaded})')
+        self._latencies = []
+        self._overloaded = False
+        self._max_in_flight = self.in_flight
+        self._publish()
+
+    def _publish(self):
+        metrics.registry.set_gauge('concurrency_limit', int(self.limit), {"service": self.name})
+
+
+def limited(limiter: Optional[AdaptiveLimiter], fn: Callable[[], Any]) -> Any:
+    return limiter.call(fn) if limiter is not None else fn()
@@ -1,11 +1,16 @@
+import logging
 import re
+from concurrent.futures import Future, ThreadPoolExecutor
 from copy import deepcopy
-from typing import List, Dict, Optional
+from typing import List, Dict, Iterator, Optional, Tuple
 from dataclasses import dataclass
 
 from ingest.api.ingestapi import IngestApi
+import requests
 
-from exporter import utils
+from exporter import utils, metrics
+from exporter.limiter import AdaptiveLimiter, limited
+from exporter.singleflight import SingleFlight
 
 
 class MetadataParseException(Exception):
@@ -82,37 +87,137 @@ class MetadataResource:
 
 
 class MetadataService:
+    # fields read by the exporter beyond those MetadataResource parses, which a projection must keep
+    PROJECTED_FIELDS = {
+        'files': ['dataFileUuid', 'fileName', 'cloudUrl', 'fileContentType', 'size', 'checksums']
+    }
 
-    def __init__(self, ingest_client: IngestApi):
+    def __init__(self, ingest_client: IngestApi, limiter: Optional[AdaptiveLimiter] = None,
+                 page_size: Optional[int] = None, projection: Optional[str] = None):
         self.ingest_client = ingest_client
+        self.limiter = limiter
+        # asked of ingest-core for relation pages, until it rejects them or leaves out fields the exporter needs
+        self.relation_params = dict((k, v) for k, v in [('size', page_size), ('projection', projection)] if v)
+        self.logger = logging.getLogger(__name__)
+        # concurrent exports often ask for the same resources at the same time
+        self.single_flight = SingleFlight()
+        # fetches the next page of a relation while the current one is being processed
+        self.page_prefetcher = ThreadPoolExecutor(max_workers=8, thread_name_prefix='page-prefetch')
 
     def fetch_resource(self, resource_link: str) -> MetadataResource:
-        raw_metadata = self.ingest_client.get_entity_by_callback_link(resource_link)
+        raw_metadata = self._coalesced(('resource', resource_link),
+                                       lambda: limited(self.limiter, lambda: self.ingest_client.get_entity_by_callback_link(resource_link)))
         return MetadataResource.from_dict(raw_metadata)
 
     def get_derived_by_processes(self, experiment_material: MetadataResource) -> List[MetadataResource]:
-        return MetadataService.parse_metadata_resources(self.ingest_client.get_related_entities('derivedByProcesses', experiment_material.full_resource, 'processes'))
+        return self.get_related('derivedByProcesses', experiment_material, 'processes')
 
     def get_input_to_processes(self, experiment_material: MetadataResource) -> List[MetadataResource]:
-        return MetadataService.parse_metadata_resources(self.ingest_client.get_related_entities('inputToProcesses', experiment_material.full_resource, 'processes'))
+        return self.get_related('inputToProcesses', experiment_material, 'processes')
 
     def get_derived_biomaterials(self, process: MetadataResource) -> List[MetadataResource]:
-        return MetadataService.parse_metadata_resources(self.ingest_client.get_related_entities('derivedBiomaterials', process.full_resource, 'biomaterials'))
+        return self.get_related('derivedBiomaterials', process, 'biomaterials')
 
     def get_derived_files(self, process: MetadataResource) -> List[MetadataResource]:
-        return MetadataService.parse_metadata_resources(self.ingest_client.get_related_entities('derivedFiles', process.full_resource, 'files'))
+        return self.get_related('derivedFiles', process, 'files')
 
     def get_input_biomaterials(self, process: MetadataResource) -> List[MetadataResource]:
-        return MetadataService.parse_metadata_resources(self.ingest_client.get_related_entities('inputBiomaterials', process.full_resource, 'biomaterials'))
+        return self.get_related('inputBiomaterials', process, 'biomaterials')
 
     def get_input_files(self, process: MetadataResource) -> List[MetadataResource]:
-        return MetadataService.parse_metadata_resources(self.ingest_client.get_related_entities('inputFiles', process.full_resource, 'files'))
+        return self.get_related('inputFiles', process, 'files')
 
     def get_protocols(self, process: MetadataResource) -> List[MetadataResource]:
-        return MetadataService.parse_metadata_resources(self.ingest_client.get_related_entities('protocols', process.full_resource, 'protocols'))
+        return self.get_related('protocols', process, 'protocols')
 
     def get_supplementary_files(self, metadata: MetadataResource) -> List[MetadataResource]:
-        return MetadataService.parse_metadata_resources(self.ingest_client.get_related_entities('supplementaryFiles', metadata.full_resource, 'files'))
+        return self.get_related('supplementaryFiles', metadata, 'files')
+
+    def get_related(self, relation: str, metadata: MetadataResource, entity_type: str) -> List[MetadataResource]:
+        relation_link = metadata.full_resource.get('_links', {}).get(relation, {}).get('href')
+        if relation_link is None:
+            return []
+        related = self._coalesced(('related', relation_link), lambda: self._fetch_related(relation_link, entity_type))
+        # callers sharing a result each get their own list
+        return list(related)
+
+    def iter_related(self, relation: str, metadata: MetadataResource, entity_type: str) -> Iterator[List[MetadataResource]]:
+        """
+        Yields the pages of a relation as they arrive. Unlike get_related, concurrent callers are not coalesced.
+        """
+        relation_link = metadata.full_resource.get('_links', {}).get(relation, {}).get('href')
+        if relation_link is not None:
+            yield from self._related_pages(relation_link, entity_type)
+
+    def _fetch_related(self, relation_link: str, entity_type: str) -> List[MetadataResource]:
+        return [related for page in self._related_pages(relation_link, entity_type) for related in page]
+
+    def _related_pages(self, relation_link: str, entity_type: str) -> Iterator[List[MetadataResource]]:
+        """
+        Parsed pages of a relation, each page being fetched while the one before it is parsed and consumed
+        """
+        page, related = self._first_page(relation_link, entity_type)
+        next_page = self._prefetch_next(page)
+        yield related
+        while next_page is not None:
+            page = next_page.result()
+            next_page = self._prefetch_next(page)
+            yield self._parse_page(page, entity_type)
+
+    def _prefetch_next(self, page: Dict) -> Optional[Future]:
+        # next links carry the size and projection of the first page
+        next_link = page.get('_links', {}).get('next', {}).get('href')
+        return self.page_prefetcher.submit(self._fetch_page, next_link) if next_link else None
+
+    def _first_page(self, url: str, entity_type: str) -> Tuple[Dict, List[MetadataResource]]:
+        params = self.relation_params
+        if params:
+            try:
+                page = self._fetch_page(url, params)
+                self._check_projected_page(page, entity_type)
+                return page, self._parse_page(page, entity_type)
+            except (requests.HTTPError, MetadataParseException) as e:
+                if isinstance(e, requests.HTTPError) and not self._is_client_error(e):
+                    raise
+                self.logger.warning(f'Relation pages with {params} are not supported by ingest, '
+                                    f'falling back to full pages: {e}')
+                self.relation_params = dict()
+        page = self._fetch_page(url)
+        return page, self._parse_page(page, entity_type)
+
+    def _fetch_page(self, url: str, params: Optional[Dict] = None) -> Dict:
+        def fetch():
+            r = self.ingest_client.get(url, params=params, headers=self.ingest_client.get_headers())
+            r.raise_for_status()
+            return r
+
+        return limited(self.limiter, fetch).json()
+
+    @staticmethod
+    def _parse_page(page: Dict, entity_type: str) -> List[MetadataResource]:
+        return [MetadataResource.from_dict(entity) for entity in page.get('_embedded', {}).get(entity_type, [])]
+
+    def _check_projected_page(self, page: Dict, entity_type: str):
+        """
+        Raises a MetadataParseException if an entity of the page lacks its links, which the crawl follows, or a field
+        the exporter reads
+        """
+        for entity in page.get('_embedded', {}).get(entity_type, []):
+            missing = [field for field in self.PROJECTED_FIELDS.get(entity_type, []) if field not in entity]
+            if not entity.get('_links'):
+                missing.append('_links')
+            if missing:
+                raise MetadataParseException(f'Projected {entity_type} are missing {missing}')
+
+    @staticmethod
+    def _is_client_error(e: requests.HTTPError) -> bool:
+        return e.response is not None and 400 <= e.response.status_code < 500 and e.response.status_code != 429
+
+    def _coalesced(self, key, fetch):
+        result, shared = self.single_flight.do(key, fetch)
+        if shared:
+            metrics.inc('ingest_requests_coalesced_total')
+        return result
 
     @staticmethod
     def parse_metadata_resources(metadata_resources: List[Dict]) -> List[MetadataResource]:
@@ -155,6 +260,13 @@ class DataFile:
     def source_key(self) -> str:
         return self.cloud_url.split("//")[1].split("/", 1)[1]
 
+    @staticmethod
+    def uuid_from_file_metadata(file_metadata: MetadataResource) -> str:
+        try:
+            return file_metadata.full_resource["dataFileUuid"]
+        except (KeyError, TypeError) as e:
+            raise MetadataParseException(e)
+
     @staticmethod
     def from_file_metadata(file_metadata: MetadataResource) -> 'DataFile':
         if file_metadata.full_resource is not None:
@@ -0,0 +1,239 @@
+"""
+Lightweight, dependency-free instrumentation for the export pipelines.
+
+Stage timings are recorded with `span`, and calls to ingest-core and GCS with `inc`. Both are aggregated in a
+process-wide MetricsRegistry, which can be exposed in the Prometheus text format by a MetricsServer. Messages can
+additionally be wrapped in a `message_trace`, which collects the spans recorded on the handling thread and logs
+them as a single structured line when the message completes.
+"""
+import json
+import logging
+import re
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread, local
+from typing import Dict, Optional, Tuple, List, Iterator
+from urllib.parse import urlparse
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 600, 1800, 3600)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Optional[Dict[str, str]]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in (labels or {}).items()))
+
+
+class _Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.bucket_counts[i] += 1
+
+
+class MessageTrace:
+    def __init__(self, tags: Dict[str, str]):
+        self.tags = tags
+        self.start = time.perf_counter()
+        self.spans: Dict[str, List[float]] = dict()
+
+    def record(self, name: str, duration_sec: float):
+        span = self.spans.setdefault(name, [0, 0.0])
+        span[0] += 1
+        span[1] += duration_sec
+
+    def to_dict(self) -> Dict:
+        return dict(self.tags,
+                    total_sec=round(time.perf_counter() - self.start, 6),
+                    spans=dict((name, {"count": count, "total_sec": round(total_sec, 6)})
+                               for name, (count, total_sec) in self.spans.items()))
+
+
+class MetricsRegistry:
+
+    def __init__(self, namespace: str = 'exporter'):
+        self.namespace = namespace
+        self.trace_logging_enabled = False
+
+        self.counters: Dict[str, Dict[Labels, float]] = dict()
+        self.gauges: Dict[str, Dict[Labels, float]] = dict()
+        self.histograms: Dict[str, Dict[Labels, _Histogram]] = dict()
+        self._lock = Lock()
+        self._local = local()
+
+        self.logger = logging.getLogger(__name__)
+
+    def inc(self, name: str, labels: Optional[Dict[str, str]] = None, value: float = 1):
+        with self._lock:
+            series = self.counters.setdefault(name, dict())
+            key = _labels(labels)
+            series[key] = series.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, labels: Optional[Dict[str, str]] = None):
+        with self._lock:
+            self.gauges.setdefault(name, dict())[_labels(labels)] = value
+
+    def observe(self, name: str, value: float, labels: Optional[Dict[str, str]] = None,
+                buckets: Tuple[float, ...] = DURATION_BUCKETS):
+        with self._lock:
+            series = self.histograms.setdefault(name, dict())
+            key = _labels(labels)
+            if key not in series:
+                series[key] = _Histogram(buckets)
+            series[key].observe(value)
+
+    def counter_value(self, name: str, labels: Optional[Dict[str, str]] = None) -> float:
+        with self._lock:
+            return self.counters.get(name, {}).get(_labels(labels), 0)
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration_sec = time.perf_counter() - start
+            self.observe('stage_duration_seconds', duration_sec, {"stage": name})
+            trace = self.current_trace()
+            if trace is not None:
+                trace.record(name, duration_sec)
+
+    @contextmanager
+    def message_trace(self, pipeline: str, **tags) -> Iterator[MessageTrace]:
+        trace = MessageTrace(dict(tags, pipeline=pipeline))
+        self._local.trace = trace
+        outcome = 'failure'
+        try:
+            yield trace
+            outcome = 'success'
+        finally:
+            self._local.trace = None
+            duration_sec = time.perf_counter() - trace.start
+            self.observe('message_duration_seconds', duration_sec, {"pipeline": pipeline, "outcome": outcome})
+            self.inc('messages_total', {"pipeline": pipeline, "outcome": outcome})
+            if self.trace_logging_enabled:
+                self.logger.info(f'Message trace: {json.dumps(dict(trace.to_dict(), outcome=outcome))}')
+
+    def current_trace(self) -> Optional[MessageTrace]:
+        return getattr(self._local, 'trace', None)
+
+    def exposition(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f'# TYPE {self.namespace}_{name} counter')
+                lines.extend(f'{self.namespace}_{name}{_format_labels(labels)} {value}' for labels, value in series.items())
+            for name, series in sorted(self.gauges.items()):
+                lines.append(f'# TYPE {self.namespace}_{name} gauge')
+                lines.extend(f'{self.namespace}_{name}{_format_labels(labels)} {value}' for labels, value in series.items())
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f'# TYPE {self.namespace}_{name} histogram')
+                for labels, histogram in series.items():
+                    for upper_bound, count in zip(histogram.buckets, histogram.bucket_counts):
+                        lines.append(f'{self.namespace}_{name}_bucket{_format_labels(labels + (("le", str(upper_bound)),))} {count}')
+                    lines.append(f'{self.namespace}_{name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {histogram.count}')
+                    lines.append(f'{self.namespace}_{name}_sum{_format_labels(labels)} {histogram.sum}')
+                    lines.append(f'{self.namespace}_{name}_count{_format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    escaped = [(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+_ID_SEGMENT = re.compile(r'^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|[0-9a-f]{24}|\d+)$')
+
+
+def endpoint_for_url(method: str, url: str) -> str:
+    """
+    Normalises a request URL into an endpoint label, replacing uuids and document ids with `{id}` so that the number
+    of label values stays bounded, e.g. `GET /processes/{id}/derivedFiles`
+    """
+    path = urlparse(url).path
+    segments = ['{id}' if _ID_SEGMENT.match(segment) else segment for segment in path.split('/')]
+    return f'{method} {"/".join(segments) or "/"}'
+
+
+registry = MetricsRegistry()
+
+
+def inc(name: str, labels: Optional[Dict[str, str]] = None, value: float = 1):
+    registry.inc(name, labels, value)
+
+
+def span(name: str):
+    return registry.span(name)
+
+
+def message_trace(pipeline: str, **tags):
+    return registry.message_trace(pipeline, **tags)
+
+
+def http_response_hook(service: str):
+    def count_response(response, *args, **kwargs):
+        registry.inc('http_requests_total', {"service": service,
+                                             "endpoint": endpoint_for_url(response.request.method, response.url),
+                                             "status": str(response.status_code)})
+        return response
+
+    return count_response
+
+
+def instrument_session(session, service: str):
+    """
+    Counts every HTTP request made through a requests.Session, per endpoint and response status
+    """
+    session.hooks['response'].append(http_response_hook(service))
+    return session
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer:
+
+    def __init__(self, port: int, metrics_registry: MetricsRegistry = registry):
+        self.port = port
+        self.metrics_registry = metrics_registry
+        self.server: Optional[_ThreadingHTTPServer] = None
+
+    def start(self) -> 'MetricsServer':
+        metrics_registry = self.metrics_registry
+
+        class _MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics_registry.exposition().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = _ThreadingHTTPServer(('', self.port), _MetricsHandler)
+        Thread(target=self.server.serve_forever, name='metrics-server', daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
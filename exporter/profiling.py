@@ -0,0 +1,120 @@
+"""
+Opt-in sampling profiler for slow export messages.
+
+A single background thread samples the stacks of the threads currently handling profiled messages, at a fixed
+interval, using `sys._current_frames`. When a message takes longer than the configured threshold its samples are
+written to a local directory in the collapsed ("folded") stack format understood by flamegraph.pl and speedscope.
+"""
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock, Thread, Event, get_ident
+from typing import Dict, Optional, Iterator
+
+
+class ProfileSession:
+    def __init__(self, thread_id: int):
+        self.thread_id = thread_id
+        self.start = time.perf_counter()
+        self.samples = Counter()
+
+    def add_sample(self, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        self.samples[';'.join(reversed(stack))] += 1
+
+    def collapsed(self) -> str:
+        return ''.join(f'{stack} {count}\n' for stack, count in self.samples.most_common())
+
+
+class StackSampler:
+
+    def __init__(self, interval_sec: float = 0.01):
+        self.interval_sec = interval_sec
+        self._sessions: Dict[int, ProfileSession] = dict()
+        self._lock = Lock()
+        self._sessions_active = Event()
+        self._sampler_thread: Optional[Thread] = None
+
+    def start_session(self, thread_id: Optional[int] = None) -> ProfileSession:
+        session = ProfileSession(thread_id if thread_id is not None else get_ident())
+        with self._lock:
+            self._sessions[session.thread_id] = session
+            self._sessions_active.set()
+            if self._sampler_thread is None or not self._sampler_thread.is_alive():
+                self._sampler_thread = Thread(target=self._run, name='stack-sampler', daemon=True)
+                self._sampler_thread.start()
+        return session
+
+    def stop_session(self, session: ProfileSession):
+        with self._lock:
+            if self._sessions.get(session.thread_id) is session:
+                del self._sessions[session.thread_id]
+            if not self._sessions:
+                self._sessions_active.clear()
+
+    def sample(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+        frames = sys._current_frames()
+        for session in sessions:
+            frame = frames.get(session.thread_id)
+            if frame is not None:
+                session.add_sample(frame)
+
+    def _run(self):
+        while True:
+            self._sessions_active.wait()
+            self.sample()
+            time.sleep(self.interval_sec)
+
+
+class SlowMessageProfiler:
+    """
+    Profiles the handling of a message and keeps the profile only if handling took at least `threshold_sec`.
+    Profiling is disabled when no `output_dir` is given.
+    """
+
+    def __init__(self, output_dir: Optional[str], threshold_sec: float = 60, sampler: Optional[StackSampler] = None):
+        self.output_dir = Path(output_dir) if output_dir else None
+        self.threshold_sec = threshold_sec
+        self.sampler = sampler if sampler is not None else StackSampler()
+
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def enabled(self) -> bool:
+        return self.output_dir is not None
+
+    @contextmanager
+    def profile(self, pipeline: str, process_uuid: str, submission_uuid: str) -> Iterator[Optional[ProfileSession]]:
+        if not self.enabled:
+            yield None
+            return
+
+        session = self.sampler.start_session()
+        try:
+            yield session
+        finally:
+            self.sampler.stop_session(session)
+            elapsed_sec = time.perf_counter() - session.start
+            if elapsed_sec >= self.threshold_sec:
+                self._dump(session, pipeline, process_uuid, submission_uuid, elapsed_sec)
+
+    def _dump(self, session: ProfileSession, pipeline: str, process_uuid: str, submission_uuid: str, elapsed_sec: float):
+        try:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            timestamp = time.strftime('%Y%m%dT%H%M%S')
+            profile_path = self.output_dir / f'{pipeline}_{submission_uuid}_{process_uuid}_{timestamp}.folded'
+            profile_path.write_text(session.collapsed())
+            self.logger.info(f'Message for process {process_uuid} (submission {submission_uuid}) took '
+                             f'{elapsed_sec:.1f} seconds, wrote profile to {profile_path}')
+        except OSError as e:
+            self.logger.warning(f'Failed to write profile for process {process_uuid}: {str(e)}')
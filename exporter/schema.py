@@ -1,7 +1,10 @@
-from ingest.api.ingestapi import IngestApi
-from typing import Optional, Callable
+import logging
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from threading import Lock
 
-from cachetools.func import ttl_cache
+from ingest.api.ingestapi import IngestApi
+from typing import Optional, Callable, Dict, List
 
 
 class SchemaParseException(Exception):
@@ -25,33 +28,92 @@ class SchemaResource:
 
 
 class SchemaService:
+    """
+    Keeps the latest schemas in memory, indexed by their URL, i.e. the `describedBy` of documents, and the system
+    schemas (links, file_descriptor, ...) also by concrete entity. All of them are loaded with one request, ahead of
+    the first export when `prefetch` is called at startup.
+
+    Once the schemas are older than `refresh_ahead` of the ttl, lookups trigger a refresh in the background and
+    carry on with the schemas they have, so they only ever wait for the very first load.
+    """
 
-    def __init__(self, ingest_client: IngestApi, ttl: Optional[int] = None):
+    def __init__(self, ingest_client: IngestApi, ttl: Optional[int] = None, refresh_ahead: float = 0.8,
+                 executor: Optional[Executor] = None, clock: Callable[[], float] = time.monotonic):
         self.ingest_client = ingest_client
         self.ttl = ttl if ttl is not None else 300
+        self.refresh_ahead = refresh_ahead
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max_workers=1)
+        self.clock = clock
+
+        self._by_entity: Dict[str, SchemaResource] = dict()
+        self._by_url: Dict[str, SchemaResource] = dict()
+        self._loaded_at: Optional[float] = None
+        self._refreshing = False
+        self._lock = Lock()
+        self._load_lock = Lock()
+
+        self.logger = logging.getLogger(__name__)
+
+    def prefetch(self) -> 'SchemaService':
+        try:
+            self._load()
+        except Exception as e:
+            self.logger.warning(f'Failed to prefetch schemas, they will be loaded on first use: {str(e)}')
+        return self
+
+    def cached_latest_links_schema(self) -> SchemaResource:
+        return self._cached('links')
+
+    def cached_latest_file_descriptor_schema(self) -> SchemaResource:
+        return self._cached('file_descriptor')
 
-        self.cached_latest_links_schema = ttl_cache(ttl=self.ttl)(self.latest_links_schema)
-        self.cached_latest_file_descriptor_schema = ttl_cache(ttl=self.ttl)(self.latest_file_descriptor_schema)
+    def schema_for_url(self, described_by: str) -> Optional[SchemaResource]:
+        self._ensure_loaded()
+        return self._by_url.get(described_by)
 
-    def latest_links_schema(self) -> SchemaResource:
-        latest_schema = self.ingest_client.get_schemas(
-            latest_only=True,
-            high_level_entity="system",
-            domain_entity="",
-            concrete_entity="links"
-        )[0]
+    def schema_urls(self) -> List[str]:
+        self._ensure_loaded()
+        return list(self._by_url.keys())
 
-        return SchemaResource.from_dict(latest_schema)
+    def _cached(self, concrete_entity: str) -> SchemaResource:
+        self._ensure_loaded()
+        schema = self._by_entity.get(concrete_entity)
+        if schema is None:
+            raise SchemaParseException(f'Failed to find latest {concrete_entity} schema')
+        return schema
 
-    def latest_file_descriptor_schema(self) -> SchemaResource:
+    def _ensure_loaded(self):
+        if self._loaded_at is None:
+            with self._load_lock:
+                if self._loaded_at is None:
+                    self._load()
+            return
+
+        with self._lock:
+            if self._refreshing or self.clock() - self._loaded_at < self.ttl * self.refresh_ahead:
+                return
+            self._refreshing = True
+        self.executor.submit(self._refresh)
+
+    def _refresh(self):
         try:
-            latest_schema = self.ingest_client.get_schemas(
-                latest_only=True,
-                high_level_entity="system",
-                domain_entity="",
-                concrete_entity="file_descriptor"
-            )[0]
-
-            return SchemaResource.from_dict(latest_schema)
-        except IndexError as e:
-            raise SchemaParseException(f'Failed to find latest file_descriptor schema')
+            self._load()
+        except Exception as e:
+            self.logger.warning(f'Failed to refresh schemas, keeping schemas loaded '
+                                f'{self.clock() - self._loaded_at:.0f}s ago: {str(e)}')
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _load(self):
+        # ingest lists every latest schema in one response, whatever the entity filters
+        schemas = self.ingest_client.get_schemas(latest_only=True)
+        by_entity, by_url = dict(), dict()
+        for data in schemas:
+            schema = SchemaResource.from_dict(data)
+            by_url[schema.schema_url] = schema
+            if data.get("highLevelEntity") == "system" and data.get("concreteEntity"):
+                by_entity[data["concreteEntity"]] = schema
+        # swapped whole, so lookups see either the old or the new schemas
+        self._by_entity, self._by_url = by_entity, by_url
+        self._loaded_at = self.clock()
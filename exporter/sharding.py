@@ -0,0 +1,110 @@
+import hashlib
+import json
+import logging
+import re
+from bisect import bisect
+from dataclasses import replace
+from typing import List, Optional, Type
+
+from kombu import Connection, Consumer, Exchange, Message, Queue
+from kombu.mixins import ConsumerProducerMixin
+
+from exporter import metrics
+from exporter.amqp import AmqpConnConfig, QueueConfig
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Consistent hashing of keys to shards. Each shard owns `vnodes` points on the ring, and a key belongs to the shard
+    owning the first point at or after the key's hash, so changing the number of shards only moves the keys of the
+    shards added or removed.
+    """
+
+    def __init__(self, shard_count: int, vnodes: int = 64):
+        if shard_count < 1:
+            raise ValueError(f'shard_count must be at least 1, got {shard_count}')
+        self.shard_count = shard_count
+        points = sorted((_hash(f'shard-{shard}-{vnode}'), shard)
+                        for shard in range(shard_count) for vnode in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard_for(self, key: str) -> int:
+        return self._shards[bisect(self._hashes, _hash(key)) % len(self._hashes)]
+
+
+def shard_queue_config(queue_config: QueueConfig, shard: int) -> QueueConfig:
+    return replace(queue_config,
+                   name=f'{queue_config.name}.shard-{shard}',
+                   routing_key=f'{queue_config.routing_key}.shard-{shard}')
+
+
+def shard_index_from_hostname(hostname: str) -> Optional[int]:
+    """
+    The ordinal of a StatefulSet pod, e.g. 2 for ingest-exporter-2
+    """
+    match = re.search(r'-(\d+)$', hostname or '')
+    return int(match.group(1)) if match else None
+
+
+def _queue(queue_config: QueueConfig) -> Queue:
+    return Queue(queue_config.name, Exchange(queue_config.exchange, queue_config.exchange_type),
+                 queue_config.routing_key)
+
+
+class _ShardRouter(ConsumerProducerMixin):
+
+    def __init__(self, connection: Connection, ring: HashRing, queue_config: QueueConfig, prefetch_count: int = 50):
+        self.connection = connection
+        self.ring = ring
+        self.queue_config = queue_config
+        self.prefetch_count = prefetch_count
+        self.shard_queues = [_queue(shard_queue_config(queue_config, shard)) for shard in range(ring.shard_count)]
+
+        self.logger = logging.getLogger(__name__)
+
+    def get_consumers(self, _consumer: Type[Consumer], channel) -> List[Consumer]:
+        return [_consumer([_queue(self.queue_config)], callbacks=[self.route], prefetch_count=self.prefetch_count)]
+
+    def route(self, body: str, msg: Message):
+        try:
+            submission_uuid = json.loads(body)["envelopeUuid"]
+        except (ValueError, KeyError, TypeError) as e:
+            self.logger.error(f'Failed to route message with body: {body} due to error: {str(e)}')
+            msg.reject(requeue=False)
+            return
+
+        shard = self.ring.shard_for(submission_uuid)
+        shard_queue = self.shard_queues[shard]
+        # the original payload is passed on untouched, so the shard's consumer sees the same message
+        self.producer.publish(msg.body,
+                              content_type=msg.content_type,
+                              content_encoding=msg.content_encoding,
+                              headers=msg.headers,
+                              exchange=self.queue_config.exchange,
+                              routing_key=shard_queue.routing_key,
+                              declare=[shard_queue],
+                              retry=True)
+        msg.ack()
+        metrics.inc('messages_routed_total', {"shard": str(shard)})
+
+
+class ShardRouter:
+    """
+    Moves messages from the shared queue to per-shard queues, by consistent hash of their submission, so that every
+    message of a submission is handled by the same replica. Every replica runs a router, competing for the shared
+    queue, and consumes only the queue of its own shard.
+    """
+
+    def __init__(self, amqp_conn_config: AmqpConnConfig, ring: HashRing, queue_config: QueueConfig):
+        self.amqp_conn_config = amqp_conn_config
+        self.ring = ring
+        self.queue_config = queue_config
+
+    def run(self):
+        with Connection(self.amqp_conn_config.broker_url()) as conn:
+            _ShardRouter(conn, self.ring, self.queue_config).run()
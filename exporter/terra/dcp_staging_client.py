@@ -1,12 +1,20 @@
 from ingest.api.ingestapi import IngestApi
-from exporter import utils
+from exporter import utils, metrics
 from exporter.metadata import MetadataResource, DataFile, FileChecksums
 from exporter.graph.experiment_graph import LinkSet
+from exporter.graph.link_index import LinkIndex
+from exporter.limiter import AdaptiveLimiter
 from exporter.schema import SchemaService
 from exporter.terra.gcs import GcsXferStorage, GcsStorage, Streamable, TransferJobSpec
-from typing import Iterable, Dict, Tuple, Callable
+from exporter.terra.serialization import DocumentRenderer, NodePayload, RenderedNode
+from exporter.terra.transfer_poller import TransferStatusPoller, TokenBucket
+from exporter.terra.validation import DocumentValidationException, DocumentValidator
+from typing import Iterable, Dict, List, Tuple, Callable, Optional, Hashable
 
-from io import StringIO
+from io import BytesIO, StringIO
+from threading import Event, Lock
+
+from cachetools import LRUCache
 
 from google.cloud import storage
 from google.oauth2.service_account import Credentials
@@ -53,13 +61,77 @@ class DcpStagingException(Exception):
     pass
 
 
+class _StagingEntry:
+    def __init__(self):
+        self.done = Event()
+        self.succeeded = False
+
+
+class StagedObjectRegistry:
+    """
+    Remembers which objects have been staged, or are being staged, by this exporter instance. The first caller to
+    stage a key writes it; concurrent callers wait for that write instead of racing it, and later callers skip it.
+    If the write fails, the key is forgotten and the next caller writes it again.
+    """
+
+    def __init__(self, wait_timeout_sec: float = 60 * 60):
+        self.wait_timeout_sec = wait_timeout_sec
+        self._entries: Dict[Hashable, _StagingEntry] = dict()
+        self._lock = Lock()
+
+    def __contains__(self, key: Hashable):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry.succeeded
+
+    def stage(self, key: Hashable, write: Callable[[], None]) -> bool:
+        """
+        :return: True if this call wrote the object, False if it had already been staged
+        """
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                is_writer = entry is None
+                if is_writer:
+                    entry = self._entries[key] = _StagingEntry()
+
+            if is_writer:
+                try:
+                    write()
+                    entry.succeeded = True
+                    return True
+                except Exception:
+                    with self._lock:
+                        del self._entries[key]
+                    raise
+                finally:
+                    entry.done.set()
+
+            if not entry.done.wait(self.wait_timeout_sec):
+                raise DcpStagingException(f'Timed out waiting for {key} to be staged')
+            if entry.succeeded:
+                return False
+
+
 class DcpStagingClient:
 
-    def __init__(self, gcs_storage: GcsStorage, gcs_xfer: GcsXferStorage, schema_service: SchemaService, ingest_client: IngestApi):
+    def __init__(self, gcs_storage: GcsStorage, gcs_xfer: GcsXferStorage, schema_service: SchemaService, ingest_client: IngestApi,
+                 staged_projects_cache_size: int = 32, renderer: Optional[DocumentRenderer] = None,
+                 validator: Optional[DocumentValidator] = None):
         self.gcs_storage = gcs_storage
         self.gcs_xfer = gcs_xfer
         self.schema_service = schema_service
         self.ingest_client = ingest_client
+        # StagedObjectRegistry by project uuid, for the projects most recently exported
+        self.staged_objects = LRUCache(maxsize=staged_projects_cache_size)
+        self._staged_objects_lock = Lock()
+        # when set, metadata documents and file descriptors are rendered by it, e.g. on a pool of processes
+        self.renderer = renderer
+        # when set, documents are validated before they are uploaded; metadata documents and file descriptors by
+        # the renderer, which must then be created with validation
+        self.validator = validator
+        if self.renderer is None and validator is not None:
+            self.renderer = DocumentRenderer(validator)
 
     def transfer_data_files(self, submission: Dict, project_uuid, export_job_id: str) -> (TransferJobSpec, bool):
         upload_area = submission["stagingDetails"]["stagingAreaLocation"]["value"]
@@ -67,22 +139,60 @@ class DcpStagingClient:
         transfer_job_spec, success = self.gcs_xfer.transfer_upload_area(bucket_and_key[0], bucket_and_key[1], project_uuid, export_job_id)
         return transfer_job_spec, success
 
-    def wait_for_transfer_to_complete(self, job_name: str, compute_wait_time_sec:Callable, start_wait_time_sec: int, max_wait_time_sec: int):
-        self.gcs_xfer.wait_for_job_to_complete(job_name, compute_wait_time_sec, start_wait_time_sec, max_wait_time_sec)
+    def wait_for_transfer_to_complete(self, job_name: str, max_wait_time_sec: int):
+        self.gcs_xfer.wait_for_job_to_complete(job_name, max_wait_time_sec)
 
     def write_metadatas(self, metadatas: Iterable[MetadataResource], project_uuid: str):
-        for metadata in metadatas:
-            self.write_metadata(metadata, project_uuid)
+        if self.renderer is None:
+            for metadata in metadatas:
+                self.write_metadata(metadata, project_uuid)
+            return
+
+        staged_objects = self.staged_objects_for(project_uuid)
+        metadatas = list(metadatas)
+        pending = [metadata for metadata in metadatas if self.staged_key(metadata) not in staged_objects]
+        if len(pending) < len(metadatas):
+            metrics.inc('staging_writes_deduplicated_total', value=len(metadatas) - len(pending))
+
+        if self.renderer.validates:
+            # nothing of an assay is uploaded if any of its documents is invalid
+            with metrics.span('validate'):
+                self._raise_for_errors(self.renderer.errors(self.node_payload(metadata, project_uuid)
+                                                            for metadata in pending))
+        # documents are uploaded as they are rendered, rather than all held in memory first
+        rendered_nodes = self.renderer.render(self.node_payload(metadata, project_uuid) for metadata in pending)
+        for metadata, rendered_node in zip(pending, rendered_nodes):
+            if not staged_objects.stage(self.staged_key(metadata), lambda: self._write_rendered(rendered_node)):
+                metrics.inc('staging_writes_deduplicated_total')
 
     def write_metadata(self, metadata: MetadataResource, project_uuid: str):
+        # Donors, specimens, protocols and the project are shared by many assays of a project, so are only
+        # written by the first assay to reach them
+        if not self.staged_objects_for(project_uuid).stage(self.staged_key(metadata), lambda: self._write_metadata(metadata, project_uuid)):
+            metrics.inc('staging_writes_deduplicated_total')
+
+    @staticmethod
+    def staged_key(metadata: MetadataResource) -> Tuple[str, str, str]:
+        return metadata.concrete_type(), metadata.uuid, metadata.dcp_version
+
+    def staged_objects_for(self, project_uuid: str) -> StagedObjectRegistry:
+        with self._staged_objects_lock:
+            registry = self.staged_objects.get(project_uuid)
+            if registry is None:
+                registry = self.staged_objects[project_uuid] = StagedObjectRegistry()
+            return registry
+
+    def _write_metadata(self, metadata: MetadataResource, project_uuid: str):
 
         # TODO1: only proceed if lastContentModified > last
 
-        dest_object_key = f'{project_uuid}/metadata/{metadata.concrete_type()}/{metadata.uuid}_{metadata.dcp_version}.json'
+        dest_object_key = self.metadata_object_key(metadata, project_uuid)
 
-        metadata_json = metadata.get_content(with_provenance=True)
-        data_stream = DcpStagingClient.dict_to_json_stream(metadata_json)
-        self.write_to_staging_bucket(dest_object_key, data_stream)
+        with metrics.span('metadata_write'):
+            metadata_json = metadata.get_content(with_provenance=True)
+            self._validate(metadata_json)
+            data_stream = DcpStagingClient.dict_to_json_stream(metadata_json)
+            self.write_to_staging_bucket(dest_object_key, data_stream)
 
         # TODO2: patch dcpVersion        
         #patch_url = metadata.metadata_json['_links']['self']['href']
@@ -91,17 +201,58 @@ class DcpStagingClient:
         if metadata.metadata_type == "file":
             self.write_file_descriptor(metadata, project_uuid)
 
-    def write_links(self, link_set: LinkSet, process_uuid: str, process_version: str, project_uuid: str):
-        dest_object_key = f'{project_uuid}/links/{process_uuid}_{process_version}_{project_uuid}.json'
+    def node_payload(self, metadata: MetadataResource, project_uuid: str) -> NodePayload:
+        payload = NodePayload(self.metadata_object_key(metadata, project_uuid), metadata.full_resource["content"],
+                              metadata.provenance.to_dict())
+        if metadata.metadata_type == "file":
+            payload.descriptor_key = self.file_descriptor_object_key(metadata, project_uuid)
+            payload.descriptor = self.generate_file_desciptor_json(metadata)
+        return payload
+
+    def _write_rendered(self, rendered_node: RenderedNode):
+        with metrics.span('metadata_write'):
+            self.write_to_staging_bucket(rendered_node.object_key, BytesIO(rendered_node.document))
+        if rendered_node.descriptor is not None:
+            with metrics.span('descriptor_write'):
+                self.write_to_staging_bucket(rendered_node.descriptor_key, BytesIO(rendered_node.descriptor))
+
+    @staticmethod
+    def metadata_object_key(metadata: MetadataResource, project_uuid: str) -> str:
+        return f'{project_uuid}/metadata/{metadata.concrete_type()}/{metadata.uuid}_{metadata.dcp_version}.json'
+
+    @staticmethod
+    def file_descriptor_object_key(file_metadata: MetadataResource, project_uuid: str) -> str:
+        return f'{project_uuid}/descriptors/{file_metadata.concrete_type()}/{file_metadata.uuid}_{file_metadata.dcp_version}.json'
+
+    def write_links(self, link_set: LinkSet, process_uuid: str, process_version: str, project_uuid: str,
+                    link_index: Optional[LinkIndex] = None):
+        self.write_links_document(self.links_document(link_set, link_index), process_uuid, process_version, project_uuid)
+
+    def links_document(self, link_set: LinkSet, link_index: Optional[LinkIndex] = None) -> str:
+        """
+        The serialised, validated links document of an assay, which can be built before any of the assay is staged
+        """
+        if link_index is not None:
+            links_document = link_index.links_json(link_set, self.links_document_fields())
+            if self.validator is not None:
+                self._validate(json.loads(links_document))
+            return links_document
         links_json = self.generate_links_json(link_set)
-        data_stream = DcpStagingClient.dict_to_json_stream(links_json)
-        self.write_to_staging_bucket(dest_object_key, data_stream)
+        self._validate(links_json)
+        return json.dumps(links_json)
+
+    def write_links_document(self, links_document: str, process_uuid: str, process_version: str, project_uuid: str):
+        dest_object_key = f'{project_uuid}/links/{process_uuid}_{process_version}_{project_uuid}.json'
+        with metrics.span('links_write'):
+            self.write_to_staging_bucket(dest_object_key, StringIO(links_document))
 
     def write_file_descriptor(self, file_metadata: MetadataResource, project_uuid: str):
-        dest_object_key = f'{project_uuid}/descriptors/{file_metadata.concrete_type()}/{file_metadata.uuid}_{file_metadata.dcp_version}.json'
-        file_descriptor_json = self.generate_file_desciptor_json(file_metadata)
-        data_stream = DcpStagingClient.dict_to_json_stream(file_descriptor_json)
-        self.write_to_staging_bucket(dest_object_key, data_stream)
+        dest_object_key = self.file_descriptor_object_key(file_metadata, project_uuid)
+        with metrics.span('descriptor_write'):
+            file_descriptor_json = self.generate_file_desciptor_json(file_metadata)
+            self._validate(file_descriptor_json)
+            data_stream = DcpStagingClient.dict_to_json_stream(file_descriptor_json)
+            self.write_to_staging_bucket(dest_object_key, data_stream)
 
     def generate_file_desciptor_json(self, file_metadata) -> Dict:
         latest_file_descriptor_schema = self.schema_service.cached_latest_file_descriptor_schema()
@@ -113,19 +264,34 @@ class DcpStagingClient:
 
         return file_descriptor_dict
 
+    def _validate(self, document: Dict):
+        if self.validator is not None:
+            with metrics.span('validate'):
+                self._raise_for_errors(self.validator.errors(document))
+
+    @staticmethod
+    def _raise_for_errors(errors: List[str]):
+        if errors:
+            metrics.inc('staging_validation_errors_total', value=len(errors))
+            raise DocumentValidationException(errors)
+
     def write_to_staging_bucket(self, object_key: str, data_stream: Streamable):
         self.gcs_storage.write(object_key, data_stream)
 
     def generate_links_json(self, link_set: LinkSet) -> Dict:
-        latest_links_schema = self.schema_service.cached_latest_links_schema()
-
         links_json = link_set.to_dict()
-        links_json["describedBy"] = latest_links_schema.schema_url
-        links_json["schema_version"] = latest_links_schema.schema_version
-        links_json["schema_type"] = "links"
+        links_json.update(self.links_document_fields())
 
         return links_json
 
+    def links_document_fields(self) -> Dict:
+        latest_links_schema = self.schema_service.cached_latest_links_schema()
+        return {
+            "describedBy": latest_links_schema.schema_url,
+            "schema_version": latest_links_schema.schema_version,
+            "schema_type": "links"
+        }
+
     @staticmethod
     def dict_to_json_stream(d: Dict) -> StringIO:
         return StringIO(json.dumps(d))
@@ -142,24 +308,42 @@ class DcpStagingClient:
             self.schema_service = None
             self.gcs_storage = None
             self.gcs_xfer = None
+            self.renderer = None
+            self.validator = None
+            self.credentials: Dict[str, Credentials] = dict()
 
         def with_gcs_info(self, service_account_credentials_path: str, gcp_project: str, bucket_name: str,
-                          bucket_prefix: str) -> 'DcpStagingClient.Builder':
-            with open(service_account_credentials_path) as source:
-                info = json.load(source)
-                storage_credentials: Credentials = Credentials.from_service_account_info(info)
-                gcs_client = storage.Client(project=gcp_project, credentials=storage_credentials)
-                self.gcs_storage = GcsStorage(gcs_client, bucket_name, bucket_prefix)
+                          bucket_prefix: str, limiter: Optional[AdaptiveLimiter] = None,
+                          gzip_uploads: bool = False) -> 'DcpStagingClient.Builder':
+            storage_credentials = self._credentials(service_account_credentials_path)
+            self.gcs_storage = GcsStorage(None, bucket_name, bucket_prefix, limiter,
+                                          client_factory=lambda: storage.Client(project=gcp_project, credentials=storage_credentials),
+                                          gzip_uploads=gzip_uploads)
+            return self
 
-                return self
+        def with_gcs_xfer(self, service_account_credentials_path: str, gcp_project: str, bucket_name: str, bucket_prefix: str, aws_access_key_id: str, aws_access_key_secret: str,
+                          poll_interval_sec: float = 10, poll_requests_per_sec: float = 1):
+            credentials = self._credentials(service_account_credentials_path)
+            status_poller = TransferStatusPoller(lambda: self.gcs_xfer.client, gcp_project,
+                                                 interval_sec=poll_interval_sec,
+                                                 rate_limiter=TokenBucket(rate=poll_requests_per_sec, capacity=5))
+            self.gcs_xfer = GcsXferStorage(aws_access_key_id, aws_access_key_secret, gcp_project, bucket_name, bucket_prefix, credentials, status_poller)
+            return self
+
+        def _credentials(self, service_account_credentials_path: str) -> Credentials:
+            if service_account_credentials_path not in self.credentials:
+                with open(service_account_credentials_path) as source:
+                    info = json.load(source)
+                self.credentials[service_account_credentials_path] = Credentials.from_service_account_info(info)
+            return self.credentials[service_account_credentials_path]
 
-        def with_gcs_xfer(self, service_account_credentials_path: str, gcp_project: str, bucket_name: str, bucket_prefix: str, aws_access_key_id: str, aws_access_key_secret: str):
-            with open(service_account_credentials_path) as source:
-                info = json.load(source)
-                credentials: Credentials = Credentials.from_service_account_info(info)
-                self.gcs_xfer = GcsXferStorage(aws_access_key_id, aws_access_key_secret, gcp_project, bucket_name, bucket_prefix, credentials)
+        def with_gcs_storage(self, gcs_storage: GcsStorage) -> 'DcpStagingClient.Builder':
+            self.gcs_storage = gcs_storage
+            return self
 
-                return self
+        def with_gcs_xfer_storage(self, gcs_xfer: GcsXferStorage) -> 'DcpStagingClient.Builder':
+            self.gcs_xfer = gcs_xfer
+            return self
 
         def with_ingest_client(self, ingest_client: IngestApi) -> 'DcpStagingClient.Builder':
             self.ingest_client = ingest_client
@@ -169,6 +353,14 @@ class DcpStagingClient:
             self.schema_service = schema_service
             return self
 
+        def with_renderer(self, renderer: DocumentRenderer) -> 'DcpStagingClient.Builder':
+            self.renderer = renderer
+            return self
+
+        def with_validator(self, validator: DocumentValidator) -> 'DcpStagingClient.Builder':
+            self.validator = validator
+            return self
+
         def build(self) -> 'DcpStagingClient':
             if not self.gcs_xfer:
                 raise Exception("gcs_xfer must be set")
@@ -178,5 +370,9 @@ class DcpStagingClient:
                 raise Exception("schema_service must be set")
             elif not self.ingest_client:
                 raise Exception("ingest_client must be set")
+            elif self.validator is not None and self.renderer is not None and not self.renderer.validates:
+                # metadata documents and file descriptors would otherwise be staged without being validated
+                raise Exception("renderer must validate when a validator is set")
             else:
-                return DcpStagingClient(self.gcs_storage, self.gcs_xfer, self.schema_service, self.ingest_client)
+                return DcpStagingClient(self.gcs_storage, self.gcs_xfer, self.schema_service, self.ingest_client,
+                                        renderer=self.renderer, validator=self.validator)
@@ -0,0 +1,100 @@
+"""
+Dry-run staging storage, which writes what an export would stage to a local directory or tar stream instead of GCS.
+
+Objects keep the key layout of the staging bucket, `<prefix>/<project uuid>/<metadata|descriptors|links>/...`, so a
+dry-run tree can be diffed against a previous run or a real export before publishing it.
+"""
+import io
+import json
+import tarfile
+import time
+from pathlib import Path
+from threading import Lock
+from typing import Dict, IO, Optional
+
+from exporter.terra.gcs import Streamable
+
+
+class DryRunReport:
+    def __init__(self):
+        self.objects: Dict[str, int] = dict()
+        self.bytes: Dict[str, int] = dict()
+        self.duplicates = 0
+
+    def add(self, object_type: str, size: int):
+        self.objects[object_type] = self.objects.get(object_type, 0) + 1
+        self.bytes[object_type] = self.bytes.get(object_type, 0) + size
+
+    def to_dict(self) -> Dict:
+        return {
+            "objects": sum(self.objects.values()),
+            "bytes": sum(self.bytes.values()),
+            "duplicates": self.duplicates,
+            "by_type": dict((object_type, {"objects": count, "bytes": self.bytes[object_type]})
+                            for object_type, count in sorted(self.objects.items()))
+        }
+
+    @staticmethod
+    def object_type(object_key: str) -> str:
+        # keys are <project uuid>/<object type>/...
+        parts = object_key.split('/')
+        return parts[1] if len(parts) > 2 else 'other'
+
+    @staticmethod
+    def for_directory(root: str, storage_prefix: str = '') -> 'DryRunReport':
+        report = DryRunReport()
+        staging_root = Path(root) / storage_prefix
+        for path in staging_root.rglob('*'):
+            if path.is_file():
+                report.add(DryRunReport.object_type(path.relative_to(staging_root).as_posix()), path.stat().st_size)
+        return report
+
+
+class DryRunStorage:
+    """
+    Stands in for GcsStorage. Exactly one of `root`, a directory, or `tar_stream`, a writable binary stream, should
+    be given. As with GCS, an object that has already been written is not written again.
+    """
+
+    def __init__(self, storage_prefix: str, root: Optional[str] = None, tar_stream: Optional[IO[bytes]] = None):
+        if (root is None) == (tar_stream is None):
+            raise ValueError('Exactly one of root or tar_stream must be given')
+        self.storage_prefix = storage_prefix
+        self.root = Path(root) if root is not None else None
+        self.tar = tarfile.open(fileobj=tar_stream, mode='w|') if tar_stream is not None else None
+
+        self.report = DryRunReport()
+        self._written = set()
+        self._lock = Lock()
+
+    def file_exists(self, object_key: str) -> bool:
+        with self._lock:
+            return object_key in self._written
+
+    def write(self, object_key: str, data_stream: Streamable):
+        data = data_stream.read()
+        data = data.encode() if isinstance(data, str) else data
+        dest_key = f'{self.storage_prefix}/{object_key}'
+        with self._lock:
+            if object_key in self._written:
+                self.report.duplicates += 1
+                return
+            self._written.add(object_key)
+            self.report.add(DryRunReport.object_type(object_key), len(data))
+            if self.tar is not None:
+                tar_info = tarfile.TarInfo(dest_key)
+                tar_info.size = len(data)
+                tar_info.mtime = int(time.time())
+                self.tar.addfile(tar_info, io.BytesIO(data))
+        if self.root is not None:
+            dest_path = self.root / dest_key
+            dest_path.parent.mkdir(parents=True, exist_ok=True)
+            dest_path.write_bytes(data)
+
+    def close(self):
+        if self.tar is not None:
+            self.tar.close()
+
+    def write_report(self, report_path: str):
+        with open(report_path, 'w') as report_file:
+            json.dump(self.report.to_dict(), report_file, indent=2)
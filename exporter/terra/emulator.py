@@ -0,0 +1,408 @@
+"""
+Local stand-ins for Google Cloud Storage and the Storage Transfer service.
+
+These mimic the parts of `google.cloud.storage.Client` and the `storagetransfer` discovery client that are used by
+GcsStorage and GcsXferStorage, so that exports can be run and benchmarked offline, and so that upload races and
+transient failures can be reproduced with configurable latency and failure injection.
+"""
+import base64
+import gzip
+import json
+import random
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from threading import Lock, Thread
+from typing import Dict, Optional, List, Iterable, Iterator, Set, Tuple, Any
+
+import google_crc32c
+import httplib2
+from google.api_core.exceptions import PreconditionFailed, ServiceUnavailable, NotFound
+from googleapiclient.errors import HttpError
+
+from exporter.terra.gcs import GcsXferStorage, TransferStatusPoller
+
+
+@dataclass
+class FaultInjection:
+    latency_sec: float = 0
+    latency_jitter_sec: float = 0
+    failure_rate: float = 0
+    failing_operations: Optional[Set[str]] = None
+    seed: Optional[int] = None
+    _random: random.Random = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._random = random.Random(self.seed)
+
+    def on_call(self, operation: str):
+        delay = self.latency_sec + (self._random.uniform(0, self.latency_jitter_sec) if self.latency_jitter_sec else 0)
+        if delay > 0:
+            time.sleep(delay)
+        if self.failure_rate > 0 and (self.failing_operations is None or operation in self.failing_operations):
+            if self._random.random() < self.failure_rate:
+                raise ServiceUnavailable(f'Injected failure for {operation}')
+
+
+@dataclass
+class StoredObject:
+    data: bytes
+    generation: int
+    metadata: Optional[Dict] = None
+    content_encoding: Optional[str] = None
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+    @property
+    def crc32c(self) -> str:
+        # GCS reports crc32c as base64 of the big-endian checksum
+        return base64.b64encode(google_crc32c.Checksum(self.data).digest()).decode()
+
+
+class InMemoryObjectStore:
+
+    def __init__(self):
+        self.objects: Dict[Tuple[str, str], StoredObject] = dict()
+        self.lock = Lock()
+        self._generation = 0
+
+    def get(self, bucket_name: str, key: str) -> Optional[StoredObject]:
+        with self.lock:
+            return self._load(bucket_name, key)
+
+    def create(self, bucket_name: str, key: str, data: bytes, if_generation_match: Optional[int] = None,
+               content_encoding: Optional[str] = None) -> StoredObject:
+        with self.lock:
+            existing = self._load(bucket_name, key)
+            if if_generation_match is not None and (existing.generation if existing else 0) != if_generation_match:
+                raise PreconditionFailed(f'At least one of the pre-conditions you specified did not hold '
+                                         f'for gs://{bucket_name}/{key}')
+            self._generation += 1
+            stored = StoredObject(data, self._generation, content_encoding=content_encoding)
+            self._save(bucket_name, key, stored)
+            return stored
+
+    def patch_metadata(self, bucket_name: str, key: str, metadata: Optional[Dict]):
+        with self.lock:
+            stored = self._load(bucket_name, key)
+            if stored is None:
+                raise NotFound(f'No such object: {bucket_name}/{key}')
+            stored.metadata = dict(metadata) if metadata is not None else None
+            self._save(bucket_name, key, stored)
+
+    def rename(self, bucket_name: str, key: str, new_key: str) -> StoredObject:
+        with self.lock:
+            stored = self._load(bucket_name, key)
+            if stored is None:
+                raise NotFound(f'No such object: {bucket_name}/{key}')
+            self._delete(bucket_name, key)
+            self._save(bucket_name, new_key, stored)
+            return stored
+
+    def list(self, bucket_name: str, prefix: str = '') -> List[Tuple[str, StoredObject]]:
+        with self.lock:
+            return sorted([(key, stored) for (bucket, key), stored in self.objects.items()
+                           if bucket == bucket_name and key.startswith(prefix)], key=lambda entry: entry[0])
+
+    def _load(self, bucket_name: str, key: str) -> Optional[StoredObject]:
+        return self.objects.get((bucket_name, key))
+
+    def _save(self, bucket_name: str, key: str, stored: StoredObject):
+        self.objects[(bucket_name, key)] = stored
+
+    def _delete(self, bucket_name: str, key: str):
+        del self.objects[(bucket_name, key)]
+
+
+class FilesystemObjectStore(InMemoryObjectStore):
+    """
+    Object store persisting object data under `root/<bucket>/<key>`, so that staged trees can be inspected on disk.
+    Generations and custom metadata are kept in sidecar files under `root/.metadata`.
+    """
+
+    def __init__(self, root: str):
+        super().__init__()
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._generation = max([stored.generation for _, stored in self._scan()], default=0)
+
+    def list(self, bucket_name: str, prefix: str = '') -> List[Tuple[str, StoredObject]]:
+        with self.lock:
+            return sorted([(key, stored) for (bucket, key), stored in self._scan()
+                           if bucket == bucket_name and key.startswith(prefix)], key=lambda entry: entry[0])
+
+    def _load(self, bucket_name: str, key: str) -> Optional[StoredObject]:
+        data_path = self._data_path(bucket_name, key)
+        if not data_path.is_file():
+            return None
+        sidecar = json.loads(self._sidecar_path(bucket_name, key).read_text())
+        return StoredObject(data_path.read_bytes(), sidecar["generation"], sidecar["metadata"],
+                            sidecar.get("contentEncoding"))
+
+    def _save(self, bucket_name: str, key: str, stored: StoredObject):
+        data_path = self._data_path(bucket_name, key)
+        data_path.parent.mkdir(parents=True, exist_ok=True)
+        data_path.write_bytes(stored.data)
+        sidecar_path = self._sidecar_path(bucket_name, key)
+        sidecar_path.parent.mkdir(parents=True, exist_ok=True)
+        sidecar_path.write_text(json.dumps({"generation": stored.generation, "metadata": stored.metadata,
+                                            "contentEncoding": stored.content_encoding}))
+
+    def _delete(self, bucket_name: str, key: str):
+        self._data_path(bucket_name, key).unlink()
+        self._sidecar_path(bucket_name, key).unlink()
+
+    def _scan(self) -> Iterable[Tuple[Tuple[str, str], StoredObject]]:
+        for bucket_dir in [d for d in self.root.iterdir() if d.is_dir() and d.name != '.metadata']:
+            for data_path in [p for p in bucket_dir.rglob('*') if p.is_file()]:
+                key = data_path.relative_to(bucket_dir).as_posix()
+                yield (bucket_dir.name, key), self._load(bucket_dir.name, key)
+
+    def _data_path(self, bucket_name: str, key: str) -> Path:
+        return self.root / bucket_name / key
+
+    def _sidecar_path(self, bucket_name: str, key: str) -> Path:
+        return self.root / '.metadata' / bucket_name / f'{key}.json'
+
+
+class LocalBlob:
+
+    def __init__(self, bucket: 'LocalBucket', name: str, chunk_size: Optional[int] = None):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = chunk_size
+        self.metadata: Optional[Dict] = None
+        self.content_encoding: Optional[str] = None
+        self.generation: Optional[int] = None
+        self.size: Optional[int] = None
+        self.crc32c: Optional[str] = None
+
+    def exists(self) -> bool:
+        self.bucket.client.faults.on_call('exists')
+        return self.bucket.client.store.get(self.bucket.name, self.name) is not None
+
+    def reload(self):
+        self.bucket.client.faults.on_call('reload')
+        stored = self.bucket.client.store.get(self.bucket.name, self.name)
+        if stored is None:
+            raise NotFound(f'No such object: {self.bucket.name}/{self.name}')
+        self._set_properties(stored)
+
+    def upload_from_file(self, file_obj, if_generation_match: Optional[int] = None, **kwargs):
+        self.bucket.client.faults.on_call('upload')
+        data = file_obj.read()
+        data = data.encode() if isinstance(data, str) else data
+        stored = self.bucket.client.store.create(self.bucket.name, self.name, data, if_generation_match,
+                                                 self.content_encoding)
+        self._set_properties(stored)
+
+    def upload_from_string(self, data, if_generation_match: Optional[int] = None, **kwargs):
+        self.bucket.client.faults.on_call('upload')
+        data = data.encode() if isinstance(data, str) else data
+        stored = self.bucket.client.store.create(self.bucket.name, self.name, data, if_generation_match,
+                                                 self.content_encoding)
+        self._set_properties(stored)
+
+    def download_as_bytes(self, raw_download: bool = False) -> bytes:
+        self.bucket.client.faults.on_call('download')
+        stored = self.bucket.client.store.get(self.bucket.name, self.name)
+        if stored is None:
+            raise NotFound(f'No such object: {self.bucket.name}/{self.name}')
+        # gzip-encoded objects are decompressed for the reader, as GCS does unless asked for the raw bytes
+        if stored.content_encoding == 'gzip' and not raw_download:
+            return gzip.decompress(stored.data)
+        return stored.data
+
+    def patch(self):
+        self.bucket.client.faults.on_call('patch')
+        self.bucket.client.store.patch_metadata(self.bucket.name, self.name, self.metadata)
+
+    def _set_properties(self, stored: StoredObject):
+        self.metadata = dict(stored.metadata) if stored.metadata is not None else None
+        self.content_encoding = stored.content_encoding
+        self.generation = stored.generation
+        self.size = stored.size
+        self.crc32c = stored.crc32c
+
+
+class LocalBucket:
+
+    def __init__(self, client: 'LocalGcsClient', name: str):
+        self.client = client
+        self.name = name
+
+    def blob(self, blob_name: str, chunk_size: Optional[int] = None) -> LocalBlob:
+        return LocalBlob(self, blob_name, chunk_size)
+
+    def rename_blob(self, blob: LocalBlob, new_name: str) -> LocalBlob:
+        self.client.faults.on_call('rename')
+        self.client.store.rename(self.name, blob.name, new_name)
+        new_blob = self.blob(new_name)
+        new_blob.reload()
+        return new_blob
+
+    def list_blobs(self, prefix: str = '', **kwargs) -> '_LocalBlobListing':
+        return self.client.list_blobs(self, prefix=prefix, **kwargs)
+
+
+class _LocalBlobListing:
+    """
+    Emulates the iterator returned by `list_blobs`: blobs are listed a page at a time, each page being one request
+    """
+
+    def __init__(self, client: 'LocalGcsClient', bucket: LocalBucket, prefix: str, page_size: int):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.page_size = page_size
+        self.next_page_token: Optional[str] = None
+
+    @property
+    def pages(self) -> Iterator[List[LocalBlob]]:
+        listed = self.client.store.list(self.bucket.name, self.prefix)
+        for start in range(0, max(len(listed), 1), self.page_size):
+            self.client.faults.on_call('list')
+            page = []
+            for key, stored in listed[start:start + self.page_size]:
+                blob = self.bucket.blob(key)
+                blob._set_properties(stored)
+                page.append(blob)
+            self.next_page_token = str(start + self.page_size) if start + self.page_size < len(listed) else None
+            yield page
+
+    def __iter__(self) -> Iterator[LocalBlob]:
+        for page in self.pages:
+            yield from page
+
+
+class LocalGcsClient:
+    """
+    Emulates the subset of `google.cloud.storage.Client` used by GcsStorage.
+    """
+
+    def __init__(self, store: Optional[InMemoryObjectStore] = None, faults: Optional[FaultInjection] = None):
+        self.store = store if store is not None else InMemoryObjectStore()
+        self.faults = faults if faults is not None else FaultInjection()
+
+    def bucket(self, bucket_name: str) -> LocalBucket:
+        return LocalBucket(self, bucket_name)
+
+    def list_blobs(self, bucket_or_name: Any, prefix: str = '', page_size: Optional[int] = None,
+                   **kwargs) -> _LocalBlobListing:
+        bucket = bucket_or_name if isinstance(bucket_or_name, LocalBucket) else self.bucket(bucket_or_name)
+        # GCS lists at most 1000 objects per request
+        return _LocalBlobListing(self, bucket, prefix, min(page_size or 1000, 1000))
+
+
+class _LocalRequest:
+    def __init__(self, fn):
+        self.fn = fn
+
+    def execute(self):
+        return self.fn()
+
+
+class LocalTransferClient:
+    """
+    Emulates the `storagetransfer` v1 discovery client. Transfer jobs copy objects from a local directory standing
+    in for S3 (`s3_root/<bucket>/<path>`) into a LocalGcsClient, in a background thread, after `transfer_delay_sec`.
+    """
+
+    def __init__(self, s3_root: str, gcs_client: LocalGcsClient, transfer_delay_sec: float = 0):
+        self.s3_root = Path(s3_root)
+        self.gcs_client = gcs_client
+        self.transfer_delay_sec = transfer_delay_sec
+
+        self.jobs: Dict[str, Dict] = dict()
+        self.operations: Dict[str, Dict] = dict()
+        self.lock = Lock()
+
+    def transferJobs(self) -> '_LocalTransferJobs':
+        return _LocalTransferJobs(self)
+
+    def transferOperations(self) -> '_LocalTransferOperations':
+        return _LocalTransferOperations(self)
+
+    def create_job(self, body: Dict) -> Dict:
+        job_name = body["name"]
+        with self.lock:
+            if job_name in self.jobs:
+                raise HttpError(httplib2.Response({'status': 409}), b'{"error": {"code": 409, "status": "ALREADY_EXISTS"}}')
+            self.jobs[job_name] = body
+            self.operations[job_name] = {
+                "name": f'transferOperations/{job_name.split("/")[-1]}',
+                "metadata": {"transferJobName": job_name, "status": "IN_PROGRESS"},
+                "done": False
+            }
+        Thread(target=lambda: self._run_job(body), daemon=True).start()
+        return body
+
+    def list_operations(self, filter: str) -> Dict:
+        job_names = json.loads(filter).get("job_names", [])
+        with self.lock:
+            return {"operations": [dict(self.operations[job_name]) for job_name in job_names
+                                   if job_name in self.operations]}
+
+    def _run_job(self, body: Dict):
+        time.sleep(self.transfer_delay_sec)
+        job_name = body["name"]
+        transfer_spec = body["transferSpec"]
+        try:
+            self._copy(transfer_spec["awsS3DataSource"], transfer_spec["gcsDataSink"],
+                       transfer_spec.get("transferOptions", {}).get("overwriteObjectsAlreadyExistingInSink", False))
+            status, error = "SUCCESS", None
+        except Exception as e:
+            status, error = "FAILED", {"message": str(e)}
+        with self.lock:
+            operation = self.operations[job_name]
+            operation["metadata"]["status"] = status
+            operation["done"] = True
+            if error:
+                operation["error"] = error
+
+    def _copy(self, source: Dict, sink: Dict, overwrite: bool):
+        source_dir = self.s3_root / source["bucketName"] / source.get("path", '')
+        dest_bucket = self.gcs_client.bucket(sink["bucketName"])
+        for source_file in sorted([p for p in source_dir.rglob('*') if p.is_file()]):
+            dest_key = f'{sink.get("path", "")}{source_file.relative_to(source_dir).as_posix()}'
+            blob = dest_bucket.blob(dest_key)
+            if overwrite or not blob.exists():
+                blob.upload_from_string(source_file.read_bytes())
+
+
+class _LocalTransferJobs:
+    def __init__(self, client: LocalTransferClient):
+        self.client = client
+
+    def create(self, body: Dict) -> _LocalRequest:
+        return _LocalRequest(lambda: self.client.create_job(body))
+
+
+class _LocalTransferOperations:
+    def __init__(self, client: LocalTransferClient):
+        self.client = client
+
+    def list(self, name: str, filter: str, **kwargs) -> _LocalRequest:
+        return _LocalRequest(lambda: self.client.list_operations(filter))
+
+    def list_next(self, previous_request: _LocalRequest, previous_response: Dict) -> Optional[_LocalRequest]:
+        return None
+
+
+class LocalGcsXferStorage(GcsXferStorage):
+
+    def __init__(self, transfer_client: LocalTransferClient, aws_access_key_id: str, aws_access_key_secret: str,
+                 project_id: str, gcs_dest_bucket: str, gcs_dest_prefix: str,
+                 status_poller: Optional[TransferStatusPoller] = None):
+        self.local_transfer_client = transfer_client
+        super().__init__(aws_access_key_id, aws_access_key_secret, project_id, gcs_dest_bucket, gcs_dest_prefix,
+                         None, status_poller)
+
+    def create_transfer_client(self):
+        return self.local_transfer_client
+
+
+def local_object_store(storage_root: Optional[str]) -> InMemoryObjectStore:
+    return FilesystemObjectStore(storage_root) if storage_root else InMemoryObjectStore()
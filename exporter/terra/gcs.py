@@ -1,21 +1,29 @@
+import os
 import googleapiclient.discovery
-from typing import IO, Dict, Any, Union, Optional, Callable
+from typing import IO, Dict, Any, List, Union, Optional, Callable
 from datetime import datetime
 import time
 
-import polling
 from google.cloud import storage
 from google.oauth2.service_account import Credentials
 from google.api_core.exceptions import PreconditionFailed, ServiceUnavailable
 from google.api_core import retry
-import json
 import logging
-from io import StringIO, BufferedReader
+from io import BytesIO, StringIO, BufferedReader
 
 from time import sleep
+from threading import Lock
 from dataclasses import dataclass
 from googleapiclient.errors import HttpError
 
+from exporter import metrics
+from exporter.compression import gzip_bytes
+from exporter.limiter import AdaptiveLimiter, limited
+from exporter.terra.transfer_poller import TransferStatusPoller
+
+# a copy of the Storage Transfer API discovery document, so creating the client needs no request to the discovery service
+STORAGE_TRANSFER_DISCOVERY_DOC = os.path.join(os.path.dirname(__file__), 'discovery', 'storagetransfer.v1.json')
+
 
 @dataclass
 class TransferJobSpec:
@@ -70,7 +78,8 @@ class TransferJobSpec:
 
 class GcsXferStorage:
 
-    def __init__(self, aws_access_key_id: str, aws_access_key_secret: str, project_id: str, gcs_dest_bucket: str, gcs_dest_prefix: str, credentials: Credentials):
+    def __init__(self, aws_access_key_id: str, aws_access_key_secret: str, project_id: str, gcs_dest_bucket: str, gcs_dest_prefix: str, credentials: Credentials,
+                 status_poller: Optional[TransferStatusPoller] = None):
         self.aws_access_key_id = aws_access_key_id
         self.aws_access_key_secret = aws_access_key_secret
         self.project_id = project_id
@@ -78,14 +87,25 @@ class GcsXferStorage:
         self.gcs_bucket_prefix = gcs_dest_prefix
         self.credentials = credentials
 
-        self.client = self.create_transfer_client()
+        self._client = None
+        self._client_lock = Lock()
+        self.status_poller = status_poller if status_poller is not None else TransferStatusPoller(lambda: self.client, project_id)
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.INFO)
 
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self.create_transfer_client()
+        return self._client
+
     def transfer_upload_area(self, source_bucket: str, upload_area_key: str, project_uuid: str, export_job_id: str)-> (TransferJobSpec, bool):
         transfer_job_spec = self.transfer_job_spec_for_upload_area(source_bucket, upload_area_key, project_uuid, export_job_id)
         success = False
         try:
+            metrics.inc('gcs_requests_total', {"operation": "transfer_job_create"})
             self.client.transferJobs().create(body=transfer_job_spec.to_dict()).execute()
             success = True
 
@@ -109,35 +129,18 @@ class GcsXferStorage:
                                dest_bucket=self.gcs_dest_bucket,
                                dest_path=f'{self.gcs_bucket_prefix}/{project_uuid}/data/')
 
-    def wait_for_job_to_complete(self, job_name: str, compute_wait_time:Callable, start_wait_time_sec: int, max_wait_time_sec: int):
-        try:
-            polling.poll(
-                lambda: self.is_job_complete(job_name),
-                step=start_wait_time_sec,
-                step_function=compute_wait_time,
-                timeout=max_wait_time_sec
-            )
-        except polling.TimeoutException as te:
-            raise
-
-    def is_job_complete(self, job_name: str):
-        request = self.client.transferOperations().list(name="transferOperations",
-                                                        filter=json.dumps({
-                                                            "project_id": self.project_id,
-                                                            "job_names": [job_name]
-                                                        }))
-        response: Dict = request.execute()
-
-        try:
-            operations = response.get("operations",[])
-            operation = operations[0] if len(operations) > 0 else None
-            return operation and operation.get('done', False)
-
-        except (KeyError, IndexError) as e:
-            raise Exception(f'Failed to parse transferOperations') from e
+    def wait_for_job_to_complete(self, job_name: str, max_wait_time_sec: int):
+        # Status lookups for all jobs being waited on are batched by the shared poller, which polls at its own
+        # rate-limited interval rather than per-waiter backoff steps
+        self.status_poller.wait_for_job(job_name, max_wait_time_sec)
 
     def create_transfer_client(self):
-        return googleapiclient.discovery.build('storagetransfer', 'v1', credentials=self.credentials, cache_discovery=False)
+        try:
+            with open(STORAGE_TRANSFER_DISCOVERY_DOC) as discovery_doc:
+                return googleapiclient.discovery.build_from_document(discovery_doc.read(), credentials=self.credentials)
+        except OSError as e:
+            self.logger.warning(f'Failed to read bundled discovery document, fetching it instead: {str(e)}')
+            return googleapiclient.discovery.build('storagetransfer', 'v1', credentials=self.credentials, cache_discovery=False)
 
 
 class UploadPollingException(Exception):
@@ -148,22 +151,44 @@ Streamable = Union[BufferedReader, StringIO, IO[Any]]
 
 
 class GcsStorage:
-    def __init__(self, gcs_client: storage.Client, bucket_name: str, storage_prefix: str):
-        self.gcs_client = gcs_client
+    """
+    With `gzip_uploads`, documents are uploaded gzip-compressed with a gzip Content-Encoding. GCS then serves them
+    decompressed to readers that do not accept gzip (decompressive transcoding), so only the bytes stored and
+    transferred change. This relies on the objects not having a `Cache-Control: no-transform` header.
+    """
+
+    def __init__(self, gcs_client: Optional[storage.Client], bucket_name: str, storage_prefix: str,
+                 limiter: Optional[AdaptiveLimiter] = None,
+                 client_factory: Optional[Callable[[], storage.Client]] = None,
+                 gzip_uploads: bool = False):
+        # without a client, one is created by client_factory on first use
+        self._gcs_client = gcs_client
+        self._client_factory = client_factory
+        self._client_lock = Lock()
         self.bucket_name = bucket_name
         self.storage_prefix = storage_prefix
+        self.limiter = limiter
+        self.gzip_uploads = gzip_uploads
 
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.INFO)
 
+    @property
+    def gcs_client(self) -> storage.Client:
+        if self._gcs_client is None:
+            with self._client_lock:
+                if self._gcs_client is None:
+                    self._gcs_client = self._client_factory()
+        return self._gcs_client
+
     def file_exists(self, object_key: str) -> bool:
         dest_key = f'{self.storage_prefix}/{object_key}'
         staging_bucket: storage.Bucket = self.gcs_client.bucket(self.bucket_name)
         blob: storage.Blob = staging_bucket.blob(dest_key)
-        if not blob.exists():
+        if not self._request('exists', blob.exists):
             return False
         else:
-            blob.reload()
+            self._request('reload', blob.reload)
             return blob.metadata is not None and blob.metadata.get("export_completed", False)
 
     def write(self, object_key: str, data_stream: Streamable):
@@ -172,8 +197,13 @@ class GcsStorage:
             staging_bucket: storage.Bucket = self.gcs_client.bucket(self.bucket_name)
             blob: storage.Blob = staging_bucket.blob(dest_key, chunk_size=1024 * 256 * 20)
 
-            if not blob.exists():
-                blob.upload_from_file(data_stream, if_generation_match=0)
+            if not self._request('exists', blob.exists):
+                upload_args = dict()
+                if self.gzip_uploads:
+                    data_stream = self._gzipped(data_stream)
+                    blob.content_encoding = 'gzip'
+                    upload_args['content_type'] = 'application/json'
+                self._request('upload', lambda: blob.upload_from_file(data_stream, if_generation_match=0, **upload_args))
                 self.mark_complete(blob)
             else:
                 self.assert_file_uploaded(object_key)
@@ -183,12 +213,20 @@ class GcsStorage:
             # and instead poll for its completion
             self.assert_file_uploaded(object_key)
 
+    @staticmethod
+    def _gzipped(data_stream: Streamable) -> BytesIO:
+        data = data_stream.read()
+        data = data.encode('utf-8') if isinstance(data, str) else data
+        compressed = gzip_bytes(data)
+        metrics.inc('gcs_upload_bytes_saved_total', value=len(data) - len(compressed))
+        return BytesIO(compressed)
+
     def move_file(self, source_key: str, object_key: str):
         dest_key = f'{self.storage_prefix}/{object_key}'
         staging_bucket: storage.Bucket = self.gcs_client.bucket(self.bucket_name)
         source_blob: storage.Blob = staging_bucket.blob(source_key)
 
-        new_blob = staging_bucket.rename_blob(source_blob, dest_key)
+        new_blob = self._request('rename', lambda: staging_bucket.rename_blob(source_blob, dest_key))
         self.mark_complete(new_blob)
         return
 
@@ -197,7 +235,23 @@ class GcsStorage:
         patch_retryer = retry.Retry(predicate=retry.if_exception_type(ServiceUnavailable),
                                     deadline=60)
 
-        patch_retryer(lambda: blob.patch())()
+        patch_retryer(lambda: self._request('patch', blob.patch))()
+
+    def list_objects(self, prefix: str, fields: Optional[str] = None) -> List[storage.Blob]:
+        """
+        The objects with keys starting with `prefix` under the storage prefix, each page of the listing being one
+        request. `fields`, if given, must include nextPageToken for the listing to go past its first page.
+        """
+        blobs = self.gcs_client.list_blobs(self.bucket_name, prefix=f'{self.storage_prefix}/{prefix}', fields=fields)
+        pages = iter(blobs.pages)
+        objects = list(self._request('list', lambda: next(pages, [])))
+        while blobs.next_page_token:
+            objects.extend(self._request('list', lambda: next(pages)))
+        return objects
+
+    def _request(self, operation: str, request: Callable[[], Any]) -> Any:
+        metrics.inc('gcs_requests_total', {"operation": operation})
+        return limited(self.limiter, request)
 
     def assert_file_uploaded(self, object_key: str):
         dest_key = f'{self.storage_prefix}/{object_key}'
@@ -214,7 +268,7 @@ class GcsStorage:
                                          f'wait time of {str(max_sleep_time)} seconds')
         else:
             sleep(sleep_time)
-            blob.reload()
+            self._request('reload', blob.reload)
 
             export_completed = blob.metadata is not None and blob.metadata.get("export_completed")
             if export_completed:
@@ -0,0 +1,126 @@
+import logging
+import math
+import time
+from collections import deque
+from threading import Condition, Thread
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from exporter import metrics
+
+
+def size_priority(total_assays: int) -> int:
+    """
+    Smaller submissions get higher priority: 0 for up to 9 assays, -1 for up to 99, -2 for up to 999 and so on
+    """
+    return -int(math.log10(max(total_assays, 1)))
+
+
+class _SubmissionQueue:
+    def __init__(self, priority: int, enqueued_at: float):
+        self.tasks: Deque[Callable[[], None]] = deque()
+        self.priority = priority
+        self.running = 0
+        # when the submission was last given a worker, or started waiting for one
+        self.waiting_since = enqueued_at
+
+
+class FairScheduler:
+    """
+    Runs tasks on a fixed pool of worker threads, queuing them per submission rather than in arrival order.
+
+    When a worker is free, it takes the next task of the submission with the highest effective priority, then the
+    fewest running tasks. A submission's effective priority is its priority plus one for every `aging_sec` it has
+    been waiting for a worker, so low priority submissions are not starved. No submission runs more than
+    `max_per_submission` tasks at once, so a large submission cannot take every worker.
+    """
+
+    def __init__(self, workers: int = 4, max_per_submission: Optional[int] = None, aging_sec: float = 300,
+                 clock: Callable[[], float] = time.monotonic):
+        self.workers = workers
+        self.max_per_submission = max_per_submission if max_per_submission is not None else max(1, workers - 1)
+        self.aging_sec = aging_sec
+        self.clock = clock
+
+        self._queues: Dict[str, _SubmissionQueue] = dict()
+        self._changed = Condition()
+        self._threads: List[Thread] = []
+
+        self.logger = logging.getLogger(__name__)
+
+    def start(self) -> 'FairScheduler':
+        for i in range(self.workers):
+            thread = Thread(target=self._work, name=f'terra-scheduler-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def submit(self, submission_uuid: str, task: Callable[[], None], priority: int = 0):
+        with self._changed:
+            queue = self._queues.get(submission_uuid)
+            if queue is None:
+                queue = self._queues[submission_uuid] = _SubmissionQueue(priority, self.clock())
+            queue.priority = priority
+            queue.tasks.append(task)
+            self._publish()
+            self._changed.notify()
+
+    def pending(self) -> Dict[str, int]:
+        with self._changed:
+            return dict((submission_uuid, len(queue.tasks)) for submission_uuid, queue in self._queues.items())
+
+    def next_task(self) -> Optional[Tuple[str, Callable[[], None]]]:
+        """
+        Takes the next task to run, if any submission has a task that can run now. Should be followed by a call to
+        `task_done` once the task has run.
+        """
+        with self._changed:
+            return self._next_task()
+
+    def task_done(self, submission_uuid: str):
+        with self._changed:
+            queue = self._queues[submission_uuid]
+            queue.running -= 1
+            if queue.running == 0 and not queue.tasks:
+                del self._queues[submission_uuid]
+            self._publish()
+            self._changed.notify_all()
+
+    def _next_task(self) -> Optional[Tuple[str, Callable[[], None]]]:
+        now = self.clock()
+        runnable = [(submission_uuid, queue) for submission_uuid, queue in self._queues.items()
+                    if queue.tasks and queue.running < self.max_per_submission]
+        if not runnable:
+            return None
+
+        def rank(entry: Tuple[str, _SubmissionQueue]):
+            _, queue = entry
+            effective_priority = queue.priority + int((now - queue.waiting_since) / self.aging_sec)
+            return -effective_priority, queue.running, queue.waiting_since
+
+        submission_uuid, queue = min(runnable, key=rank)
+        queue.running += 1
+        queue.waiting_since = now
+        self._publish()
+        return submission_uuid, queue.tasks.popleft()
+
+    def _work(self):
+        while True:
+            with self._changed:
+                submission_uuid, task = self._wait_for_task()
+            try:
+                task()
+            except Exception as e:
+                self.logger.exception(f'Scheduled task for submission {submission_uuid} failed: {str(e)}')
+            finally:
+                self.task_done(submission_uuid)
+
+    def _wait_for_task(self) -> Tuple[str, Callable[[], None]]:
+        while True:
+            next_task = self._next_task()
+            if next_task is not None:
+                return next_task
+            self._changed.wait()
+
+    def _publish(self):
+        metrics.registry.set_gauge('scheduler_pending_tasks', sum(len(queue.tasks) for queue in self._queues.values()))
+        metrics.registry.set_gauge('scheduler_submissions', len(self._queues))
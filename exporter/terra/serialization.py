@@ -0,0 +1,123 @@
+"""
+Rendering of staged metadata documents and file descriptors to bytes, optionally on a pool of worker processes,
+and their optional validation.
+
+Rendered documents are produced lazily, so they can be uploaded as they are rendered rather than held for a whole
+assay. Validation is a separate pass which only keeps errors, so that an assay can be validated in full before any
+of it is uploaded.
+
+Workers only receive plain payloads (the node's content, provenance and descriptor fields) and only import this
+module and the validation module, so they start quickly and do not need the ingest or Google clients.
+"""
+import json
+import multiprocessing
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from exporter.terra.validation import DocumentValidator, SchemaCache, fetch_schema
+
+
+@dataclass
+class NodePayload:
+    object_key: str
+    content: Dict
+    provenance: Dict
+    descriptor_key: Optional[str] = None
+    descriptor: Optional[Dict] = None
+
+
+@dataclass
+class RenderedNode:
+    object_key: str
+    document: bytes
+    descriptor_key: Optional[str] = None
+    descriptor: Optional[bytes] = None
+
+
+def _document(payload: NodePayload) -> Dict:
+    # a shallow copy, as in-process the content is still the node's own
+    document = dict(payload.content)
+    document["provenance"] = payload.provenance
+    return document
+
+
+def render_node(payload: NodePayload) -> RenderedNode:
+    descriptor = json.dumps(payload.descriptor).encode('utf-8') if payload.descriptor is not None else None
+    return RenderedNode(payload.object_key, json.dumps(_document(payload)).encode('utf-8'), payload.descriptor_key,
+                        descriptor)
+
+
+def node_errors(payload: NodePayload, validator: DocumentValidator) -> List[str]:
+    errors = [f'{payload.object_key}: {error}' for error in validator.errors(_document(payload))]
+    if payload.descriptor is not None:
+        errors += [f'{payload.descriptor_key}: {error}' for error in validator.errors(payload.descriptor)]
+    return errors
+
+
+class DocumentRenderer:
+
+    def __init__(self, validator: Optional[DocumentValidator] = None):
+        self.validator = validator
+
+    @property
+    def validates(self) -> bool:
+        return self.validator is not None
+
+    def errors(self, payloads: Iterable[NodePayload]) -> List[str]:
+        if not self.validates:
+            return []
+        return [error for payload in payloads for error in node_errors(payload, self.validator)]
+
+    def render(self, payloads: Iterable[NodePayload]) -> Iterator[RenderedNode]:
+        return map(render_node, payloads)
+
+    def close(self):
+        pass
+
+
+class ProcessPoolRenderer(DocumentRenderer):
+    """
+    Renders documents on `processes` worker processes, `chunk_size` at a time, yielding them in order as they are
+    rendered. Workers are spawned rather than forked, as forking a process that is already running consumer and
+    I/O threads can copy locks held by them.
+
+    With `validate`, workers validate documents with their own validator and a schema cache seeded with
+    `schemas`, e.g. the documents of a prefetched validator, and filled by `fetch`, which has to be picklable.
+    """
+
+    def __init__(self, processes: int, chunk_size: int = 16, validate: bool = False,
+                 fetch: Callable[[str], Dict] = fetch_schema, schemas: Optional[Dict[str, Dict]] = None):
+        super().__init__()
+        self.validate = validate
+        self.chunk_size = chunk_size
+        self.pool = multiprocessing.get_context('spawn').Pool(processes, initializer=_init_worker,
+                                                              initargs=(validate, fetch, schemas))
+
+    @property
+    def validates(self) -> bool:
+        return self.validate
+
+    def errors(self, payloads: Iterable[NodePayload]) -> List[str]:
+        if not self.validates:
+            return []
+        return [error for errors in self.pool.imap(_errors_in_worker, payloads, chunksize=self.chunk_size)
+                for error in errors]
+
+    def render(self, payloads: Iterable[NodePayload]) -> Iterator[RenderedNode]:
+        return self.pool.imap(render_node, payloads, chunksize=self.chunk_size)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+_worker_validator: Optional[DocumentValidator] = None
+
+
+def _init_worker(validate: bool, fetch: Callable[[str], Dict], schemas: Optional[Dict[str, Dict]] = None):
+    global _worker_validator
+    _worker_validator = DocumentValidator(SchemaCache(fetch, schemas)) if validate else None
+
+
+def _errors_in_worker(payload: NodePayload) -> List[str]:
+    return node_errors(payload, _worker_validator)
@@ -1,6 +1,8 @@
 from dataclasses import dataclass
-from typing import List, Dict, Callable
+from typing import List, Dict, Callable, Optional
 from ingest.api.ingestapi import IngestApi
+from exporter import metrics
+from exporter.limiter import AdaptiveLimiter, limited
 import requests
 import json
 
@@ -62,14 +64,16 @@ class TerraExportJob:
 
 
 class TerraExportJobService:
-    def __init__(self, ingest_client: IngestApi):
+    def __init__(self, ingest_client: IngestApi, limiter: Optional[AdaptiveLimiter] = None):
         self.ingest_client = ingest_client
+        self.limiter = limiter
 
     def create_export_entity(self, job_id: str, assay_process_id: str):
         assay_export_entity = TerraExportEntity(assay_process_id, [])
         create_export_entity_url = self.get_export_entities_url(job_id)
-        requests.post(create_export_entity_url, json.dumps(assay_export_entity.to_dict()),
-                      headers={"Content-type": "application/json"}, json=True).raise_for_status()
+        limited(self.limiter, lambda: requests.post(create_export_entity_url, json.dumps(assay_export_entity.to_dict()),
+                                                    headers={"Content-type": "application/json"}, json=True,
+                                                    hooks={"response": metrics.http_response_hook("ingest")}).raise_for_status())
         self._maybe_complete_job(job_id)
 
     def _maybe_complete_job(self, job_id):
@@ -79,14 +83,14 @@ class TerraExportJobService:
 
     def complete_job(self, job_id: str):
         job_url = self.get_job_url(job_id)
-        self.ingest_client.patch(job_url, {"status": ExportJobState.EXPORTED.value})
+        limited(self.limiter, lambda: self.ingest_client.patch(job_url, {"status": ExportJobState.EXPORTED.value}))
 
     def get_job_state(self, job_id: str) -> ExportJobState:
         return self.get_job(job_id).export_state
 
     def get_job(self, job_id: str) -> TerraExportJob:
         job_url = self.get_job_url(job_id)
-        return TerraExportJob.from_dict(self.ingest_client.get(job_url).json())
+        return TerraExportJob.from_dict(limited(self.limiter, lambda: self.ingest_client.get(job_url)).json())
 
     def get_job_url(self, job_id: str) -> str:
         return self.ingest_client.get_full_url(f'/exportJobs/{job_id}')
@@ -97,14 +101,14 @@ class TerraExportJobService:
     def get_num_complete_entities_for_job(self, job_id: str) -> int:
         entities_url = self.get_export_entities_url(job_id)
         find_entities_by_status_url = f'{entities_url}?status={ExportJobState.EXPORTED.value}'
-        return int(self.ingest_client.get(find_entities_by_status_url).json()["page"]["totalElements"])
+        return int(limited(self.limiter, lambda: self.ingest_client.get(find_entities_by_status_url)).json()["page"]["totalElements"])
 
     def set_data_transfer_complete(self, job_id: str):
         job_url = self.get_job_url(job_id)
-        job = self.ingest_client.get(job_url).json()
+        job = limited(self.limiter, lambda: self.ingest_client.get(job_url)).json()
         context = job["context"]
         context.update({"isDataTransferComplete": True})
-        self.ingest_client.patch(job_url, {"context": context})
+        limited(self.limiter, lambda: self.ingest_client.patch(job_url, {"context": context}))
 
     def is_data_transfer_complete(self, job_id: str):
         return self.get_job(job_id).is_data_transfer_complete
@@ -1,9 +1,18 @@
 from ingest.api.ingestapi import IngestApi
+from exporter import metrics
 from exporter.metadata import MetadataResource, MetadataService, DataFile
 from exporter.graph.graph_crawler import GraphCrawler
 from exporter.terra.dcp_staging_client import DcpStagingClient
+from exporter.terra.verification import DataFileVerificationException, DataFileVerifier
 
 import logging
+from threading import Lock
+from typing import Hashable, Optional
+
+from cachetools import LRUCache
+
+from exporter.graph.experiment_graph import ExperimentGraph
+from exporter.graph.link_index import LinkIndex
 
 from exporter.terra.terra_export_job import TerraExportJobService
 
@@ -14,12 +23,19 @@ class TerraExporter:
                  metadata_service: MetadataService,
                  graph_crawler: GraphCrawler,
                  dcp_staging_client: DcpStagingClient,
-                 job_service: TerraExportJobService):
+                 job_service: TerraExportJobService,
+                 link_index_cache_size: int = 16,
+                 data_file_verifier: Optional[DataFileVerifier] = None):
         self.ingest_client = ingest_client
         self.metadata_service = metadata_service
         self.graph_crawler = graph_crawler
         self.dcp_staging_client = dcp_staging_client
         self.job_service = job_service
+        # link indexes of the most recent export jobs
+        self.link_indexes = LRUCache(maxsize=link_index_cache_size)
+        self._link_indexes_lock = Lock()
+        # when set, the transferred data files of each assay are checked before its metadata is staged
+        self.data_file_verifier = data_file_verifier
 
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.INFO)
@@ -34,14 +50,53 @@ class TerraExporter:
         self.logger.info(f"The export data flag has been set to {export_data}")
         if export_data and not self.job_service.is_data_transfer_complete(export_job_id):
             self.logger.info("Exporting data files..")
-            transfer_job_spec, success = self.dcp_staging_client.transfer_data_files(submission, project.uuid, export_job_id)
-            self._wait_for_data_transfer_to_complete(export_job_id, success, transfer_job_spec)
+            with metrics.span('transfer_wait'):
+                transfer_job_spec, success = self.dcp_staging_client.transfer_data_files(submission, project.uuid, export_job_id)
+                self._wait_for_data_transfer_to_complete(export_job_id, success, transfer_job_spec)
 
         self.logger.info("Exporting metadata..")
+        verify_data_files = export_data and self.data_file_verifier is not None
+        self._export_metadata(process, project, self.link_index_for(export_job_id),
+                              export_job_id if verify_data_files else None)
+
+    def export_metadata(self, process_uuid, link_index_key: Optional[Hashable] = None):
+        """
+        Stages the metadata, file descriptors and links of an assay, without transferring its data files.
+        Assays exported with the same `link_index_key` share serialised links, so it should identify one export.
+        """
+        process = self.get_process(process_uuid)
+        link_index = self.link_index_for(link_index_key) if link_index_key else None
+        self._export_metadata(process, self.project_for_process(process), link_index)
+
+    def _export_metadata(self, process: MetadataResource, project: MetadataResource, link_index: Optional[LinkIndex],
+                         verification_job_id: Optional[str] = None):
         experiment_graph = self.graph_crawler.generate_complete_experiment_graph(process, project)
-        
-        self.dcp_staging_client.write_metadatas(experiment_graph.nodes.get_nodes(), project.uuid)
-        self.dcp_staging_client.write_links(experiment_graph.links, process_uuid, process.dcp_version, project.uuid)
+        if verification_job_id is not None:
+            self.verify_data_files(experiment_graph, project.uuid, verification_job_id)
+
+        # built first, so that an invalid links document fails the export before anything is staged
+        links_document = self.dcp_staging_client.links_document(experiment_graph.links, link_index)
+        # the nodes are only read while staging, so need not be copied
+        self.dcp_staging_client.write_metadatas(experiment_graph.nodes.iter_nodes(), project.uuid)
+        self.dcp_staging_client.write_links_document(links_document, process.uuid, process.dcp_version, project.uuid)
+
+    def verify_data_files(self, experiment_graph: ExperimentGraph, project_uuid: str, export_job_id: str):
+        data_files = [DataFile.from_file_metadata(node) for node in experiment_graph.nodes.iter_nodes()
+                      if node.metadata_type == "file"]
+        with metrics.span('data_file_verification'):
+            # files are transferred once per export job, so its assays share one listing of the data prefix
+            report = self.data_file_verifier.verify(project_uuid, data_files, index_key=export_job_id)
+        if not report.ok:
+            raise DataFileVerificationException(report)
+
+    def link_index_for(self, export_key: Hashable) -> LinkIndex:
+        # keyed by export rather than submission, as the links of a submission may change between its exports
+        with self._link_indexes_lock:
+            link_index = self.link_indexes.get(export_key)
+            if link_index is None:
+                link_index = LinkIndex()
+                self.link_indexes[export_key] = link_index
+            return link_index
 
     # Only the exporter process which is successful should be polling GCP Transfer service if the job is complete
     # This is to avoid hitting the rate limit 500 requests per 100 sec https://cloud.google.com/storage-transfer/quotas
@@ -55,8 +110,7 @@ class TerraExporter:
         if success:
             self.logger.info("Google Cloud Transfer job was successfully created..")
             self.logger.info("Waiting for job to complete..")
-            self.dcp_staging_client.wait_for_transfer_to_complete(transfer_job_spec.name, compute_wait_time,
-                                                                  start_wait_time_sec, max_wait_time_sec)
+            self.dcp_staging_client.wait_for_transfer_to_complete(transfer_job_spec.name, max_wait_time_sec)
             self.job_service.set_data_transfer_complete(export_job_id)
         else:
             self.logger.info("Google Cloud Transfer job was already created..")
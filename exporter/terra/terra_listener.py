@@ -1,10 +1,14 @@
 from kombu.mixins import ConsumerProducerMixin
 from kombu import Connection, Consumer, Message, Queue, Exchange
 
+from exporter import metrics
 from exporter.terra.terra_exporter import TerraExporter
 from exporter.amqp import QueueConfig, AmqpConnConfig
+from exporter.profiling import SlowMessageProfiler
+from exporter.terra.scheduler import FairScheduler, size_priority
 
-from typing import Type, List, Dict
+from typing import Type, List, Dict, Optional
+from queue import Queue as CompletionQueue, Empty
 from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 
@@ -48,13 +52,22 @@ class _TerraListener(ConsumerProducerMixin):
                  job_service: TerraExportJobService,
                  experiment_queue_config: QueueConfig,
                  publish_queue_config: QueueConfig,
-                 executor: ThreadPoolExecutor):
+                 executor: Optional[ThreadPoolExecutor],
+                 profiler: Optional[SlowMessageProfiler] = None,
+                 scheduler: Optional[FairScheduler] = None,
+                 prefetch_count: int = 1):
         self.connection = connection
         self.terra_exporter = terra_exporter
         self.job_service = job_service
         self.experiment_queue_config = experiment_queue_config
         self.publish_queue_config = publish_queue_config
         self.executor = executor
+        self.profiler = profiler if profiler is not None else SlowMessageProfiler(None)
+        # when set, messages are queued per submission by the scheduler instead of running in arrival order
+        self.scheduler = scheduler
+        self.prefetch_count = prefetch_count
+        # exported messages, to be published and acked on the consumer thread, which owns the channel
+        self.completed = CompletionQueue()
 
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.INFO)
@@ -62,21 +75,31 @@ class _TerraListener(ConsumerProducerMixin):
     def get_consumers(self, _consumer: Type[Consumer], channel) -> List[Consumer]:
         experiment_consumer = _consumer([_TerraListener.queue_from_config(self.experiment_queue_config)],
                                         callbacks=[self.experiment_message_handler],
-                                        prefetch_count=1)
+                                        prefetch_count=self.prefetch_count)
 
         return [experiment_consumer]
 
     def experiment_message_handler(self, body: str, msg: Message):
-        return self.executor.submit(lambda: self._experiment_message_handler(body, msg))
+        if self.scheduler is None:
+            return self.executor.submit(lambda: self._experiment_message_handler(body, msg))
 
-    def _experiment_message_handler(self, body: str, msg: Message):
         try:
             exp = ExperimentMessage.from_dict(json.loads(body))
-            self.logger.info(f'Received experiment message for process {exp.process_uuid} (index {exp.experiment_index} for submission {exp.submission_uuid})')
-            self.terra_exporter.export(exp.process_uuid, exp.submission_uuid, exp.job_id)
-            self.logger.info(f'Exported experiment for process uuid {exp.process_uuid} (--index {exp.experiment_index} --total {exp.total} --submission {exp.submission_uuid})')
-            self.log_complete_assay(exp.job_id, exp.process_id)
-
+        except (ValueError, ExperimentMessageParseExpection) as e:
+            self.logger.error(f'Failed to parse experiment message with body: {body}')
+            self.logger.exception(e)
+            # it would otherwise hold its prefetch slot until the connection drops
+            msg.reject(requeue=False)
+            return None
+        self.scheduler.submit(exp.submission_uuid, lambda: self._experiment_message_handler(body, msg),
+                              size_priority(exp.total))
+
+    def on_iteration(self):
+        while True:
+            try:
+                body, msg = self.completed.get_nowait()
+            except Empty:
+                return
             self.producer.publish(json.loads(body),
                 exchange=self.publish_queue_config.exchange,
                 routing_key=self.publish_queue_config.routing_key,
@@ -84,6 +107,19 @@ class _TerraListener(ConsumerProducerMixin):
                 retry_policy=self.publish_queue_config.retry_policy)
             msg.ack()
 
+    def _experiment_message_handler(self, body: str, msg: Message):
+        try:
+            exp = ExperimentMessage.from_dict(json.loads(body))
+            with metrics.message_trace('terra', process_uuid=exp.process_uuid, submission_uuid=exp.submission_uuid), \
+                    self.profiler.profile('terra', exp.process_uuid, exp.submission_uuid):
+                self.logger.info(f'Received experiment message for process {exp.process_uuid} (index {exp.experiment_index} for submission {exp.submission_uuid})')
+                self.terra_exporter.export(exp.process_uuid, exp.submission_uuid, exp.job_id)
+                self.logger.info(f'Exported experiment for process uuid {exp.process_uuid} (--index {exp.experiment_index} --total {exp.total} --submission {exp.submission_uuid})')
+                with metrics.span('job_bookkeeping'):
+                    self.log_complete_assay(exp.job_id, exp.process_id)
+
+                self.completed.put((body, msg))
+
         except Exception as e:
             self.logger.error(f'Failed to export experiment message with body: {body}')
             self.logger.exception(e)
@@ -104,14 +140,22 @@ class TerraListener:
                  terra_exporter: TerraExporter,
                  job_service: TerraExportJobService,
                  experiment_queue_config: QueueConfig,
-                 publish_queue_config: QueueConfig):
+                 publish_queue_config: QueueConfig,
+                 profiler: Optional[SlowMessageProfiler] = None,
+                 scheduler: Optional[FairScheduler] = None,
+                 prefetch_count: int = 1):
         self.amqp_conn_config = amqp_conn_config
         self.terra_exporter = terra_exporter
         self.job_service = job_service
         self.experiment_queue_config = experiment_queue_config
         self.publish_queue_config = publish_queue_config
+        self.profiler = profiler
+        self.scheduler = scheduler
+        self.prefetch_count = prefetch_count
 
     def run(self):
         with Connection(self.amqp_conn_config.broker_url()) as conn:
-            _terra_listener = _TerraListener(conn, self.terra_exporter, self.job_service, self.experiment_queue_config, self.publish_queue_config, ThreadPoolExecutor())
+            executor = ThreadPoolExecutor() if self.scheduler is None else None
+            _terra_listener = _TerraListener(conn, self.terra_exporter, self.job_service, self.experiment_queue_config, self.publish_queue_config, executor, self.profiler,
+                                             self.scheduler, self.prefetch_count)
             _terra_listener.run()
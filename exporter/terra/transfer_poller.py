@@ -0,0 +1,176 @@
+from threading import Thread, Lock, Condition, Event
+from typing import Any, Callable, Dict, Iterable, List, Optional
+import json
+import logging
+import time
+
+import polling
+
+from exporter import metrics
+
+
+class TokenBucket:
+    """
+    Token-bucket rate limiter. Tokens are refilled continuously at `rate` tokens per second, up to `capacity`.
+    """
+
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+
+        self._tokens = capacity
+        self._last_refill = clock()
+        self._lock = Lock()
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            else:
+                return False
+
+    def acquire(self, tokens: float = 1):
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait_time_sec = (tokens - self._tokens) / self.rate
+            time.sleep(wait_time_sec)
+
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+
+class _JobStatus:
+    def __init__(self):
+        self.done = Event()
+        self.error: Optional[Exception] = None
+        self.waiters = 0
+
+
+class TransferStatusPoller:
+    """
+    Polls the Storage Transfer service on behalf of every thread waiting on a transfer job.
+
+    Rather than each waiter listing transferOperations for its own job, the poller issues a single filtered
+    list request covering all active job names once per interval, subject to a token-bucket rate limit, and
+    wakes up the waiters of any job whose operation is done.
+
+    A failed poll is retried at the next interval, but after `max_consecutive_failures` failures in a row, the
+    waiters of the jobs being polled are woken up with the last error.
+    """
+
+    def __init__(self, client_provider: Callable[[], Any], project_id: str,
+                 interval_sec: float = 10, rate_limiter: Optional[TokenBucket] = None,
+                 max_jobs_per_request: int = 100, max_consecutive_failures: int = 3):
+        self.client_provider = client_provider
+        self.project_id = project_id
+        self.interval_sec = interval_sec
+        # stay well within the 500 requests per 100 sec quota, which is shared by every exporter instance
+        self.rate_limiter = rate_limiter if rate_limiter is not None else TokenBucket(rate=1, capacity=5)
+        self.max_jobs_per_request = max_jobs_per_request
+        self.max_consecutive_failures = max_consecutive_failures
+
+        self._jobs: Dict[str, _JobStatus] = dict()
+        self._jobs_changed = Condition()
+        self._poller_thread: Optional[Thread] = None
+
+        self.logger = logging.getLogger(__name__)
+
+    def wait_for_job(self, job_name: str, timeout_sec: float):
+        job_status = self._register(job_name)
+        try:
+            if not job_status.done.wait(timeout_sec):
+                raise polling.TimeoutException(None, f'Transfer job {job_name} did not complete within '
+                                                     f'{str(timeout_sec)} seconds')
+            if job_status.error is not None:
+                raise job_status.error
+        finally:
+            self._unregister(job_name, job_status)
+
+    def active_job_names(self) -> List[str]:
+        with self._jobs_changed:
+            return [job_name for job_name, job_status in self._jobs.items() if not job_status.done.is_set()]
+
+    def poll(self):
+        active_job_names = self.active_job_names()
+        for i in range(0, len(active_job_names), self.max_jobs_per_request):
+            job_names = active_job_names[i:i + self.max_jobs_per_request]
+            for operation in self._list_operations(job_names):
+                if operation.get('done', False):
+                    self._mark_done(operation.get('metadata', {}).get('transferJobName'))
+
+    def _list_operations(self, job_names: List[str]) -> Iterable[Dict]:
+        operations_api = self.client_provider().transferOperations()
+        request = operations_api.list(name="transferOperations",
+                                      filter=json.dumps({
+                                          "project_id": self.project_id,
+                                          "job_names": job_names
+                                      }))
+        while request is not None:
+            self.rate_limiter.acquire()
+            metrics.inc('gcs_requests_total', {"operation": "transfer_operations_list"})
+            response: Dict = request.execute()
+            yield from response.get("operations", [])
+            request = operations_api.list_next(previous_request=request, previous_response=response)
+
+    def _register(self, job_name: str) -> _JobStatus:
+        with self._jobs_changed:
+            job_status = self._jobs.setdefault(job_name, _JobStatus())
+            job_status.waiters += 1
+            self._ensure_poller_started()
+            self._jobs_changed.notify_all()
+            return job_status
+
+    def _unregister(self, job_name: str, job_status: _JobStatus):
+        with self._jobs_changed:
+            job_status.waiters -= 1
+            if job_status.waiters == 0 and self._jobs.get(job_name) is job_status:
+                del self._jobs[job_name]
+
+    def _mark_done(self, job_name: Optional[str]):
+        with self._jobs_changed:
+            job_status = self._jobs.get(job_name)
+            if job_status is not None:
+                job_status.done.set()
+
+    def _fail(self, job_names: List[str], error: Exception):
+        with self._jobs_changed:
+            for job_name in job_names:
+                job_status = self._jobs.get(job_name)
+                if job_status is not None:
+                    job_status.error = error
+                    job_status.done.set()
+
+    def _ensure_poller_started(self):
+        if self._poller_thread is None or not self._poller_thread.is_alive():
+            self._poller_thread = Thread(target=self._run, name='transfer-status-poller', daemon=True)
+            self._poller_thread.start()
+
+    def _run(self):
+        consecutive_failures = 0
+        while True:
+            with self._jobs_changed:
+                self._jobs_changed.wait_for(lambda: len(self._jobs) > 0)
+            time.sleep(self.interval_sec)
+            active_job_names = self.active_job_names()
+            try:
+                self.poll()
+                consecutive_failures = 0
+            except Exception as e:
+                consecutive_failures += 1
+                if consecutive_failures < self.max_consecutive_failures:
+                    self.logger.warning(f'Failed to poll transfer operations, will retry in '
+                                        f'{str(self.interval_sec)} seconds: {str(e)}')
+                    continue
+                self.logger.error(f'Failed to poll transfer operations {consecutive_failures} times in a row, '
+                                  f'failing {len(active_job_names)} waiting job(s): {str(e)}')
+                self._fail(active_job_names, e)
+                consecutive_failures = 0
@@ -0,0 +1,164 @@
+"""
+Validation of staged documents against the schemas named by their `describedBy`, before they are uploaded.
+
+Schemas, including the documents they `$ref`, are fetched once per process and shared by every validator, and
+validators are compiled once per schema URL. Validators for the latest schemas can be compiled ahead of the first
+export with `prefetch`, and the fetched documents handed to other processes to seed their caches.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+from urllib.parse import urldefrag, urljoin
+
+import requests
+from jsonschema.validators import validator_for
+
+from exporter import metrics
+from exporter.singleflight import SingleFlight
+
+try:
+    from referencing import Registry, Resource
+    from referencing.jsonschema import DRAFT7
+except ImportError:  # jsonschema < 4.18 resolves $refs with a RefResolver
+    Registry = None
+    from jsonschema import RefResolver
+
+
+class DocumentValidationException(Exception):
+    def __init__(self, errors: List[str]):
+        super().__init__(f'{len(errors)} staged document(s) are invalid: {"; ".join(errors[:10])}')
+        self.errors = errors
+
+
+def fetch_schema(url: str) -> Dict:
+    r = requests.get(url, timeout=30)
+    r.raise_for_status()
+    return r.json()
+
+
+class SchemaCache:
+
+    def __init__(self, fetch: Callable[[str], Dict] = fetch_schema, documents: Optional[Dict[str, Dict]] = None):
+        self.fetch = fetch
+        self._documents: Dict[str, Dict] = dict(documents) if documents else dict()
+        self._lock = Lock()
+        self._single_flight = SingleFlight()
+
+    def document(self, url: str) -> Dict:
+        url = url.rstrip('#')
+        with self._lock:
+            document = self._documents.get(url)
+        if document is None:
+            document, _ = self._single_flight.do(url, lambda: self._fetch(url))
+        return document
+
+    def documents(self) -> Dict[str, Dict]:
+        with self._lock:
+            return dict(self._documents)
+
+    def _fetch(self, url: str) -> Dict:
+        document = self.fetch(url)
+        metrics.inc('schema_documents_fetched_total')
+        with self._lock:
+            self._documents[url] = document
+        return document
+
+
+class DocumentValidator:
+
+    def __init__(self, schema_cache: Optional[SchemaCache] = None):
+        self.schema_cache = schema_cache if schema_cache is not None else SchemaCache()
+        self._validators: Dict[str, object] = dict()
+        self._registry = Registry() if Registry is not None else None
+        self._lock = Lock()
+        self._single_flight = SingleFlight()
+        self.logger = logging.getLogger(__name__)
+
+    def prefetch(self, schema_urls: Iterable[str], workers: int = 8) -> 'DocumentValidator':
+        """
+        Compiles validators for the given schemas, fetching them and the schemas they refer to, so that validating
+        documents described by them does not wait on schema requests
+        """
+        def compile_validator(schema_url: str):
+            try:
+                self.validator_for(schema_url)
+            except Exception as e:
+                self.logger.warning(f'Failed to prefetch schema {schema_url}, it will be fetched on first use: {str(e)}')
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(compile_validator, schema_urls))
+        return self
+
+    def errors(self, document: Dict) -> List[str]:
+        schema_url = document.get("describedBy")
+        if not schema_url:
+            return ['document has no describedBy']
+        return [f'{schema_url}: {"/".join(str(p) for p in error.absolute_path)}: {error.message}'
+                for error in self.validator_for(schema_url).iter_errors(document)]
+
+    def validate(self, document: Dict):
+        errors = self.errors(document)
+        if errors:
+            raise DocumentValidationException(errors)
+
+    def validator_for(self, schema_url: str):
+        with self._lock:
+            validator = self._validators.get(schema_url)
+        if validator is None:
+            validator, _ = self._single_flight.do(schema_url, lambda: self._compile(schema_url))
+        return validator
+
+    def _compile(self, schema_url: str):
+        schema = self.schema_cache.document(schema_url)
+        validator_class = validator_for(schema)
+        validator_class.check_schema(schema)
+        if Registry is not None:
+            # referring to the schema by its URL resolves its relative $refs against it, even without an $id
+            validator = validator_class({"$ref": schema_url}, registry=self._registry_with(schema_url))
+        else:
+            resolver = RefResolver(schema_url, schema, handlers={'http': self.schema_cache.document,
+                                                                 'https': self.schema_cache.document})
+            validator = validator_class(schema, resolver=resolver)
+        with self._lock:
+            self._validators[schema_url] = validator
+        return validator
+
+    def _registry_with(self, schema_url: str) -> 'Registry':
+        """
+        The registry shared by all validators, with the schema and every schema it refers to, directly or not,
+        already crawled, so that looking up a $ref while validating is a dictionary lookup
+        """
+        urls = self._referenced_urls(schema_url)
+        with self._lock:
+            missing = [url for url in urls if url not in self._registry]
+            if missing:
+                # HCA schemas are draft-07, and name it in $schema
+                self._registry = self._registry.with_resources(
+                    (url, Resource.from_contents(self.schema_cache.document(url), default_specification=DRAFT7))
+                    for url in missing).crawl()
+            return self._registry
+
+    def _referenced_urls(self, schema_url: str) -> List[str]:
+        urls = [schema_url]
+        pending = [schema_url]
+        while pending:
+            url = pending.pop()
+            for ref in _refs(self.schema_cache.document(url)):
+                ref_url = urldefrag(urljoin(url, ref))[0]
+                if ref_url and ref_url not in urls:
+                    urls.append(ref_url)
+                    pending.append(ref_url)
+        return urls
+
+
+def _refs(schema) -> Iterator[str]:
+    if isinstance(schema, dict):
+        for key, value in schema.items():
+            if key == '$ref' and isinstance(value, str):
+                yield value
+            else:
+                yield from _refs(value)
+    elif isinstance(schema, list):
+        for item in schema:
+            yield from _refs(item)
@@ -0,0 +1,126 @@
+"""
+Verification of transferred data files against the data files of an experiment graph, from object metadata only.
+
+The data prefix of a project is listed once, asking only for the name, size and crc32c of each object, and every
+DataFile is then checked against that index. No object is read.
+"""
+import base64
+import binascii
+from dataclasses import dataclass, field, asdict
+from threading import Lock
+from typing import Dict, Hashable, Iterable, List, Optional
+
+from cachetools import LRUCache
+
+from exporter import metrics
+from exporter.metadata import DataFile
+from exporter.singleflight import SingleFlight
+from exporter.terra.gcs import GcsStorage
+
+
+class DataFileVerificationException(Exception):
+    def __init__(self, report: 'DataFileReport'):
+        super().__init__(f'{len(report.missing)} data file(s) missing and {len(report.mismatched)} mismatched out of '
+                         f'{report.checked}: {report.missing[:5]} {[m.file_name for m in report.mismatched[:5]]}')
+        self.report = report
+
+
+@dataclass
+class StoredDataFile:
+    size: int
+    crc32c: str
+
+
+@dataclass
+class DataFileMismatch:
+    file_name: str
+    expected: StoredDataFile
+    actual: StoredDataFile
+
+
+@dataclass
+class DataFileReport:
+    checked: int = 0
+    missing: List[str] = field(default_factory=list)
+    mismatched: List[DataFileMismatch] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.missing and not self.mismatched
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+def crc32c_hex(gcs_crc32c: str) -> str:
+    """
+    GCS reports crc32c as base64 of the big-endian checksum, where ingest has it in hex
+    """
+    return binascii.hexlify(base64.b64decode(gcs_crc32c)).decode()
+
+
+class DataFileVerifier:
+    """
+    Indexes are kept for the `index_cache_size` most recent keys, as every assay of an export job checks its files
+    against the same transfer. A key should therefore change whenever files may have been transferred since, e.g. by
+    being the export job id.
+    """
+
+    def __init__(self, gcs_storage: GcsStorage, index_cache_size: int = 16):
+        self.gcs_storage = gcs_storage
+        self.indexes = LRUCache(maxsize=index_cache_size)
+        self._indexes_lock = Lock()
+        self._single_flight = SingleFlight()
+
+    def verify(self, project_uuid: str, data_files: Iterable[DataFile],
+               index_key: Optional[Hashable] = None) -> DataFileReport:
+        index = self.index_for(project_uuid, index_key)
+        report = DataFileReport()
+        for data_file in data_files:
+            report.checked += 1
+            file_name = self.transferred_name(data_file)
+            stored = index.get(file_name)
+            expected = StoredDataFile(int(data_file.size), self.normalised_crc32c(data_file.checksums.crc32c))
+            if stored is None:
+                report.missing.append(file_name)
+            elif stored != expected:
+                report.mismatched.append(DataFileMismatch(file_name, expected, stored))
+        metrics.inc('data_files_verified_total', value=report.checked)
+        metrics.inc('data_files_missing_total', value=len(report.missing))
+        metrics.inc('data_files_mismatched_total', value=len(report.mismatched))
+        return report
+
+    def index_for(self, project_uuid: str, index_key: Optional[Hashable] = None) -> Dict[str, StoredDataFile]:
+        if index_key is None:
+            return self.index(project_uuid)
+        key = (project_uuid, index_key)
+        with self._indexes_lock:
+            index = self.indexes.get(key)
+        if index is None:
+            index, _ = self._single_flight.do(key, lambda: self._cache_index(key, project_uuid))
+        return index
+
+    def index(self, project_uuid: str) -> Dict[str, StoredDataFile]:
+        """
+        The name, relative to the project's data prefix, size and hex crc32c of every transferred data file
+        """
+        data_prefix = f'{self.gcs_storage.storage_prefix}/{project_uuid}/data/'
+        with metrics.span('data_file_listing'):
+            blobs = self.gcs_storage.list_objects(f'{project_uuid}/data/', fields='items(name,size,crc32c),nextPageToken')
+            return dict((blob.name[len(data_prefix):], StoredDataFile(int(blob.size), crc32c_hex(blob.crc32c)))
+                        for blob in blobs)
+
+    def _cache_index(self, key: Hashable, project_uuid: str) -> Dict[str, StoredDataFile]:
+        index = self.index(project_uuid)
+        with self._indexes_lock:
+            self.indexes[key] = index
+        return index
+
+    @staticmethod
+    def transferred_name(data_file: DataFile) -> str:
+        # the whole upload area is transferred to the data prefix, so the name is the key within the upload area
+        return data_file.source_key().split('/', 1)[1]
+
+    @staticmethod
+    def normalised_crc32c(crc32c: str) -> str:
+        return crc32c.lower().zfill(8) if crc32c else crc32c
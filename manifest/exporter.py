@@ -2,26 +2,69 @@
 import argparse
 import logging
 import sys
+from typing import Dict, Optional, List
 
+import requests
 from ingest.api.ingestapi import IngestApi
 
+from exporter import metrics
+
+from exporter.graph.graph_crawler import GraphCrawler
+from exporter.metadata import MetadataService
 from manifest.generator import ManifestGenerator
+from manifest.manifests import AssayManifest
 
 
 class ManifestExporter:
-    def __init__(self, ingest_api: IngestApi, manifest_generator: ManifestGenerator):
+    def __init__(self, ingest_api: IngestApi, manifest_generator: ManifestGenerator, stream_threshold: Optional[int] = None):
         format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
         logging.basicConfig(format=format)
         self.logger = logging.getLogger(__name__)
         self.ingest_api = ingest_api
         self.manifest_generator = manifest_generator
+        # manifests with at least this many entries are streamed to ingest rather than serialised in one go
+        self.stream_threshold = stream_threshold
 
-    def export(self, process_uuid: str, submission_uuid: str):
-        assay_manifest = self.manifest_generator.generate_manifest(process_uuid, submission_uuid)
-        assay_manifest_resource = self.ingest_api.create_bundle_manifest(assay_manifest)
+    def export(self, process_uuid: str, submission_uuid: str, manifest_generator: Optional[ManifestGenerator] = None):
+        manifest_generator = manifest_generator if manifest_generator is not None else self.manifest_generator
+        assay_manifest = manifest_generator.generate_manifest(process_uuid, submission_uuid)
+        with metrics.span('manifest_submit'):
+            assay_manifest_resource = self.create_bundle_manifest(assay_manifest)
         assay_manifest_url = assay_manifest_resource['_links']['self']['href']
         self.logger.info(f"Assay manifest was created: {assay_manifest_url}")
 
+    def export_batch(self, process_uuids: List[str], submission_uuid: str) -> Dict[str, Exception]:
+        """
+        Exports the manifests of several assays of the same submission from one shared crawl. Ingest has no bulk
+        endpoint for bundle manifests, so they are created one after another over the ingest client's keep-alive
+        session.
+        :return: the errors of the assays that failed to export, by process uuid
+        """
+        manifest_generator = self.manifest_generator.with_shared_crawl()
+        failures = dict()
+        for process_uuid in process_uuids:
+            try:
+                self.export(process_uuid, submission_uuid, manifest_generator)
+            except Exception as e:
+                self.logger.exception(f'Failed to export manifest for process {process_uuid}: {str(e)}')
+                failures[process_uuid] = e
+        return failures
+
+    def create_bundle_manifest(self, assay_manifest: AssayManifest) -> Dict:
+        if self.stream_threshold is not None and assay_manifest.entry_count() >= self.stream_threshold:
+            return self.stream_bundle_manifest(assay_manifest)
+        else:
+            return self.ingest_api.create_bundle_manifest(assay_manifest)
+
+    def stream_bundle_manifest(self, assay_manifest: AssayManifest) -> Dict:
+        # A chunked request body cannot be replayed, so this deliberately bypasses the retrying ingest session, but
+        # posts to the same bundleManifests link as create_bundle_manifest
+        url = self.ingest_api.get_resource_repository_url('bundleManifests')
+        r = requests.post(url, data=assay_manifest.to_json_chunks(), headers=self.ingest_api.get_headers(),
+                          hooks={"response": metrics.http_response_hook("ingest")})
+        r.raise_for_status()
+        return r.json()
+
 
 if __name__ == '__main__':
     format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -36,5 +79,5 @@ if __name__ == '__main__':
     submission_uuid = args.submission_uuid
 
     ingest_api = IngestApi(url=f'https://api.{args.env}.archive.data.humancellatlas.org/')
-    exporter = ManifestExporter(ingest_api)
+    exporter = ManifestExporter(ingest_api, ManifestGenerator(ingest_api, GraphCrawler(MetadataService(ingest_api))))
     exporter.export(process_uuid, submission_uuid)
\ No newline at end of file
@@ -1,8 +1,10 @@
 from ingest.api.ingestapi import IngestApi
 
+from exporter import metrics
+
 from manifest.manifests import AssayManifest
 from exporter.graph.experiment_graph import ExperimentGraph
-from exporter.graph.graph_crawler import GraphCrawler
+from exporter.graph.graph_crawler import GraphCrawler, CachingGraphCrawler
 from exporter.metadata import MetadataResource, DataFile
 from typing import Dict, List
 
@@ -17,10 +19,17 @@ class ManifestGenerator:
         project = self.project_for_process(process)
 
         experiment_graph = self.graph_crawler.generate_complete_experiment_graph(process, project)
-        assay_manifest = ManifestGenerator.assay_manifest_from_experiment_graph(experiment_graph, submission_uuid)
+        with metrics.span('manifest_generation'):
+            assay_manifest = ManifestGenerator.assay_manifest_from_experiment_graph(experiment_graph, submission_uuid)
 
         return assay_manifest
 
+    def with_shared_crawl(self) -> 'ManifestGenerator':
+        """
+        :return: a ManifestGenerator whose crawls share the process and project metadata they have already fetched
+        """
+        return ManifestGenerator(self.ingest_client, CachingGraphCrawler(self.graph_crawler.metadata_service))
+
     def get_process(self, process_uuid: str) -> MetadataResource:
         return MetadataResource.from_dict(self.ingest_client.get_entity_by_uuid('processes', process_uuid))
 
@@ -32,17 +41,24 @@ class ManifestGenerator:
         assay_manifest = AssayManifest()
         assay_manifest.envelopeUuid = submission_uuid
 
-        assay_manifest.fileProjectMap.update(ManifestGenerator.metadata_uuid_map_from_graph(experiment_graph, "project"))
-        assay_manifest.fileBiomaterialMap.update(ManifestGenerator.metadata_uuid_map_from_graph(experiment_graph, "biomaterial"))
-        assay_manifest.fileProcessMap.update(ManifestGenerator.metadata_uuid_map_from_graph(experiment_graph, "process"))
-        assay_manifest.fileProtocolMap.update(ManifestGenerator.metadata_uuid_map_from_graph(experiment_graph, "protocol"))
-        assay_manifest.fileFilesMap.update(ManifestGenerator.metadata_uuid_map_from_graph(experiment_graph, "file"))
+        uuid_maps = {
+            "project": assay_manifest.fileProjectMap,
+            "biomaterial": assay_manifest.fileBiomaterialMap,
+            "process": assay_manifest.fileProcessMap,
+            "protocol": assay_manifest.fileProtocolMap,
+            "file": assay_manifest.fileFilesMap
+        }
 
-        assay_manifest.dataFiles = [DataFile.from_file_metadata(m).uuid for m in experiment_graph.nodes.get_nodes()
-                                    if m.metadata_type == "file"]
+        # a single pass over the graph's nodes, which are read but never copied
+        for node in experiment_graph.nodes.iter_nodes():
+            uuid_map = uuid_maps.get(node.metadata_type)
+            if uuid_map is not None:
+                uuid_map[node.uuid] = [node.uuid]
+            if node.metadata_type == "file":
+                assay_manifest.dataFiles.append(DataFile.uuid_from_file_metadata(node))
 
         return assay_manifest
 
     @staticmethod
     def metadata_uuid_map_from_graph(experiment_graph: ExperimentGraph, metadata_type: str) -> Dict[str, List[str]]:
-        return dict([(m.uuid, [m.uuid]) for m in experiment_graph.nodes.get_nodes() if m.metadata_type == metadata_type])
+        return dict([(m.uuid, [m.uuid]) for m in experiment_graph.nodes.iter_nodes() if m.metadata_type == metadata_type])
@@ -1,3 +1,6 @@
+import json
+from typing import Iterator
+
 _BUNDLE_FILE_TYPE_DATA = 'data'
 _BUNDLE_FILE_TYPE_LINKS = 'links'
 
@@ -50,4 +53,24 @@ class AssayManifest:
             else:
                 raise KeyError(f'Cannot map unknown metadata type [{metadata_type}].')
 
+    def entry_count(self) -> int:
+        return len(self.dataFiles) + len(self.fileBiomaterialMap) + len(self.fileProcessMap) + \
+               len(self.fileFilesMap) + len(self.fileProjectMap) + len(self.fileProtocolMap)
+
+    def to_json_chunks(self, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+        """
+        Encodes the manifest as JSON incrementally, yielding chunks of roughly `chunk_size` bytes, so that very large
+        manifests can be streamed without building the whole document in memory
+        """
+        buffer = []
+        buffered = 0
+        for fragment in json.JSONEncoder().iterencode(self.__dict__):
+            buffer.append(fragment)
+            buffered += len(fragment)
+            if buffered >= chunk_size:
+                yield ''.join(buffer).encode()
+                buffer, buffered = [], 0
+        if buffer:
+            yield ''.join(buffer).encode()
+
 
@@ -1,51 +1,172 @@
 import json
 import logging
+import queue
 import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Optional, Type, Dict, List, Tuple
 
+from kombu import Consumer, Message
+
+from exporter import metrics
+from exporter.profiling import SlowMessageProfiler
 from manifest.exporter import ManifestExporter
 from receiver import Receiver
 
 
+class _Batch:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.messages: List[Tuple[Dict, Message]] = []
+
+
 class ManifestReceiver(Receiver):
-    def __init__(self, connection, queues, exporter: ManifestExporter, publish_config):
+    """
+    Exports manifests on a pool of worker threads, keeping at most `prefetch_count` unacknowledged messages in flight.
+
+    A message is only acked once its manifest has been created and the state tracker notified. As the AMQP channel
+    is not thread-safe, workers hand their results back through a queue, and the ack and completion notification
+    are done on the consumer thread, in `on_iteration`. A failed notification is retried on the following
+    iterations, up to `max_notify_attempts` times, rather than requeueing the message, which would create the
+    manifest again.
+
+    With a positive `batch_window_sec`, messages of the same submission that arrive within the window, up to
+    `batch_size` of them, are exported together from one shared crawl. The prefetch window should then be at least
+    the batch size.
+    """
+
+    def __init__(self, connection, queues, exporter: ManifestExporter, publish_config,
+                 profiler: Optional[SlowMessageProfiler] = None, executor: Optional[Executor] = None,
+                 prefetch_count: int = 1, batch_window_sec: float = 0, batch_size: int = 50,
+                 max_notify_attempts: int = 5):
         self.connection = connection
         self.queues = queues
         self.logger = logging.getLogger(f'{__name__}.ManifestReceiver')
         self.publish_config = publish_config
         self.exporter = exporter
+        self.profiler = profiler if profiler is not None else SlowMessageProfiler(None)
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max_workers=1)
+        self.prefetch_count = prefetch_count
+        self.completed = queue.Queue()
+        self.batch_window_sec = batch_window_sec
+        self.batch_size = batch_size
+        self.batches: Dict[str, _Batch] = dict()
+        self.max_notify_attempts = max_notify_attempts
+        # (message, body, attempts so far) of completed manifests whose notification failed
+        self.pending_notifications: List[Tuple[Message, Dict, int]] = []
 
     def run(self):
         self.logger.info("Running ManifestReceiver")
         super(ManifestReceiver, self).run()
 
-    def on_message(self, body, message):
+    def get_consumers(self, consumer: Type[Consumer], channel):
+        return [consumer(queues=self.queues,
+                         callbacks=[self.on_message],
+                         prefetch_count=self.prefetch_count)]
+
+    def on_message(self, body, message: Message):
         self.logger.info(f'Message received: {body}')
+        if self.batch_window_sec <= 0:
+            return self.executor.submit(self.export, body, message)
 
-        self.logger.info('Ack-ing message...')
-        message.ack()
-        self.logger.info('Acked!')
+        try:
+            body_dict = json.loads(body)
+            # both are read by export_batch on a worker thread, where a missing one would fail the batch unnoticed
+            submission_uuid, _ = body_dict["envelopeUuid"], body_dict["documentUuid"]
+        except (ValueError, KeyError, TypeError) as e:
+            self.logger.error(f"Failed to parse the exporter message: {body} due to error: {str(e)}")
+            message.reject(requeue=False)
+            return None
 
+        batch = self.batches.setdefault(submission_uuid, _Batch())
+        batch.messages.append((body_dict, message))
+        if len(batch.messages) >= self.batch_size:
+            return self.submit_batch(submission_uuid)
+        return None
+
+    def submit_batch(self, submission_uuid: str):
+        batch = self.batches.pop(submission_uuid)
+        return self.executor.submit(self.export_batch, submission_uuid, batch.messages)
+
+    def export_batch(self, submission_uuid: str, messages: List[Tuple[Dict, Message]]):
+        process_uuids = [body_dict["documentUuid"] for body_dict, _ in messages]
+        self.logger.info(f'Exporting batch of {len(process_uuids)} manifests for submission {submission_uuid}')
+        try:
+            with metrics.message_trace('manifest_batch', submission_uuid=submission_uuid, size=len(process_uuids)):
+                failures = self.exporter.export_batch(process_uuids, submission_uuid)
+        except Exception as e:
+            self.logger.exception(f'Failed to export batch of manifests for submission {submission_uuid}: {str(e)}')
+            failures = dict((process_uuid, e) for process_uuid in process_uuids)
+
+        for body_dict, message in messages:
+            self.completed.put((message, body_dict, body_dict["documentUuid"] not in failures))
+
+    def export(self, body, message: Message):
         success = False
         start = time.perf_counter()
-        body_dict = json.loads(body)
+        body_dict = None
 
         try:
+            body_dict = json.loads(body)
             self.logger.info('process received ' + body_dict["callbackLink"])
             self.logger.info('process index: ' + str(
                 body_dict["index"]) + ', total processes: ' + str(
                 body_dict["total"]))
 
-            self.exporter.export(process_uuid=body_dict["documentUuid"], submission_uuid=body_dict["envelopeUuid"])
+            with metrics.message_trace('manifest', process_uuid=body_dict["documentUuid"],
+                                       submission_uuid=body_dict["envelopeUuid"]), \
+                    self.profiler.profile('manifest', body_dict["documentUuid"], body_dict["envelopeUuid"]):
+                self.exporter.export(process_uuid=body_dict["documentUuid"], submission_uuid=body_dict["envelopeUuid"])
 
             success = True
+            self.logger.info('Export time (s): ' + str(time.perf_counter() - start))
         except Exception as e1:
             self.logger.exception(str(e1))
             self.logger.error(f"Failed to process the exporter message: {body} due to error: {str(e1)}")
 
-        if success:
-            self.logger.info(f"Notifying state tracker of completed manifest: {body}")
+        self.completed.put((message, body_dict, success))
+
+    def on_iteration(self):
+        now = time.monotonic()
+        expired = [submission_uuid for submission_uuid, batch in self.batches.items()
+                   if now - batch.started >= self.batch_window_sec]
+        for submission_uuid in expired:
+            self.submit_batch(submission_uuid)
+
+        pending_notifications, self.pending_notifications = self.pending_notifications, []
+        for message, body_dict, attempts in pending_notifications:
+            self.notify(message, body_dict, attempts)
+
+        while True:
+            try:
+                message, body_dict, success = self.completed.get_nowait()
+            except queue.Empty:
+                return
+            self.complete(message, body_dict, success)
+
+    def complete(self, message: Message, body_dict: Optional[Dict], success: bool):
+        if not success:
+            self.logger.info(f'Rejecting message {str(message.delivery_tag)}')
+            message.reject(requeue=False)
+            return
+
+        self.notify(message, body_dict)
+
+    def notify(self, message: Message, body_dict: Dict, attempts: int = 0):
+        attempts += 1
+        try:
+            self.logger.info(f"Notifying state tracker of completed manifest: {body_dict}")
             self.notify_state_tracker(body_dict)
-            end = time.perf_counter()
-            time_to_export = end - start
-            self.logger.info('Finished! ' + str(message.delivery_tag))
-            self.logger.info('Export time (ms): ' + str(time_to_export))
\ No newline at end of file
+        except Exception as e:
+            if attempts < self.max_notify_attempts:
+                self.logger.warning(f'Failed to notify state tracker of completed manifest, attempt {attempts} of '
+                                    f'{self.max_notify_attempts}: {str(e)}')
+                self.pending_notifications.append((message, body_dict, attempts))
+            else:
+                # the manifest exists, so the message is not requeued, which would create it again
+                self.logger.exception(f'Failed to notify state tracker of completed manifest, rejecting message '
+                                      f'{str(message.delivery_tag)}: {str(e)}')
+                message.reject(requeue=False)
+            return
+
+        message.ack()
+        self.logger.info('Finished! ' + str(message.delivery_tag))
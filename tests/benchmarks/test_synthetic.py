@@ -0,0 +1,87 @@
+from unittest import TestCase
+
+from benchmarks.ingest import SyntheticIngestAPI
+from benchmarks.run import ExportBenchmark
+from benchmarks.synthetic import SubmissionSpec, SyntheticSubmission
+from exporter.graph.graph_crawler import GraphCrawler
+from exporter.metadata import MetadataService, MetadataResource
+
+
+class SyntheticSubmissionTest(TestCase):
+
+    def test_submission_shape(self):
+        # given:
+        spec = SubmissionSpec(donors=2, depth=2, fan_out=3, pooling=2, files_per_assay=4)
+
+        # when:
+        submission = SyntheticSubmission(spec)
+
+        # then: 2 donors x 3 x 3 cell suspensions, pooled 2 at a time
+        self.assertEqual(len(submission.assay_process_uuids), 9)
+
+    def test_generation_is_deterministic(self):
+        # expect:
+        self.assertEqual(SyntheticSubmission(SubmissionSpec(seed=1)).assay_process_uuids,
+                         SyntheticSubmission(SubmissionSpec(seed=1)).assay_process_uuids)
+
+    def test_crawl_assay(self):
+        # given:
+        spec = SubmissionSpec(donors=1, depth=2, fan_out=2, pooling=1, files_per_assay=3, protocols_per_process=1,
+                              protocol_pool_size=1, supplementary_files=2)
+        submission = SyntheticSubmission(spec)
+        ingest_api = SyntheticIngestAPI(submission)
+        crawler = GraphCrawler(MetadataService(ingest_api))
+
+        process = MetadataResource.from_dict(submission.get_entity('processes', submission.assay_process_uuids[0]))
+        project = MetadataResource.from_dict(submission.get_entity('projects', submission.project_uuid))
+
+        # when:
+        experiment_graph = crawler.generate_complete_experiment_graph(process, project)
+
+        # then: donor, 2 specimens, 2 cell suspensions (process outputs include siblings), 3 processes, 1 protocol,
+        # 3 files, project and 2 supplementary files
+        self.assertEqual(len(experiment_graph.nodes.get_nodes()), 15)
+        self.assertEqual(len(experiment_graph.links.get_links()), 4)
+
+    def test_crawl_with_large_projected_pages(self):
+        # given:
+        spec = SubmissionSpec(donors=1, depth=1, fan_out=2, pooling=1, files_per_assay=30)
+        submission = SyntheticSubmission(spec)
+        process = MetadataResource.from_dict(submission.get_entity('processes', submission.assay_process_uuids[0]))
+        project = MetadataResource.from_dict(submission.get_entity('projects', submission.project_uuid))
+
+        default_api = SyntheticIngestAPI(submission)
+        expected_graph = GraphCrawler(MetadataService(default_api)).generate_complete_experiment_graph(process, project)
+        projected_api = SyntheticIngestAPI(submission)
+        fallback_api = SyntheticIngestAPI(submission, projections=False)
+
+        # when:
+        projected_graph = GraphCrawler(MetadataService(projected_api, page_size=500, projection='exporter')) \
+            .generate_complete_experiment_graph(process, project)
+        fallback_graph = GraphCrawler(MetadataService(fallback_api, page_size=500, projection='exporter')) \
+            .generate_complete_experiment_graph(process, project)
+
+        # then:
+        for graph in [projected_graph, fallback_graph]:
+            self.assertEqual(graph.links.to_dict(), expected_graph.links.to_dict())
+            self.assertEqual([node.uuid for node in graph.nodes.get_nodes()],
+                             [node.uuid for node in expected_graph.nodes.get_nodes()])
+        self.assertLess(projected_api.total_requests(), default_api.total_requests())
+        self.assertLess(projected_api.response_bytes, default_api.response_bytes)
+
+
+class ExportBenchmarkTest(TestCase):
+
+    def test_run_reports_every_stage(self):
+        # given:
+        submission = SyntheticSubmission(SubmissionSpec(donors=1, depth=1, fan_out=2))
+        ingest_api = SyntheticIngestAPI(submission)
+        benchmark = ExportBenchmark(submission, ingest_api, trace_memory=False)
+
+        # when:
+        results = benchmark.run(['crawl', 'manifest'])
+
+        # then:
+        self.assertEqual(results['crawl'].assays, 2)
+        self.assertGreater(results['crawl'].requests, 0)
+        self.assertEqual(results['manifest'].requests_by_endpoint['POST /bundleManifests'], 2)
@@ -0,0 +1,77 @@
+from unittest import TestCase
+
+from exporter.graph.graph_core import ProcessGraph, UuidInterner
+
+
+class UuidInternerTest(TestCase):
+    def test_ids_are_dense_and_stable(self):
+        # given
+        interner = UuidInterner()
+
+        # when
+        ids = [interner.id_for(uuid) for uuid in ['a', 'b', 'a', 'c']]
+
+        # then
+        self.assertEqual(ids, [0, 1, 0, 2])
+        self.assertEqual(interner.uuid_of(2), 'c')
+        self.assertEqual(interner.get('d'), -1)
+        self.assertEqual(len(interner), 3)
+
+
+class ProcessGraphTest(TestCase):
+    def setUp(self):
+        # donor -(collection)-> specimen -(dissociation)-> cells -(assay)-> sequence files -(analysis)-> matrix
+        self.graph = ProcessGraph()
+        self.graph.add_process(('collection_process', 'collection'), [('donor_organism', 'donor')],
+                               [('specimen_from_organism', 'specimen')], [('collection_protocol', 'collection-protocol')])
+        self.graph.add_process(('dissociation_process', 'dissociation'), [('specimen_from_organism', 'specimen')],
+                               [('cell_suspension', 'cells')], [])
+        self.graph.add_process(('assay_process', 'assay'), [('cell_suspension', 'cells')],
+                               [('sequence_file', 'r1'), ('sequence_file', 'r2')], [('sequencing_protocol', 'seq')])
+        self.graph.add_process(('analysis_process', 'analysis'), [('sequence_file', 'r1'), ('sequence_file', 'r2')],
+                               [('analysis_file', 'matrix')], [])
+        self.graph.set_upstream('assay', ['dissociation'])
+        self.graph.set_upstream('dissociation', ['collection'])
+        self.graph.set_upstream('collection', [])
+        self.graph.set_downstream('assay', ['analysis'])
+        self.graph.set_downstream('analysis', [])
+
+    def test_experiment_processes__upstream_then_downstream(self):
+        # when
+        processes = self.graph.experiment_processes('assay')
+
+        # then
+        self.assertEqual(processes, ['assay', 'dissociation', 'collection', 'analysis'])
+
+    def test_experiment_processes__unknown_process(self):
+        self.assertEqual(self.graph.experiment_processes('unknown'), [])
+
+    def test_walk__visits_shared_ancestors_once_in_crawl_order(self):
+        # given
+        graph = ProcessGraph()
+        graph.set_upstream('pool', ['a', 'b'])
+        graph.set_upstream('a', ['shared'])
+        graph.set_upstream('b', ['shared', 'c'])
+        graph.set_upstream('shared', ['pool'])
+        graph.set_downstream('pool', [])
+
+        # when
+        processes = graph.experiment_processes('pool')
+
+        # then
+        self.assertEqual(processes, ['pool', 'a', 'shared', 'b', 'c'])
+
+    def test_process_link__serialises_like_crawled_links(self):
+        # when
+        link = self.graph.process_link('assay')
+
+        # then
+        self.assertEqual(link.to_dict(), {
+            "link_type": "process_link",
+            "process_id": "assay",
+            "process_type": "assay_process",
+            "inputs": [{"input_type": "cell_suspension", "input_id": "cells"}],
+            "outputs": [{"output_type": "sequence_file", "output_id": "r1"},
+                        {"output_type": "sequence_file", "output_id": "r2"}],
+            "protocols": [{"protocol_type": "sequencing_protocol", "protocol_id": "seq"}]
+        })
@@ -1,13 +1,14 @@
+from threading import Event
 from unittest import TestCase
 
 from ingest.api.ingestapi import IngestApi
-from exporter.graph.graph_crawler import GraphCrawler
+from exporter.graph.graph_crawler import GraphCrawler, CachingGraphCrawler
 from exporter.metadata import MetadataResource, MetadataService
 
 from tests.mocks.ingest import MockIngestAPI
 from tests.mocks.files import MockEntityFiles
 
-from mock import MagicMock
+from mock import MagicMock, Mock
 
 
 class GraphCrawlerTest(TestCase):
@@ -66,6 +67,59 @@ class GraphCrawlerTest(TestCase):
         self.assertEqual(len(experiment_graph.links.get_links()), len(expected_links.get('links', [])))
         self.assertEqual(experiment_graph.links.to_dict(), expected_links)
 
+    def test_caching_crawler_fetches_shared_metadata_once(self):
+        # given
+        ingest_client = self.mock_ingest
+        crawler = CachingGraphCrawler(MetadataService(ingest_client))
+
+        test_assay_process = MetadataResource.from_dict(self.mock_files.get_entity('processes', 'mock-assay-process'))
+        test_project = MetadataResource.from_dict(self.mock_files.get_entity('projects', 'mock-project'))
+        expected_graph = GraphCrawler(MetadataService(ingest_client)).generate_complete_experiment_graph(test_assay_process, test_project)
+
+        # when
+        first_graph = crawler.generate_complete_experiment_graph(test_assay_process, test_project)
+        requests_after_first_crawl = ingest_client.get.call_count
+        second_graph = crawler.generate_complete_experiment_graph(test_assay_process, test_project)
+
+        # then
+        self.assertEqual(ingest_client.get.call_count, requests_after_first_crawl)
+        self.assertEqual(first_graph.links.to_dict(), expected_graph.links.to_dict())
+        self.assertEqual(second_graph.links.to_dict(), expected_graph.links.to_dict())
+        self.assertEqual([node.uuid for node in second_graph.nodes.get_nodes()],
+                         [node.uuid for node in expected_graph.nodes.get_nodes()])
+
+    def test_linked_processes_are_looked_up_as_pages_arrive(self):
+        # given: a process whose second page of outputs is only served once the first page's outputs were followed
+        followed = Event()
+        outputs = [Mock(uuid=f'file-{i}') for i in range(3)]
+
+        def output_pages(relation, process, entity_type):
+            if relation == 'derivedFiles':
+                yield outputs[:2]
+                self.assertTrue(followed.wait(5))
+                yield outputs[2:]
+
+        def input_to_processes(material):
+            if material.uuid == 'file-1':
+                followed.set()
+            return [Mock(uuid=f'{material.uuid}-analysis')]
+
+        metadata_service = Mock(spec=MetadataService)
+        metadata_service.get_related.return_value = []
+        metadata_service.get_protocols.return_value = []
+        metadata_service.iter_related.side_effect = output_pages
+        metadata_service.get_input_to_processes.side_effect = input_to_processes
+        crawler = GraphCrawler(metadata_service)
+
+        # when
+        process_info = crawler.process_info(Mock(uuid='assay'), follow_outputs=True)
+        downstream = crawler._crawl_outputs(process_info)
+
+        # then
+        self.assertEqual([o.uuid for o in process_info.outputs], ['file-0', 'file-1', 'file-2'])
+        self.assertEqual([p.uuid for p in downstream], ['file-0-analysis', 'file-1-analysis', 'file-2-analysis'])
+        self.assertIsNone(process_info.upstream)
+
     def _get_nodes(self, expected_links):
         nodes = set()
         for link in expected_links.get('links', []):
@@ -0,0 +1,50 @@
+import json
+from unittest import TestCase
+
+from mock import MagicMock
+
+from exporter.graph.experiment_graph import LinkSet, ProcessLink, Input, Output, ProtocolLink, \
+    SupplementaryFileLink, SupplementedEntity, SupplementaryFile
+from exporter.graph.link_index import LinkIndex
+
+
+class LinkIndexTest(TestCase):
+    def setUp(self):
+        self.upstream_link = ProcessLink('upstream-process', 'process', [Input('donor_organism', 'donor')],
+                                         [Output('specimen_from_organism', 'specimen')],
+                                         [ProtocolLink('collection_protocol', 'protocol')])
+        self.supplementary_link = SupplementaryFileLink(SupplementedEntity('project', 'project-uuid'),
+                                                        [SupplementaryFile('supplementary_file', 'file-uuid')])
+        self.fields = {"describedBy": "links-url", "schema_version": "1.0.0", "schema_type": "links"}
+
+    def link_set(self, assay_uuid: str) -> LinkSet:
+        link_set = LinkSet()
+        link_set.add_links([self.upstream_link, self.supplementary_link,
+                            ProcessLink(assay_uuid, 'process', [Input('specimen_from_organism', 'specimen')],
+                                        [Output('sequence_file', f'{assay_uuid}-file')], [])])
+        return link_set
+
+    def test_links_json_matches_serialised_link_set(self):
+        # given
+        link_index = LinkIndex()
+        link_set = self.link_set('assay-1')
+
+        # when
+        links_json = link_index.links_json(link_set, self.fields)
+
+        # then
+        self.assertEqual(links_json, json.dumps(dict(link_set.to_dict(), **self.fields)))
+
+    def test_shared_links_are_serialised_once(self):
+        # given
+        link_index = LinkIndex()
+        link_index.links_json(self.link_set('assay-1'), self.fields)
+        self.upstream_link.to_dict = MagicMock(side_effect=AssertionError('serialised again'))
+
+        # when
+        links_json = link_index.links_json(self.link_set('assay-2'), self.fields)
+
+        # then
+        self.assertEqual(len(link_index), 4)
+        self.assertEqual([link["link_type"] for link in json.loads(links_json)["links"]],
+                         ["process_link", "supplementary_file_link", "process_link"])
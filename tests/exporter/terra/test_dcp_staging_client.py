@@ -0,0 +1,136 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import NamedTemporaryFile
+from threading import Event
+from unittest import TestCase
+
+from mock import MagicMock, patch
+
+from exporter.metadata import MetadataResource
+from exporter.schema import SchemaService
+from exporter.terra.dcp_staging_client import DcpStagingClient, StagedObjectRegistry
+from exporter.terra.gcs import GcsStorage
+from exporter.terra.serialization import DocumentRenderer
+from exporter.terra.validation import DocumentValidator
+from tests.mocks.files import MockEntityFiles
+
+
+class StagedObjectRegistryTest(TestCase):
+    def test_stage_writes_key_once(self):
+        # given
+        registry = StagedObjectRegistry()
+        write = MagicMock()
+
+        # when
+        first = registry.stage('key', write)
+        second = registry.stage('key', write)
+
+        # then
+        self.assertEqual((first, second), (True, False))
+        write.assert_called_once()
+        self.assertIn('key', registry)
+
+    def test_concurrent_stage_waits_for_writer(self):
+        # given
+        registry = StagedObjectRegistry()
+        write_started = Event()
+        release_write = Event()
+        waiting_write = MagicMock()
+
+        def slow_write():
+            write_started.set()
+            release_write.wait(5)
+
+        # when
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            writer = executor.submit(registry.stage, 'key', slow_write)
+            write_started.wait(5)
+            waiter = executor.submit(registry.stage, 'key', waiting_write)
+            self.assertFalse(waiter.done())
+            release_write.set()
+
+        # then
+        self.assertTrue(writer.result())
+        self.assertFalse(waiter.result())
+        waiting_write.assert_not_called()
+
+    def test_failed_write_is_retried_by_next_caller(self):
+        # given
+        registry = StagedObjectRegistry()
+        retried_write = MagicMock()
+
+        # when
+        with self.assertRaises(Exception):
+            registry.stage('key', MagicMock(side_effect=Exception('upload failed')))
+        staged = registry.stage('key', retried_write)
+
+        # then
+        self.assertTrue(staged)
+        retried_write.assert_called_once()
+
+
+class DcpStagingClientTest(TestCase):
+    def test_write_metadata_skips_objects_already_staged_for_project(self):
+        # given
+        gcs_storage = MagicMock(spec=GcsStorage)
+        staging_client = DcpStagingClient(gcs_storage, MagicMock(), MagicMock(spec=SchemaService), MagicMock())
+        files = MockEntityFiles(base_uri='http://mock-ingest-api/')
+        project = MetadataResource.from_dict(files.get_entity('projects', 'mock-project'))
+
+        # when
+        staging_client.write_metadata(project, 'project-uuid')
+        staging_client.write_metadata(project, 'project-uuid')
+        staging_client.write_metadata(project, 'other-project-uuid')
+
+        # then
+        self.assertEqual(gcs_storage.write.call_count, 2)
+
+
+class DcpStagingClientBuilderTest(TestCase):
+    def test_gcs_clients_are_created_on_first_use(self):
+        # given
+        with NamedTemporaryFile('w', suffix='.json') as key_file:
+            json.dump({"type": "service_account"}, key_file)
+            key_file.flush()
+
+            with patch('exporter.terra.dcp_staging_client.Credentials.from_service_account_info') as from_info, \
+                    patch('exporter.terra.dcp_staging_client.storage.Client') as storage_client, \
+                    patch('exporter.terra.gcs.googleapiclient.discovery.build') as discovery_build:
+                # when
+                builder = (DcpStagingClient.Builder()
+                           .with_gcs_info(key_file.name, 'project', 'bucket', 'prefix')
+                           .with_gcs_xfer(key_file.name, 'project', 'bucket', 'prefix', 'key-id', 'key-secret'))
+
+                # then
+                from_info.assert_called_once()
+                storage_client.assert_not_called()
+                self.assertIsNone(builder.gcs_xfer._client)
+
+                # when
+                builder.gcs_storage.gcs_client
+                builder.gcs_storage.gcs_client
+
+                # then
+                storage_client.assert_called_once_with(project='project', credentials=from_info.return_value)
+
+            # when
+            transfer_client = builder.gcs_xfer.client
+
+            # then
+            discovery_build.assert_not_called()
+            self.assertIs(builder.gcs_xfer.client, transfer_client)
+
+    def test_validator_requires_a_validating_renderer(self):
+        # given
+        builder = (DcpStagingClient.Builder()
+                   .with_gcs_storage(MagicMock(spec=GcsStorage))
+                   .with_gcs_xfer_storage(MagicMock())
+                   .with_schema_service(MagicMock(spec=SchemaService))
+                   .with_ingest_client(MagicMock())
+                   .with_validator(MagicMock(spec=DocumentValidator))
+                   .with_renderer(DocumentRenderer()))
+
+        # expect
+        with self.assertRaises(Exception):
+            builder.build()
+        self.assertIsNotNone(builder.with_renderer(DocumentRenderer(MagicMock(spec=DocumentValidator))).build())
@@ -0,0 +1,76 @@
+import io
+import tarfile
+import tempfile
+from io import StringIO
+from pathlib import Path
+from unittest import TestCase
+
+from mock import MagicMock
+
+from exporter.graph.experiment_graph import LinkSet
+from exporter.schema import SchemaService
+from exporter.terra.dcp_staging_client import DcpStagingClient
+from exporter.terra.dry_run import DryRunStorage, DryRunReport
+
+
+class DryRunStorageTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_write_to_directory(self):
+        # given
+        storage = DryRunStorage('prefix', root=self.tmp_dir.name)
+
+        # when
+        storage.write('project-uuid/metadata/donor_organism/uuid_version.json', StringIO('{"a": 1}'))
+        storage.write('project-uuid/metadata/donor_organism/uuid_version.json', StringIO('{"a": 1}'))
+        storage.write('project-uuid/links/process_version_project.json', StringIO('{}'))
+
+        # then
+        written = Path(self.tmp_dir.name) / 'prefix/project-uuid/metadata/donor_organism/uuid_version.json'
+        self.assertEqual(written.read_text(), '{"a": 1}')
+        self.assertTrue(storage.file_exists('project-uuid/links/process_version_project.json'))
+        self.assertEqual(storage.report.to_dict(), {
+            "objects": 2,
+            "bytes": 10,
+            "duplicates": 1,
+            "by_type": {
+                "links": {"objects": 1, "bytes": 2},
+                "metadata": {"objects": 1, "bytes": 8}
+            }
+        })
+        self.assertEqual(DryRunReport.for_directory(self.tmp_dir.name, 'prefix').to_dict()["by_type"],
+                         storage.report.to_dict()["by_type"])
+
+    def test_write_to_tar_stream(self):
+        # given
+        tar_stream = io.BytesIO()
+        storage = DryRunStorage('prefix', tar_stream=tar_stream)
+
+        # when
+        storage.write('project-uuid/descriptors/sequence_file/uuid_version.json', StringIO('{"size": 1}'))
+        storage.close()
+
+        # then
+        tar_stream.seek(0)
+        with tarfile.open(fileobj=tar_stream) as tar:
+            member = tar.extractfile('prefix/project-uuid/descriptors/sequence_file/uuid_version.json')
+            self.assertEqual(member.read(), b'{"size": 1}')
+
+    def test_staging_client_writes_links_to_dry_run_storage(self):
+        # given
+        storage = DryRunStorage('prefix', root=self.tmp_dir.name)
+        schema_service = MagicMock(spec=SchemaService)
+        schema_service.cached_latest_links_schema = MagicMock(return_value=MagicMock(schema_url='links-url', schema_version='1.0.0'))
+        staging_client = DcpStagingClient(storage, None, schema_service, MagicMock())
+
+        # when
+        staging_client.write_links(LinkSet(), 'process-uuid', 'version', 'project-uuid')
+
+        # then
+        links_path = Path(self.tmp_dir.name) / 'prefix/project-uuid/links/process-uuid_version_project-uuid.json'
+        self.assertTrue(links_path.exists())
+        self.assertEqual(storage.report.to_dict()["by_type"], {"links": {"objects": 1, "bytes": links_path.stat().st_size}})
@@ -0,0 +1,145 @@
+import gzip
+import tempfile
+from io import StringIO
+from pathlib import Path
+from threading import Thread
+from unittest import TestCase
+
+from google.api_core.exceptions import PreconditionFailed, ServiceUnavailable
+
+from exporter.terra.emulator import FaultInjection, LocalGcsClient, LocalTransferClient, LocalGcsXferStorage, \
+    InMemoryObjectStore, FilesystemObjectStore
+from exporter.terra.gcs import GcsStorage
+from exporter.terra.transfer_poller import TransferStatusPoller, TokenBucket
+
+
+class LocalGcsClientTest(TestCase):
+
+    def test_write_marks_object_complete(self):
+        # given:
+        gcs_client = LocalGcsClient()
+        gcs_storage = GcsStorage(gcs_client, 'mock-bucket', 'mock-prefix')
+
+        # when:
+        gcs_storage.write('project/metadata/doc.json', StringIO('{"a": 1}'))
+
+        # then:
+        self.assertTrue(gcs_storage.file_exists('project/metadata/doc.json'))
+        blob = gcs_client.bucket('mock-bucket').blob('mock-prefix/project/metadata/doc.json')
+        self.assertEqual(blob.download_as_bytes(), b'{"a": 1}')
+
+    def test_gzip_uploads_are_transcoded_for_readers(self):
+        # given:
+        gcs_client = LocalGcsClient()
+        gcs_storage = GcsStorage(gcs_client, 'mock-bucket', 'mock-prefix', gzip_uploads=True)
+        document = '{"describedBy": "https://schema.humancellatlas.org/type/file/2.5.0/sequence_file"}'
+
+        # when:
+        gcs_storage.write('project/metadata/doc.json', StringIO(document))
+
+        # then:
+        self.assertTrue(gcs_storage.file_exists('project/metadata/doc.json'))
+        blob = gcs_client.bucket('mock-bucket').blob('mock-prefix/project/metadata/doc.json')
+        self.assertEqual(blob.download_as_bytes(), document.encode())
+        self.assertEqual(gzip.decompress(blob.download_as_bytes(raw_download=True)), document.encode())
+        blob.reload()
+        self.assertEqual(blob.content_encoding, 'gzip')
+
+    def test_objects_are_listed_a_page_at_a_time(self):
+        # given:
+        gcs_client = LocalGcsClient()
+        for i in range(3):
+            gcs_client.bucket('mock-bucket').blob(f'mock-prefix/data/R{i}.fastq.gz').upload_from_string(b'read')
+
+        # when:
+        listing = gcs_client.list_blobs('mock-bucket', prefix='mock-prefix/data/', page_size=2)
+        pages = iter(listing.pages)
+        first_page = next(pages)
+        next_page_token = listing.next_page_token
+
+        # then:
+        self.assertEqual([blob.name for blob in first_page], ['mock-prefix/data/R0.fastq.gz', 'mock-prefix/data/R1.fastq.gz'])
+        self.assertIsNotNone(next_page_token)
+        self.assertEqual([blob.name for blob in next(pages)], ['mock-prefix/data/R2.fastq.gz'])
+        self.assertIsNone(listing.next_page_token)
+
+    def test_generation_precondition(self):
+        # given:
+        store = InMemoryObjectStore()
+        store.create('mock-bucket', 'key', b'data', if_generation_match=0)
+
+        # expect:
+        with self.assertRaises(PreconditionFailed):
+            store.create('mock-bucket', 'key', b'other-data', if_generation_match=0)
+
+    def test_concurrent_writers_race_on_the_same_object(self):
+        # given:
+        gcs_client = LocalGcsClient(faults=FaultInjection(latency_sec=0.05))
+        gcs_storage = GcsStorage(gcs_client, 'mock-bucket', 'mock-prefix')
+
+        # when:
+        writers = [Thread(target=lambda: gcs_storage.write('key.json', StringIO('{}'))) for _ in range(3)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join(10)
+
+        # then:
+        self.assertTrue(gcs_storage.file_exists('key.json'))
+        self.assertEqual(len(gcs_client.store.list('mock-bucket')), 1)
+
+    def test_failure_injection(self):
+        # given:
+        gcs_client = LocalGcsClient(faults=FaultInjection(failure_rate=1, failing_operations={'upload'}))
+        gcs_storage = GcsStorage(gcs_client, 'mock-bucket', 'mock-prefix')
+
+        # expect:
+        with self.assertRaises(ServiceUnavailable):
+            gcs_storage.write('key.json', StringIO('{}'))
+
+    def test_filesystem_store_persists_objects(self):
+        with tempfile.TemporaryDirectory() as storage_root:
+            # given:
+            gcs_storage = GcsStorage(LocalGcsClient(FilesystemObjectStore(storage_root)), 'mock-bucket', 'mock-prefix')
+
+            # when:
+            gcs_storage.write('project/links/links.json', StringIO('{"links": []}'))
+
+            # then:
+            self.assertEqual((Path(storage_root) / 'mock-bucket/mock-prefix/project/links/links.json').read_text(),
+                             '{"links": []}')
+            reopened_storage = GcsStorage(LocalGcsClient(FilesystemObjectStore(storage_root)), 'mock-bucket', 'mock-prefix')
+            self.assertTrue(reopened_storage.file_exists('project/links/links.json'))
+
+
+class LocalTransferClientTest(TestCase):
+
+    def test_transfer_upload_area(self):
+        with tempfile.TemporaryDirectory() as s3_root:
+            # given:
+            upload_area = Path(s3_root) / 'upload-bucket' / 'upload-area-uuid'
+            upload_area.mkdir(parents=True)
+            (upload_area / 'R1.fastq.gz').write_bytes(b'ACGT')
+            (upload_area / 'R2.fastq.gz').write_bytes(b'TGCA')
+
+            gcs_client = LocalGcsClient()
+            transfer_client = LocalTransferClient(s3_root, gcs_client)
+            status_poller = TransferStatusPoller(lambda: transfer_client, 'mock-project', interval_sec=0.05,
+                                                 rate_limiter=TokenBucket(100, 100))
+            gcs_xfer = LocalGcsXferStorage(transfer_client, 'key-id', 'key-secret', 'mock-project', 'mock-bucket',
+                                           'mock-prefix', status_poller)
+
+            # when:
+            transfer_job_spec, success = gcs_xfer.transfer_upload_area('upload-bucket', 'upload-area-uuid',
+                                                                      'project-uuid', 'export-job-id')
+            gcs_xfer.wait_for_job_to_complete(transfer_job_spec.name, 5)
+
+            # then:
+            self.assertTrue(success)
+            self.assertEqual([key for key, _ in gcs_client.store.list('mock-bucket')],
+                             ['mock-prefix/project-uuid/data/R1.fastq.gz', 'mock-prefix/project-uuid/data/R2.fastq.gz'])
+
+            # and: a second job for the same export job conflicts
+            _, second_success = gcs_xfer.transfer_upload_area('upload-bucket', 'upload-area-uuid',
+                                                              'project-uuid', 'export-job-id')
+            self.assertFalse(second_success)
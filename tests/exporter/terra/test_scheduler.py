@@ -0,0 +1,104 @@
+import time
+from unittest import TestCase
+
+from mock import MagicMock
+
+from exporter.terra.scheduler import FairScheduler, size_priority
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class FairSchedulerTest(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_small_submission_is_not_blocked_by_large_one(self):
+        # given
+        scheduler = FairScheduler(workers=4, max_per_submission=3, clock=self.clock)
+        for i in range(100):
+            scheduler.submit('large', MagicMock(name=f'large-{i}'), size_priority(5000))
+        scheduler.submit('small', MagicMock(name='small-0'), size_priority(3))
+
+        # when
+        first = scheduler.next_task()
+
+        # then
+        self.assertEqual(first[0], 'small')
+
+    def test_submissions_share_workers(self):
+        # given
+        scheduler = FairScheduler(workers=4, max_per_submission=3, clock=self.clock)
+        for i in range(10):
+            scheduler.submit('submission-a', MagicMock())
+            scheduler.submit('submission-b', MagicMock())
+
+        # when
+        dispatched = [scheduler.next_task()[0] for _ in range(4)]
+
+        # then
+        self.assertEqual(sorted(dispatched), ['submission-a', 'submission-a', 'submission-b', 'submission-b'])
+
+    def test_max_per_submission(self):
+        # given
+        scheduler = FairScheduler(workers=4, max_per_submission=2, clock=self.clock)
+        for i in range(10):
+            scheduler.submit('large', MagicMock())
+
+        # when
+        dispatched = [scheduler.next_task() for _ in range(3)]
+
+        # then
+        self.assertIsNotNone(dispatched[1])
+        self.assertIsNone(dispatched[2])
+
+        # when
+        scheduler.task_done('large')
+
+        # then
+        self.assertEqual(scheduler.next_task()[0], 'large')
+
+    def test_waiting_submission_ages_past_higher_priority(self):
+        # given
+        scheduler = FairScheduler(workers=2, max_per_submission=2, aging_sec=100, clock=self.clock)
+        scheduler.submit('low', MagicMock(), priority=-1)
+        for i in range(10):
+            scheduler.submit('high', MagicMock(), priority=0)
+
+        # when
+        for now in [0, 50, 90]:
+            self.clock.now = now
+            self.assertEqual(scheduler.next_task()[0], 'high')
+            scheduler.task_done('high')
+        self.clock.now = 130
+
+        # then
+        self.assertEqual(scheduler.next_task()[0], 'low')
+
+    def test_workers_run_tasks(self):
+        # given
+        scheduler = FairScheduler(workers=2).start()
+        task = MagicMock()
+        failing_task = MagicMock(side_effect=Exception('export failed'))
+
+        # when
+        scheduler.submit('submission', failing_task)
+        scheduler.submit('submission', task)
+        for _ in range(100):
+            if task.called and not scheduler.pending():
+                break
+            time.sleep(0.01)
+
+        # then
+        task.assert_called_once()
+        failing_task.assert_called_once()
+
+    def test_size_priority(self):
+        self.assertEqual(size_priority(3), 0)
+        self.assertEqual(size_priority(50), -1)
+        self.assertEqual(size_priority(5000), -3)
@@ -0,0 +1,115 @@
+from typing import Dict
+from unittest import TestCase
+
+from mock import MagicMock
+
+from ingest.api.ingestapi import IngestApi
+
+from exporter.graph.graph_crawler import GraphCrawler
+from exporter.metadata import MetadataResource, MetadataService
+from exporter.schema import SchemaResource, SchemaService
+from exporter.terra.dcp_staging_client import DcpStagingClient
+from exporter.terra.emulator import LocalGcsClient
+from exporter.terra.gcs import GcsStorage
+from exporter.terra.serialization import DocumentRenderer, ProcessPoolRenderer
+from exporter.terra.validation import DocumentValidationException, DocumentValidator, SchemaCache
+from tests.mocks.files import MockEntityFiles
+from tests.mocks.ingest import MockIngestAPI
+
+
+def strict_schema(url: str) -> Dict:
+    # every document lacks a field required by this schema
+    return {"$schema": "http://json-schema.org/draft-07/schema#", "type": "object", "required": ["describedBy", "missing"]}
+
+
+class DocumentRendererTest(TestCase):
+    def setUp(self):
+        self.mock_files = MockEntityFiles(base_uri='http://mock-ingest-api/')
+        ingest_client = MagicMock(spec=IngestApi, wraps=MockIngestAPI(mock_entity_retriever=self.mock_files))
+        process = MetadataResource.from_dict(self.mock_files.get_entity('processes', 'mock-assay-process'))
+        project = MetadataResource.from_dict(self.mock_files.get_entity('projects', 'mock-project'))
+        self.nodes = GraphCrawler(MetadataService(ingest_client)).generate_complete_experiment_graph(process, project).nodes
+
+        self.schema_service = MagicMock(spec=SchemaService)
+        self.schema_service.cached_latest_file_descriptor_schema.return_value = SchemaResource('file-descriptor-url', '2.0.0')
+
+    def stage(self, renderer=None) -> Dict[str, bytes]:
+        gcs_client = LocalGcsClient()
+        staging_client = DcpStagingClient(GcsStorage(gcs_client, 'bucket', 'prefix'), MagicMock(), self.schema_service,
+                                          MagicMock(), renderer=renderer)
+        staging_client.write_metadatas(self.nodes.iter_nodes(), 'project-uuid')
+        return dict((key, gcs_client.bucket('bucket').blob(key).download_as_bytes())
+                    for key, _ in gcs_client.store.list('bucket'))
+
+    def test_rendered_documents_match_documents_written_in_thread(self):
+        # given
+        expected = self.stage()
+
+        # when
+        rendered = self.stage(DocumentRenderer())
+
+        # then
+        self.assertEqual(rendered, expected)
+        self.assertTrue(any('/descriptors/' in key for key in rendered))
+
+    def test_process_pool_renders_the_same_documents(self):
+        # given
+        expected = self.stage()
+        renderer = ProcessPoolRenderer(2, chunk_size=2)
+
+        # when
+        try:
+            rendered = self.stage(renderer)
+        finally:
+            renderer.close()
+
+        # then
+        self.assertEqual(rendered, expected)
+
+    def test_rendering_leaves_nodes_unchanged(self):
+        # when
+        self.stage(DocumentRenderer())
+
+        # then
+        self.assertTrue(all("provenance" not in node.full_resource["content"] for node in self.nodes.iter_nodes()))
+
+    def test_process_pool_validates_documents(self):
+        # given
+        with self.assertRaises(DocumentValidationException) as in_thread:
+            self.stage(DocumentRenderer(DocumentValidator(SchemaCache(strict_schema))))
+        renderer = ProcessPoolRenderer(2, chunk_size=2, validate=True, fetch=strict_schema)
+
+        # when
+        try:
+            with self.assertRaises(DocumentValidationException) as in_pool:
+                self.stage(renderer)
+        finally:
+            renderer.close()
+
+        # then
+        self.assertEqual(in_pool.exception.errors, in_thread.exception.errors)
+        # one error for each metadata document and file descriptor
+        nodes = list(self.nodes.iter_nodes())
+        self.assertEqual(len(in_pool.exception.errors), len(nodes) + len([n for n in nodes if n.metadata_type == "file"]))
+
+    def test_documents_are_uploaded_as_they_are_rendered(self):
+        # given
+        events = []
+
+        class RecordingRenderer(DocumentRenderer):
+            def render(self, payloads):
+                for rendered_node in super().render(payloads):
+                    events.append('render')
+                    yield rendered_node
+
+        gcs_storage = MagicMock(spec=GcsStorage)
+        gcs_storage.write = MagicMock(side_effect=lambda *args: events.append('write'))
+        staging_client = DcpStagingClient(gcs_storage, MagicMock(), self.schema_service, MagicMock(),
+                                          renderer=RecordingRenderer())
+
+        # when
+        staging_client.write_metadatas(self.nodes.iter_nodes(), 'project-uuid')
+
+        # then
+        self.assertEqual(events[:2], ['render', 'write'])
+        self.assertEqual(events.count('render'), len(list(self.nodes.iter_nodes())))
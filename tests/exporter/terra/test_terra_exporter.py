@@ -0,0 +1,19 @@
+from unittest import TestCase
+
+from mock import MagicMock
+
+from exporter.terra.terra_exporter import TerraExporter
+
+
+class TerraExporterTest(TestCase):
+
+    def test_link_indexes_are_kept_per_export_job(self):
+        # given:
+        exporter = TerraExporter(MagicMock(), MagicMock(), MagicMock(), MagicMock(), MagicMock())
+
+        # when:
+        first_job_index = exporter.link_index_for('export-job-1')
+
+        # then: assays of the same job share an index, a new export of the submission starts afresh
+        self.assertIs(exporter.link_index_for('export-job-1'), first_job_index)
+        self.assertIsNot(exporter.link_index_for('export-job-2'), first_job_index)
@@ -0,0 +1,64 @@
+import json
+from unittest import TestCase
+
+from mock import MagicMock, patch
+
+from exporter.amqp import QueueConfig
+from exporter.terra.scheduler import FairScheduler
+from exporter.terra.terra_listener import _TerraListener
+
+
+class TerraListenerTest(TestCase):
+    def setUp(self):
+        self.publish_queue_config = QueueConfig(None, 'routing-key', 'exchange', 'topic', True, None)
+        self.body = json.dumps({
+            "documentId": "process-id",
+            "documentUuid": "process-uuid",
+            "envelopeUuid": "submission-uuid",
+            "index": 0,
+            "total": 3,
+            "exportJobId": "job-id"
+        })
+
+    def test_scheduled_message_is_acked_on_consumer_thread(self):
+        # given
+        scheduler = FairScheduler(workers=1)
+        terra_exporter = MagicMock()
+        job_service = MagicMock()
+        listener = _TerraListener(MagicMock(), terra_exporter, job_service, MagicMock(), self.publish_queue_config,
+                                  None, scheduler=scheduler, prefetch_count=10)
+        producer = MagicMock()
+        msg = MagicMock()
+
+        # when
+        listener.experiment_message_handler(self.body, msg)
+        submission_uuid, task = scheduler.next_task()
+        task()
+
+        # then
+        self.assertEqual(submission_uuid, 'submission-uuid')
+        terra_exporter.export.assert_called_once_with('process-uuid', 'submission-uuid', 'job-id')
+        job_service.create_export_entity.assert_called_once_with('job-id', 'process-id')
+        msg.ack.assert_not_called()
+
+        # when
+        with patch.object(_TerraListener, 'producer', producer):
+            listener.on_iteration()
+
+        # then
+        producer.publish.assert_called_once()
+        msg.ack.assert_called_once()
+
+    def test_unparseable_scheduled_message_is_rejected(self):
+        # given
+        scheduler = FairScheduler(workers=1)
+        listener = _TerraListener(MagicMock(), MagicMock(), MagicMock(), MagicMock(), self.publish_queue_config,
+                                  None, scheduler=scheduler, prefetch_count=10)
+        msg = MagicMock()
+
+        # when
+        listener.experiment_message_handler('{"documentUuid": "process-uuid"}', msg)
+
+        # then
+        msg.reject.assert_called_once_with(requeue=False)
+        msg.ack.assert_not_called()
@@ -0,0 +1,157 @@
+import json
+from threading import Thread
+from unittest import TestCase
+
+import polling
+from mock import MagicMock
+
+from exporter.terra.transfer_poller import TokenBucket, TransferStatusPoller
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TokenBucketTest(TestCase):
+
+    def test_tokens_exhausted_then_refilled(self):
+        # given:
+        clock = FakeClock()
+        bucket = TokenBucket(rate=2, capacity=2, clock=clock)
+
+        # expect:
+        self.assertTrue(bucket.try_acquire())
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+
+        # when:
+        clock.now += 0.5
+
+        # then:
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+
+    def test_refill_is_capped_at_capacity(self):
+        # given:
+        clock = FakeClock()
+        bucket = TokenBucket(rate=10, capacity=3, clock=clock)
+
+        # when:
+        clock.now += 100
+
+        # then:
+        self.assertTrue(all(bucket.try_acquire() for _ in range(3)))
+        self.assertFalse(bucket.try_acquire())
+
+
+class TransferStatusPollerTest(TestCase):
+
+    @staticmethod
+    def mock_transfer_client(operations_pages):
+        client = MagicMock()
+        operations_api = client.transferOperations.return_value
+        requests = []
+        for page in operations_pages:
+            request = MagicMock()
+            request.execute.return_value = page
+            requests.append(request)
+        operations_api.list.return_value = requests[0]
+        operations_api.list_next.side_effect = requests[1:] + [None]
+        return client
+
+    def test_poll_lists_all_active_jobs_in_one_filtered_request(self):
+        # given:
+        client = self.mock_transfer_client([{"operations": []}])
+        poller = TransferStatusPoller(lambda: client, "mock-project", rate_limiter=TokenBucket(100, 100))
+        poller._ensure_poller_started = MagicMock()
+        poller._register("transferJobs/job-1")
+        poller._register("transferJobs/job-2")
+
+        # when:
+        poller.poll()
+
+        # then:
+        client.transferOperations.return_value.list.assert_called_once()
+        list_filter = json.loads(client.transferOperations.return_value.list.call_args[1]["filter"])
+        self.assertEqual(list_filter["project_id"], "mock-project")
+        self.assertEqual(set(list_filter["job_names"]), {"transferJobs/job-1", "transferJobs/job-2"})
+
+    def test_poll_marks_done_jobs_across_pages(self):
+        # given:
+        client = self.mock_transfer_client([
+            {"operations": [{"done": True, "metadata": {"transferJobName": "transferJobs/job-1"}}]},
+            {"operations": [{"done": False, "metadata": {"transferJobName": "transferJobs/job-2"}}]}
+        ])
+        poller = TransferStatusPoller(lambda: client, "mock-project", rate_limiter=TokenBucket(100, 100))
+        poller._ensure_poller_started = MagicMock()
+        job_1 = poller._register("transferJobs/job-1")
+        job_2 = poller._register("transferJobs/job-2")
+
+        # when:
+        poller.poll()
+
+        # then:
+        self.assertTrue(job_1.done.is_set())
+        self.assertFalse(job_2.done.is_set())
+        self.assertEqual(poller.active_job_names(), ["transferJobs/job-2"])
+
+    def test_waiters_of_the_same_job_share_a_single_lookup(self):
+        # given:
+        client = self.mock_transfer_client([
+            {"operations": [{"done": True, "metadata": {"transferJobName": "transferJobs/job-1"}}]}
+        ])
+        poller = TransferStatusPoller(lambda: client, "mock-project", interval_sec=0.1,
+                                      rate_limiter=TokenBucket(100, 100))
+
+        # when:
+        waiters = [Thread(target=lambda: poller.wait_for_job("transferJobs/job-1", 5)) for _ in range(5)]
+        for waiter in waiters:
+            waiter.start()
+        for waiter in waiters:
+            waiter.join(5)
+
+        # then:
+        self.assertTrue(all(not waiter.is_alive() for waiter in waiters))
+        self.assertEqual(client.transferOperations.return_value.list.call_count, 1)
+        self.assertEqual(poller.active_job_names(), [])
+
+    def test_wait_for_job_times_out(self):
+        # given:
+        client = MagicMock()
+        poller = TransferStatusPoller(lambda: client, "mock-project", interval_sec=10)
+
+        # expect:
+        with self.assertRaises(polling.TimeoutException):
+            poller.wait_for_job("transferJobs/job-1", 0.1)
+        self.assertEqual(poller.active_job_names(), [])
+
+    def test_wait_for_job_fails_after_consecutive_poll_failures(self):
+        # given:
+        client = MagicMock()
+        client.transferOperations.side_effect = PermissionError('403 Forbidden')
+        poller = TransferStatusPoller(lambda: client, "mock-project", interval_sec=0.01,
+                                      rate_limiter=TokenBucket(100, 100), max_consecutive_failures=3)
+
+        # expect:
+        with self.assertRaises(PermissionError):
+            poller.wait_for_job("transferJobs/job-1", 5)
+        self.assertEqual(client.transferOperations.call_count, 3)
+        self.assertEqual(poller.active_job_names(), [])
+
+    def test_wait_for_job_survives_transient_poll_failure(self):
+        # given:
+        client = self.mock_transfer_client([{"operations": [
+            {"done": True, "metadata": {"transferJobName": "transferJobs/job-1"}}
+        ]}])
+        operations_api = client.transferOperations.return_value
+        client.transferOperations.side_effect = [ConnectionError('reset'), operations_api]
+        poller = TransferStatusPoller(lambda: client, "mock-project", interval_sec=0.01,
+                                      rate_limiter=TokenBucket(100, 100), max_consecutive_failures=3)
+
+        # expect:
+        poller.wait_for_job("transferJobs/job-1", 5)
+        self.assertEqual(client.transferOperations.call_count, 2)
@@ -0,0 +1,156 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+
+from mock import MagicMock
+
+from exporter.graph.experiment_graph import ExperimentGraph
+from exporter.metadata import MetadataResource
+from exporter.schema import SchemaResource, SchemaService
+from exporter.terra.dcp_staging_client import DcpStagingClient
+from exporter.terra.gcs import GcsStorage
+from exporter.terra.terra_exporter import TerraExporter
+from exporter.terra.validation import DocumentValidationException, DocumentValidator, SchemaCache
+
+CORE_URL = 'https://schema.humancellatlas.org/core/biomaterial/1.0.0/biomaterial_core'
+DONOR_URL = 'https://schema.humancellatlas.org/type/biomaterial/1.0.0/donor_organism'
+SPECIMEN_URL = 'https://schema.humancellatlas.org/type/biomaterial/1.0.0/specimen_from_organism'
+LINKS_URL = 'https://schema.humancellatlas.org/system/3.0.0/links'
+
+SCHEMAS = {
+    CORE_URL: {
+        "$schema": "http://json-schema.org/draft-07/schema#",
+        "type": "object",
+        "required": ["biomaterial_id"],
+        "properties": {"biomaterial_id": {"type": "string"}}
+    },
+    DONOR_URL: {
+        "$schema": "http://json-schema.org/draft-07/schema#",
+        "type": "object",
+        "required": ["describedBy", "biomaterial_core"],
+        "properties": {"biomaterial_core": {"$ref": "../../../core/biomaterial/1.0.0/biomaterial_core"}}
+    },
+    SPECIMEN_URL: {
+        "$schema": "http://json-schema.org/draft-07/schema#",
+        "type": "object",
+        "required": ["describedBy", "biomaterial_core"],
+        "properties": {"biomaterial_core": {"$ref": CORE_URL}}
+    },
+    LINKS_URL: {
+        "$schema": "http://json-schema.org/draft-07/schema#",
+        "type": "object",
+        "required": ["describedBy", "links"],
+        "properties": {"links": {"type": "array", "minItems": 1}}
+    }
+}
+
+
+class DocumentValidatorTest(TestCase):
+
+    def test_validates_against_referenced_schemas(self):
+        # given:
+        validator = DocumentValidator(SchemaCache(SCHEMAS.__getitem__))
+
+        # when:
+        valid = validator.errors({"describedBy": DONOR_URL, "biomaterial_core": {"biomaterial_id": "donor_1"}})
+        invalid = validator.errors({"describedBy": DONOR_URL, "biomaterial_core": {"biomaterial_id": 1}})
+
+        # then:
+        self.assertEqual(valid, [])
+        self.assertEqual(len(invalid), 1)
+        self.assertIn('biomaterial_core/biomaterial_id', invalid[0])
+
+    def test_schemas_are_fetched_and_compiled_once(self):
+        # given:
+        fetch = MagicMock(side_effect=SCHEMAS.__getitem__)
+        validator = DocumentValidator(SchemaCache(fetch))
+        documents = [{"describedBy": url, "biomaterial_core": {"biomaterial_id": f'biomaterial_{i}'}}
+                     for i in range(50) for url in [DONOR_URL, SPECIMEN_URL]]
+
+        # when:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            errors = list(executor.map(validator.errors, documents))
+
+        # then: the core schema is shared by both types
+        self.assertEqual(errors, [[]] * len(documents))
+        self.assertEqual(sorted(call[0][0] for call in fetch.call_args_list), sorted([CORE_URL, DONOR_URL, SPECIMEN_URL]))
+        self.assertIs(validator.validator_for(DONOR_URL), validator.validator_for(DONOR_URL))
+
+    def test_prefetched_schemas_are_not_fetched_again(self):
+        # given:
+        schema_service = SchemaService(MagicMock())
+        schema_service.schema_urls = MagicMock(return_value=[DONOR_URL, SPECIMEN_URL, 'https://unknown/schema'])
+        fetch = MagicMock(side_effect=SCHEMAS.__getitem__)
+        validator = DocumentValidator(SchemaCache(fetch)).prefetch(schema_service.schema_urls())
+        fetch.reset_mock()
+
+        # when:
+        errors = validator.errors({"describedBy": SPECIMEN_URL, "biomaterial_core": {"biomaterial_id": "specimen"}})
+        worker_validator = DocumentValidator(SchemaCache(fetch, validator.schema_cache.documents()))
+        worker_errors = worker_validator.errors({"describedBy": DONOR_URL, "biomaterial_core": {"biomaterial_id": 1}})
+
+        # then: a schema that failed to prefetch does not stop the others
+        self.assertEqual(errors, [])
+        self.assertEqual(len(worker_errors), 1)
+        fetch.assert_not_called()
+
+    def test_document_without_schema_is_invalid(self):
+        # given:
+        validator = DocumentValidator(SchemaCache(SCHEMAS.__getitem__))
+
+        # expect:
+        with self.assertRaises(DocumentValidationException):
+            validator.validate({"biomaterial_core": {"biomaterial_id": "donor_1"}})
+
+
+class StagingValidationTest(TestCase):
+
+    def test_invalid_documents_are_not_uploaded(self):
+        # given:
+        gcs_storage = MagicMock(spec=GcsStorage)
+        validator = DocumentValidator(SchemaCache(SCHEMAS.__getitem__))
+        staging_client = DcpStagingClient(gcs_storage, MagicMock(), MagicMock(spec=SchemaService), MagicMock(),
+                                          validator=validator)
+        donors = [self.donor('valid-donor', 'donor_1'), self.donor('invalid-donor', None)]
+
+        # when:
+        with self.assertRaises(DocumentValidationException) as raised:
+            staging_client.write_metadatas(donors, 'project-uuid')
+
+        # then:
+        self.assertEqual(len(raised.exception.errors), 1)
+        self.assertIn('invalid-donor', raised.exception.errors[0])
+        gcs_storage.write.assert_not_called()
+
+    def test_nothing_is_uploaded_if_links_are_invalid(self):
+        # given: an assay with valid metadata but no links
+        gcs_storage = MagicMock(spec=GcsStorage)
+        schema_service = MagicMock(spec=SchemaService)
+        schema_service.cached_latest_links_schema = MagicMock(return_value=SchemaResource(LINKS_URL, '3.0.0'))
+        staging_client = DcpStagingClient(gcs_storage, MagicMock(), schema_service, MagicMock(),
+                                          validator=DocumentValidator(SchemaCache(SCHEMAS.__getitem__)))
+        experiment_graph = ExperimentGraph()
+        experiment_graph.nodes.add_nodes([self.donor('valid-donor', 'donor_1')])
+        graph_crawler = MagicMock()
+        graph_crawler.generate_complete_experiment_graph = MagicMock(return_value=experiment_graph)
+        exporter = TerraExporter(MagicMock(), MagicMock(), graph_crawler, staging_client, MagicMock())
+        exporter.get_process = MagicMock(return_value=MagicMock(uuid='process-uuid', dcp_version='1'))
+        exporter.project_for_process = MagicMock(return_value=MagicMock(uuid='project-uuid'))
+
+        # when:
+        with self.assertRaises(DocumentValidationException) as raised:
+            exporter.export_metadata('process-uuid')
+
+        # then:
+        self.assertIn(LINKS_URL, raised.exception.errors[0])
+        gcs_storage.write.assert_not_called()
+
+    @staticmethod
+    def donor(uuid: str, biomaterial_id) -> MetadataResource:
+        return MetadataResource.from_dict({
+            "uuid": {"uuid": uuid},
+            "content": {"describedBy": DONOR_URL, "biomaterial_core": {"biomaterial_id": biomaterial_id}},
+            "dcpVersion": "2020-01-01T00:00:00.000Z",
+            "type": "Biomaterial",
+            "submissionDate": "2020-01-01T00:00:00.000Z",
+            "updateDate": "2020-01-01T00:00:00.000Z"
+        })
@@ -0,0 +1,76 @@
+from unittest import TestCase
+
+import google_crc32c
+from mock import patch
+
+from exporter import metrics
+from exporter.metadata import DataFile, FileChecksums
+from exporter.terra.emulator import LocalGcsClient
+from exporter.terra.gcs import GcsStorage
+from exporter.terra.verification import DataFileVerifier, crc32c_hex
+
+
+def data_file(file_name: str, data: bytes) -> DataFile:
+    crc32c = google_crc32c.Checksum(data).hexdigest().decode()
+    return DataFile(f'{file_name}-uuid', '2020-01-01T00:00:00.000Z', file_name,
+                    f's3://upload-bucket/upload-area/{file_name}', 'application/gzip', len(data),
+                    FileChecksums('sha256', crc32c.upper(), 'sha1', 's3_etag'))
+
+
+class DataFileVerifierTest(TestCase):
+    def setUp(self):
+        self.gcs_client = LocalGcsClient()
+        self.gcs_storage = GcsStorage(self.gcs_client, 'bucket', 'prefix')
+        self.verifier = DataFileVerifier(self.gcs_storage)
+
+    def transfer(self, project_uuid: str, file_name: str, data: bytes):
+        self.gcs_client.bucket('bucket').blob(f'prefix/{project_uuid}/data/{file_name}').upload_from_string(data)
+
+    def test_reports_missing_and_mismatched_files(self):
+        # given:
+        self.transfer('project-uuid', 'R1.fastq.gz', b'read 1')
+        self.transfer('project-uuid', 'R2.fastq.gz', b'read 2, truncated')
+        self.transfer('other-project-uuid', 'I1.fastq.gz', b'index 1')
+        data_files = [data_file('R1.fastq.gz', b'read 1'), data_file('R2.fastq.gz', b'read 2'),
+                      data_file('I1.fastq.gz', b'index 1')]
+
+        # when:
+        report = self.verifier.verify('project-uuid', data_files)
+
+        # then:
+        self.assertFalse(report.ok)
+        self.assertEqual(report.checked, 3)
+        self.assertEqual(report.missing, ['I1.fastq.gz'])
+        self.assertEqual([mismatch.file_name for mismatch in report.mismatched], ['R2.fastq.gz'])
+        self.assertEqual(report.mismatched[0].expected.size, len(b'read 2'))
+
+    def test_data_prefix_is_listed_once_per_key(self):
+        # given:
+        self.transfer('project-uuid', 'R1.fastq.gz', b'read 1')
+
+        # when:
+        with patch.object(self.gcs_client, 'list_blobs', wraps=self.gcs_client.list_blobs) as list_blobs:
+            first = self.verifier.verify('project-uuid', [data_file('R1.fastq.gz', b'read 1')], index_key='job-1')
+            second = self.verifier.verify('project-uuid', [data_file('R1.fastq.gz', b'read 1')], index_key='job-1')
+
+        # then:
+        self.assertTrue(first.ok and second.ok)
+        list_blobs.assert_called_once()
+
+    def test_data_prefix_is_listed_through_gcs_storage(self):
+        # given:
+        for i in range(3):
+            self.transfer('project-uuid', f'R{i}.fastq.gz', b'read')
+        before = metrics.registry.counter_value('gcs_requests_total', {"operation": "list"})
+
+        # when:
+        index = self.verifier.index('project-uuid')
+
+        # then: a page of the listing is one counted, rate-limited request
+        self.assertEqual(sorted(index.keys()), ['R0.fastq.gz', 'R1.fastq.gz', 'R2.fastq.gz'])
+        self.assertEqual(metrics.registry.counter_value('gcs_requests_total', {"operation": "list"}) - before, 1)
+
+    def test_crc32c_hex(self):
+        # expect: GCS reports crc32c as base64 of the big-endian checksum
+        self.assertEqual(crc32c_hex('AAAAAA=='), '00000000')
+        self.assertEqual(crc32c_hex('yZRlqg=='), 'c99465aa')
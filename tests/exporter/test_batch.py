@@ -0,0 +1,91 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from mock import MagicMock
+
+from exporter.batch import AssayProcess, BatchExport, Checkpoint, assay_processes
+
+
+def _process(uuid: str) -> dict:
+    return {'uuid': {'uuid': uuid}, '_links': {'self': {'href': f'http://ingest/processes/id-{uuid}'}}}
+
+
+def _tasks(modes, failing_uuid):
+    def export(process: AssayProcess):
+        if process.uuid == failing_uuid:
+            raise Exception('export failed')
+
+    return dict((mode, export) for mode in modes)
+
+
+class BatchExportTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.checkpoint_path = os.path.join(self.tmp_dir.name, 'checkpoint.jsonl')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_assay_processes(self):
+        # given
+        ingest_api = MagicMock()
+        ingest_api.get_related_entities = MagicMock(return_value=iter([_process('assay'), _process('library-prep')]))
+        ingest_api.get_related_entities_count = MagicMock(
+            side_effect=lambda relation, process, entity_type: 1 if process['uuid']['uuid'] == 'assay' else 0)
+
+        # when
+        processes = assay_processes(ingest_api, 'submission-uuid')
+
+        # then
+        ingest_api.get_submission_by_uuid.assert_called_once_with('submission-uuid')
+        self.assertEqual(processes, [AssayProcess('assay', 'id-assay')])
+
+    def test_run_records_checkpoint_and_resumes(self):
+        # given
+        processes = [AssayProcess(f'uuid-{i}', f'id-{i}') for i in range(3)]
+        progress = MagicMock()
+
+        # when
+        result = BatchExport(_tasks, (['manifest', 'terra'], 'uuid-1'), workers=1,
+                             checkpoint=Checkpoint(self.checkpoint_path), progress=progress).run(processes, ['manifest', 'terra'])
+
+        # then
+        self.assertEqual((result.exported, result.failed, result.skipped), (2, 1, 0))
+        with open(self.checkpoint_path) as checkpoint_file:
+            entries = [json.loads(line) for line in checkpoint_file]
+        self.assertEqual(sorted(entry['process'] for entry in entries if entry['mode'] == 'terra'), ['uuid-0', 'uuid-2'])
+
+        # when
+        resumed = BatchExport(_tasks, (['manifest', 'terra'], None), workers=1,
+                              checkpoint=Checkpoint(self.checkpoint_path), progress=progress).run(processes, ['manifest', 'terra'])
+
+        # then
+        self.assertEqual((resumed.exported, resumed.failed, resumed.skipped), (1, 0, 2))
+
+    def test_checkpoint_ignores_line_cut_short(self):
+        # given
+        with open(self.checkpoint_path, 'w') as checkpoint_file:
+            checkpoint_file.write('{"mode": "manifest", "process": "uuid-0"}\n{"mode": "manifest", "proc')
+
+        # when
+        checkpoint = Checkpoint(self.checkpoint_path)
+        checkpoint.mark_complete('terra', 'uuid-1')
+
+        # then
+        self.assertTrue(checkpoint.is_complete('manifest', 'uuid-0'))
+        self.assertTrue(Checkpoint(self.checkpoint_path).is_complete('terra', 'uuid-1'))
+
+    def test_run_on_worker_processes(self):
+        # given
+        processes = [AssayProcess(f'uuid-{i}', f'id-{i}') for i in range(6)]
+
+        # when
+        result = BatchExport(_tasks, (['manifest'], 'uuid-3'), workers=2,
+                             checkpoint=Checkpoint(self.checkpoint_path), progress=MagicMock()).run(processes, ['manifest'])
+
+        # then
+        self.assertEqual((result.exported, result.failed), (5, 1))
+        self.assertFalse(Checkpoint(self.checkpoint_path).is_complete('manifest', 'uuid-3'))
+        self.assertTrue(Checkpoint(self.checkpoint_path).is_complete('manifest', 'uuid-5'))
@@ -0,0 +1,38 @@
+import gzip
+from unittest import TestCase
+
+from mock import MagicMock
+from requests import Session
+
+from exporter import metrics
+from exporter.compression import gzip_bytes, negotiate_compression
+
+
+class CompressionTest(TestCase):
+
+    def test_negotiate_compression(self):
+        # given:
+        session = Session()
+        response = MagicMock(headers={'Content-Length': '120', 'Content-Encoding': 'gzip'})
+        labels = {"service": 'mock-service', "encoding": 'gzip'}
+        wire_bytes = metrics.registry.counter_value('http_response_wire_bytes_total', labels)
+
+        # when:
+        negotiate_compression(session, 'mock-service')
+        session.hooks['response'][-1](response)
+
+        # then:
+        self.assertIn('gzip', session.headers['Accept-Encoding'])
+        self.assertEqual(metrics.registry.counter_value('http_response_wire_bytes_total', labels) - wire_bytes, 120)
+
+    def test_gzip_bytes_is_deterministic(self):
+        # given:
+        data = b'{"content": {"schema_type": "file"}}' * 10
+
+        # when:
+        compressed = gzip_bytes(data)
+
+        # then:
+        self.assertEqual(gzip.decompress(compressed), data)
+        self.assertEqual(gzip_bytes(data), compressed)
+        self.assertLess(len(compressed), len(data))
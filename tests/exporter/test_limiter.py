@@ -0,0 +1,90 @@
+from unittest import TestCase
+
+import requests
+from mock import MagicMock
+
+from exporter import metrics
+from exporter.limiter import AdaptiveLimiter, is_overload
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def request(self, latency_sec: float, result=None):
+        def _request():
+            self.now += latency_sec
+            return result
+        return _request
+
+
+def http_error(status_code: int) -> requests.HTTPError:
+    return requests.HTTPError(response=MagicMock(status_code=status_code))
+
+
+class AdaptiveLimiterTest(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_limit_increases_while_busy_and_latency_is_flat(self):
+        # given
+        limiter = AdaptiveLimiter('test', initial_limit=1, window_size=4, clock=self.clock)
+
+        # when
+        for _ in range(4):
+            limiter.call(self.clock.request(0.1))
+
+        # then
+        self.assertEqual(int(limiter.limit), 2)
+        self.assertEqual(metrics.registry.gauges['concurrency_limit'][(('service', 'test'),)], 2)
+
+    def test_limit_does_not_increase_when_not_busy(self):
+        # given
+        limiter = AdaptiveLimiter('test', initial_limit=4, window_size=4, clock=self.clock)
+
+        # when
+        for _ in range(8):
+            limiter.call(self.clock.request(0.1))
+
+        # then
+        self.assertEqual(int(limiter.limit), 4)
+
+    def test_limit_decreases_on_overload(self):
+        # given
+        limiter = AdaptiveLimiter('test', initial_limit=10, window_size=50, clock=self.clock)
+
+        def overloaded():
+            raise http_error(503)
+
+        # when
+        with self.assertRaises(requests.HTTPError):
+            limiter.call(overloaded)
+        limiter.call(self.clock.request(0.1, result=MagicMock(status_code=429)))
+
+        # then
+        self.assertEqual(int(limiter.limit), 4)
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_limit_decreases_when_latency_rises(self):
+        # given
+        limiter = AdaptiveLimiter('test', initial_limit=10, window_size=4, clock=self.clock)
+        for _ in range(4):
+            limiter.call(self.clock.request(0.1))
+
+        # when
+        for _ in range(4):
+            limiter.call(self.clock.request(0.5))
+
+        # then
+        self.assertEqual(int(limiter.limit), 7)
+
+    def test_is_overload(self):
+        self.assertTrue(is_overload(error=http_error(500)))
+        self.assertTrue(is_overload(error=requests.ConnectionError()))
+        self.assertTrue(is_overload(response=MagicMock(status_code=429)))
+        self.assertFalse(is_overload(error=http_error(404)))
+        self.assertFalse(is_overload(error=KeyError('key')))
+        self.assertFalse(is_overload(response={'some': 'json'}))
@@ -1,3 +1,6 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, current_thread
 from unittest import TestCase
 
 from mock import Mock
@@ -110,6 +113,162 @@ class MetadataServiceTest(TestCase):
         self.assertEqual(raw_metadata['updateDate'], metadata_resource.provenance.update_date)
 
 
+    def test_concurrent_related_requests_are_coalesced(self):
+        # given:
+        release = Event()
+        ingest_client = Mock(name='ingest_client')
+        page = Mock(json=Mock(return_value={'_embedded': {'protocols': []}, '_links': {}}))
+        ingest_client.get = Mock(side_effect=lambda url, **kwargs: release.wait(5) and page)
+        process = Mock(uuid='process-uuid', full_resource={'_links': {'protocols': {'href': 'http://ingest/processes/1/protocols'}}})
+        metadata_service = MetadataService(ingest_client)
+
+        # when:
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            calls = [executor.submit(metadata_service.get_protocols, process) for _ in range(3)]
+            time.sleep(0.2)
+            release.set()
+            results = [call.result() for call in calls]
+
+        # then:
+        ingest_client.get.assert_called_once()
+        self.assertEqual(results, [[], [], []])
+        self.assertIsNot(results[0], results[1])
+
+    def test_get_related_prefetches_next_page(self):
+        # given:
+        pages = {
+            'http://ingest/processes/1/derivedFiles': {
+                '_embedded': {'files': [self.file_entity('file-1'), self.file_entity('file-2')]},
+                '_links': {'next': {'href': 'http://ingest/processes/1/derivedFiles?page=1'}}
+            },
+            'http://ingest/processes/1/derivedFiles?page=1': {
+                '_embedded': {'files': [self.file_entity('file-3')]},
+                '_links': {}
+            }
+        }
+        fetching_threads = []
+
+        def get(url, **kwargs):
+            fetching_threads.append(current_thread().name)
+            return Mock(json=Mock(return_value=pages[url]))
+
+        ingest_client = Mock(name='ingest_client')
+        ingest_client.get = Mock(side_effect=get)
+        process = Mock(uuid='process-uuid', full_resource={'_links': {'derivedFiles': {'href': 'http://ingest/processes/1/derivedFiles'}}})
+        metadata_service = MetadataService(ingest_client)
+
+        # when:
+        related = metadata_service.get_derived_files(process)
+
+        # then: the second page was fetched in the background
+        self.assertEqual([m.uuid for m in related], ['file-1', 'file-2', 'file-3'])
+        self.assertEqual(len(fetching_threads), 2)
+        self.assertFalse(fetching_threads[0].startswith('page-prefetch'))
+        self.assertTrue(fetching_threads[1].startswith('page-prefetch'))
+
+    def test_iter_related_yields_pages_as_they_arrive(self):
+        # given:
+        pages = {
+            'http://ingest/processes/1/derivedFiles': {
+                '_embedded': {'files': [self.file_entity('file-1'), self.file_entity('file-2')]},
+                '_links': {'next': {'href': 'http://ingest/processes/1/derivedFiles?page=1'}}
+            },
+            'http://ingest/processes/1/derivedFiles?page=1': {
+                '_embedded': {'files': [self.file_entity('file-3')]},
+                '_links': {}
+            }
+        }
+        ingest_client = Mock(name='ingest_client')
+        ingest_client.get = Mock(side_effect=lambda url, **kwargs: Mock(json=Mock(return_value=pages[url])))
+        process = Mock(uuid='process-uuid', full_resource={'_links': {'derivedFiles': {'href': 'http://ingest/processes/1/derivedFiles'}}})
+        metadata_service = MetadataService(ingest_client)
+
+        # when:
+        related_pages = metadata_service.iter_related('derivedFiles', process, 'files')
+        first_page = next(related_pages)
+
+        # then:
+        self.assertEqual([m.uuid for m in first_page], ['file-1', 'file-2'])
+        self.assertEqual([[m.uuid for m in page] for page in related_pages], [['file-3']])
+        self.assertEqual(list(metadata_service.iter_related('inputFiles', process, 'files')), [])
+
+    def test_related_pages_without_projected_fields_are_fetched_again_in_full(self):
+        # given: a projection leaving out fields the exporter needs
+        full_page = {'_embedded': {'files': [self.file_entity('file-1')]}, '_links': {}}
+        projected_page = {'_embedded': {'files': [{'uuid': {'uuid': 'file-1'}}]}, '_links': {}}
+        ingest_client = Mock(name='ingest_client')
+        ingest_client.get = Mock(side_effect=lambda url, params=None, **kwargs:
+                                 Mock(json=Mock(return_value=projected_page if params else full_page)))
+        process = Mock(uuid='process-uuid', full_resource={'_links': {'derivedFiles': {'href': 'http://ingest/processes/1/derivedFiles'}}})
+        metadata_service = MetadataService(ingest_client, page_size=500, projection='exporter')
+
+        # when:
+        first = metadata_service.get_derived_files(process)
+        second = metadata_service.get_derived_files(process)
+
+        # then: the projection is only tried once
+        self.assertEqual([m.uuid for m in first + second], ['file-1', 'file-1'])
+        self.assertEqual(ingest_client.get.call_count, 3)
+        self.assertEqual(metadata_service.relation_params, {})
+
+    def test_projected_related_pages_are_used_if_complete(self):
+        # given:
+        projected_page = {'_embedded': {'files': [self.projected_file_entity('file-1')]}, '_links': {}}
+        ingest_client = Mock(name='ingest_client')
+        ingest_client.get = Mock(return_value=Mock(json=Mock(return_value=projected_page)))
+        process = Mock(uuid='process-uuid', full_resource={'_links': {'derivedFiles': {'href': 'http://ingest/processes/1/derivedFiles'}}})
+        metadata_service = MetadataService(ingest_client, page_size=500, projection='exporter')
+
+        # when:
+        related = metadata_service.get_derived_files(process)
+
+        # then:
+        self.assertEqual([m.uuid for m in related], ['file-1'])
+        ingest_client.get.assert_called_once()
+        self.assertEqual(metadata_service.relation_params, {'size': 500, 'projection': 'exporter'})
+
+    def test_related_pages_missing_links_or_file_fields_are_fetched_again_in_full(self):
+        without_links = self.projected_file_entity('file-1')
+        del without_links['_links']
+        without_file_fields = self.projected_file_entity('file-1')
+        del without_file_fields['cloudUrl']
+
+        for projected_entity in [without_links, without_file_fields]:
+            # given:
+            projected_page = {'_embedded': {'files': [projected_entity]}, '_links': {}}
+            full_page = {'_embedded': {'files': [self.projected_file_entity('file-1')]}, '_links': {}}
+            ingest_client = Mock(name='ingest_client')
+            ingest_client.get = Mock(side_effect=lambda url, params=None, page=projected_page, **kwargs:
+                                     Mock(json=Mock(return_value=page if params else full_page)))
+            process = Mock(uuid='process-uuid', full_resource={'_links': {'derivedFiles': {'href': 'http://ingest/processes/1/derivedFiles'}}})
+            metadata_service = MetadataService(ingest_client, page_size=500, projection='exporter')
+
+            # when:
+            related = metadata_service.get_derived_files(process)
+
+            # then:
+            self.assertEqual(related[0].full_resource, full_page['_embedded']['files'][0])
+            self.assertEqual(ingest_client.get.call_count, 2)
+            self.assertEqual(metadata_service.relation_params, {})
+
+    def projected_file_entity(self, uuid: str) -> dict:
+        return dict(self.file_entity(uuid), dataFileUuid=f'{uuid}-data', fileName=f'{uuid}.fastq.gz',
+                    cloudUrl=f's3://upload-bucket/upload-area/{uuid}.fastq.gz', fileContentType='application/gzip',
+                    size=4, checksums={'sha256': '', 'crc32c': '', 'sha1': '', 's3_etag': ''},
+                    _links={'self': {'href': f'http://ingest/files/{uuid}'}})
+
+    @staticmethod
+    def file_entity(uuid: str) -> dict:
+        return {
+            'uuid': {'uuid': uuid},
+            'content': {'describedBy': 'https://schema.humancellatlas.org/type/file/2.5.0/sequence_file'},
+            'dcpVersion': '2019-01-01T00:00:00.000Z',
+            'type': 'File',
+            'submissionDate': '2019-01-01T00:00:00.000Z',
+            'updateDate': '2019-01-01T00:00:00.000Z'
+        }
+
+
 class DataFileTest(TestCase):
 
     def mock_checksums(self) -> FileChecksums:
@@ -0,0 +1,99 @@
+import urllib.request
+from unittest import TestCase
+
+from mock import MagicMock
+
+from exporter.metrics import MetricsRegistry, MetricsServer, endpoint_for_url, http_response_hook, registry
+
+
+class MetricsRegistryTest(TestCase):
+
+    def test_span_is_recorded_in_histogram_and_message_trace(self):
+        # given:
+        metrics_registry = MetricsRegistry()
+
+        # when:
+        with metrics_registry.message_trace('terra', process_uuid='process-uuid') as trace:
+            with metrics_registry.span('crawl'):
+                pass
+            with metrics_registry.span('metadata_write'):
+                pass
+            with metrics_registry.span('metadata_write'):
+                pass
+
+        # then:
+        trace_dict = trace.to_dict()
+        self.assertEqual(trace_dict['process_uuid'], 'process-uuid')
+        self.assertEqual(trace_dict['spans']['metadata_write']['count'], 2)
+        self.assertEqual(trace_dict['spans']['crawl']['count'], 1)
+        self.assertIsNone(metrics_registry.current_trace())
+        self.assertEqual(metrics_registry.counter_value('messages_total', {'pipeline': 'terra', 'outcome': 'success'}), 1)
+
+    def test_failed_message_is_counted(self):
+        # given:
+        metrics_registry = MetricsRegistry()
+
+        # when:
+        with self.assertRaises(ValueError):
+            with metrics_registry.message_trace('manifest'):
+                raise ValueError()
+
+        # then:
+        self.assertEqual(metrics_registry.counter_value('messages_total', {'pipeline': 'manifest', 'outcome': 'failure'}), 1)
+
+    def test_exposition(self):
+        # given:
+        metrics_registry = MetricsRegistry()
+        metrics_registry.inc('gcs_requests_total', {'operation': 'upload'})
+        metrics_registry.inc('gcs_requests_total', {'operation': 'upload'})
+        metrics_registry.observe('stage_duration_seconds', 0.2, {'stage': 'crawl'})
+
+        # when:
+        exposition = metrics_registry.exposition()
+
+        # then:
+        self.assertIn('exporter_gcs_requests_total{operation="upload"} 2', exposition)
+        self.assertIn('exporter_stage_duration_seconds_bucket{stage="crawl",le="0.25"} 1', exposition)
+        self.assertIn('exporter_stage_duration_seconds_bucket{stage="crawl",le="0.1"} 0', exposition)
+        self.assertIn('exporter_stage_duration_seconds_count{stage="crawl"} 1', exposition)
+
+    def test_endpoint_for_url_replaces_ids(self):
+        # expect:
+        self.assertEqual(endpoint_for_url('GET', 'http://ingest/processes/5bbc8fc8109b8300069546cf/derivedFiles?page=1'),
+                         'GET /processes/{id}/derivedFiles')
+        self.assertEqual(endpoint_for_url('GET', 'http://ingest/processes/search/findByUuid?uuid=abc'),
+                         'GET /processes/search/findByUuid')
+        self.assertEqual(endpoint_for_url('POST', 'http://ingest/exportJobs/3f3212da-d5d0-4e55-b31d-83243fa02e0d/entities'),
+                         'POST /exportJobs/{id}/entities')
+
+    def test_http_response_hook_counts_requests(self):
+        # given:
+        response = MagicMock(url='http://ingest/biomaterials/5bbc8fc8109b8300069546cf', status_code=200)
+        response.request.method = 'GET'
+        labels = {'service': 'test-ingest', 'endpoint': 'GET /biomaterials/{id}', 'status': '200'}
+        before = registry.counter_value('http_requests_total', labels)
+
+        # when:
+        http_response_hook('test-ingest')(response)
+
+        # then:
+        self.assertEqual(registry.counter_value('http_requests_total', labels), before + 1)
+
+
+class MetricsServerTest(TestCase):
+
+    def test_serves_metrics(self):
+        # given:
+        metrics_registry = MetricsRegistry()
+        metrics_registry.inc('messages_total', {'pipeline': 'terra', 'outcome': 'success'})
+        server = MetricsServer(0, metrics_registry).start()
+
+        try:
+            # when:
+            port = server.server.server_address[1]
+            body = urllib.request.urlopen(f'http://localhost:{port}/metrics').read().decode()
+
+            # then:
+            self.assertIn('exporter_messages_total{outcome="success",pipeline="terra"} 1', body)
+        finally:
+            server.stop()
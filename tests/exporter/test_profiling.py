@@ -0,0 +1,57 @@
+import tempfile
+import time
+from pathlib import Path
+from unittest import TestCase
+
+from exporter.profiling import SlowMessageProfiler, StackSampler
+
+
+def busy_wait(seconds: float):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class SlowMessageProfilerTest(TestCase):
+
+    def test_profile_is_written_for_slow_message(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            # given:
+            profiler = SlowMessageProfiler(output_dir, threshold_sec=0.05, sampler=StackSampler(interval_sec=0.005))
+
+            # when:
+            with profiler.profile('terra', 'process-uuid', 'submission-uuid'):
+                busy_wait(0.2)
+
+            # then:
+            profiles = list(Path(output_dir).iterdir())
+            self.assertEqual(len(profiles), 1)
+            self.assertTrue(profiles[0].name.startswith('terra_submission-uuid_process-uuid_'))
+            collapsed = profiles[0].read_text().splitlines()
+            self.assertTrue(any('busy_wait' in line for line in collapsed))
+            stack, count = collapsed[0].rsplit(' ', 1)
+            self.assertGreater(int(count), 0)
+
+    def test_no_profile_for_fast_message(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            # given:
+            profiler = SlowMessageProfiler(output_dir, threshold_sec=10)
+
+            # when:
+            with profiler.profile('manifest', 'process-uuid', 'submission-uuid'):
+                pass
+
+            # then:
+            self.assertEqual(list(Path(output_dir).iterdir()), [])
+
+    def test_disabled_without_output_dir(self):
+        # given:
+        profiler = SlowMessageProfiler(None, threshold_sec=0)
+
+        # when:
+        with profiler.profile('manifest', 'process-uuid', 'submission-uuid') as session:
+            pass
+
+        # then:
+        self.assertFalse(profiler.enabled)
+        self.assertIsNone(session)
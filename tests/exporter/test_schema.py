@@ -2,39 +2,119 @@ from unittest import TestCase
 
 from mock import Mock, MagicMock
 
-from exporter.schema import SchemaService
+from exporter.schema import SchemaService, SchemaParseException
 from ingest.api.ingestapi import IngestApi
 
-from time import sleep
+
+class InlineExecutor:
+    def submit(self, fn):
+        fn()
 
 
 class SchemaServiceTest(TestCase):
 
-    def test_cached_schema_retrieval(self):
-        mock_ingest_api = MagicMock(spec=IngestApi)
-        mock_ingest_api.get_schemas = Mock()
-        mock_ingest_api.get_schemas.return_value = [{
-            "_links": {"json-schema": {"href": "https://some-schema-url"}},
-            "schemaVersion": "1.2.3"
+    def setUp(self):
+        self.mock_ingest_api = MagicMock(spec=IngestApi)
+        self.mock_ingest_api.get_schemas = Mock()
+        self.mock_ingest_api.get_schemas.return_value = [{
+            "_links": {"json-schema": {"href": "https://schema.humancellatlas.org/system/1.2.3/file_descriptor"}},
+            "schemaVersion": "1.2.3",
+            "highLevelEntity": "system",
+            "concreteEntity": "file_descriptor"
+        }, {
+            "_links": {"json-schema": {"href": "https://schema.humancellatlas.org/system/3.0.0/links"}},
+            "schemaVersion": "3.0.0",
+            "highLevelEntity": "system",
+            "concreteEntity": "links"
+        }, {
+            "_links": {"json-schema": {"href": "https://schema.humancellatlas.org/type/biomaterial/15.5.0/donor_organism"}},
+            "schemaVersion": "15.5.0",
+            "highLevelEntity": "type",
+            "concreteEntity": "donor_organism"
         }]
+        self.now = 0
+        self.executor = MagicMock(wraps=InlineExecutor())
 
-        test_ttl_seconds = 3
-        test_schema_service = SchemaService(mock_ingest_api, ttl=test_ttl_seconds)
-
-        # call a couple of times, assert that the ingest-api is called only once within the ttl
-        test_schema_service.cached_latest_file_descriptor_schema()
-        test_schema_service.cached_latest_file_descriptor_schema()
-
-        self.assertEqual(mock_ingest_api.get_schemas.call_count, 1)
-
-        # sleep and assert the ingest-api is called a second time after ttl expiry
-        sleep(test_ttl_seconds)
-        test_schema_service.cached_latest_file_descriptor_schema()
-        test_schema_service.cached_latest_file_descriptor_schema()
-
-        self.assertEqual(mock_ingest_api.get_schemas.call_count, 2)
-
-
-
-
+    def schema_service(self, ttl: int) -> SchemaService:
+        return SchemaService(self.mock_ingest_api, ttl=ttl, executor=self.executor, clock=lambda: self.now)
 
+    def test_cached_schema_retrieval(self):
+        # given
+        test_schema_service = self.schema_service(ttl=300)
+
+        # when
+        file_descriptor_schema = test_schema_service.cached_latest_file_descriptor_schema()
+        links_schema = test_schema_service.cached_latest_links_schema()
+
+        # then
+        self.assertEqual(file_descriptor_schema.schema_version, "1.2.3")
+        self.assertEqual(links_schema.schema_version, "3.0.0")
+        self.assertEqual(self.mock_ingest_api.get_schemas.call_count, 1)
+
+    def test_prefetch__loads_schemas_before_first_use(self):
+        # given
+        test_schema_service = self.schema_service(ttl=300)
+
+        # when
+        test_schema_service.prefetch()
+        test_schema_service.cached_latest_links_schema()
+
+        # then
+        self.assertEqual(self.mock_ingest_api.get_schemas.call_count, 1)
+
+    def test_refresh_ahead__refreshes_in_background_before_expiry(self):
+        # given
+        test_schema_service = self.schema_service(ttl=300).prefetch()
+
+        # when
+        self.now = 200
+        test_schema_service.cached_latest_links_schema()
+
+        # then
+        self.executor.submit.assert_not_called()
+        self.assertEqual(self.mock_ingest_api.get_schemas.call_count, 1)
+
+        # when
+        self.now = 250
+        test_schema_service.cached_latest_links_schema()
+        test_schema_service.cached_latest_links_schema()
+
+        # then
+        self.assertEqual(self.executor.submit.call_count, 1)
+        self.assertEqual(self.mock_ingest_api.get_schemas.call_count, 2)
+
+    def test_refresh_ahead__serves_stale_schemas_when_refresh_fails(self):
+        # given
+        test_schema_service = self.schema_service(ttl=300).prefetch()
+        self.mock_ingest_api.get_schemas.side_effect = Exception("ingest unavailable")
+
+        # when
+        self.now = 1000
+        links_schema = test_schema_service.cached_latest_links_schema()
+
+        # then
+        self.assertEqual(links_schema.schema_version, "3.0.0")
+        self.assertEqual(self.mock_ingest_api.get_schemas.call_count, 2)
+
+    def test_schema_for_url(self):
+        # given
+        test_schema_service = self.schema_service(ttl=300)
+
+        # when
+        schema = test_schema_service.schema_for_url("https://schema.humancellatlas.org/type/biomaterial/15.5.0/donor_organism")
+
+        # then: every latest schema is indexed by URL, but only system schemas by entity
+        self.assertEqual(schema.schema_version, "15.5.0")
+        self.assertIsNone(test_schema_service.schema_for_url("https://schema.humancellatlas.org/system/1.0.0/links"))
+        self.assertEqual(len(test_schema_service.schema_urls()), 3)
+        with self.assertRaises(SchemaParseException):
+            test_schema_service._cached("donor_organism")
+
+    def test_missing_schema(self):
+        # given
+        self.mock_ingest_api.get_schemas.return_value = []
+        test_schema_service = self.schema_service(ttl=300)
+
+        # when/then
+        with self.assertRaises(SchemaParseException):
+            test_schema_service.cached_latest_links_schema()
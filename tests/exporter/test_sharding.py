@@ -0,0 +1,97 @@
+import json
+from collections import Counter
+from unittest import TestCase
+
+from mock import MagicMock, patch
+
+from exporter.amqp import QueueConfig
+from exporter.sharding import HashRing, _ShardRouter, shard_index_from_hostname, shard_queue_config
+
+
+class HashRingTest(TestCase):
+    def test_shard_for__is_stable_and_spread(self):
+        # given
+        ring = HashRing(4)
+        keys = [f'submission-{i}' for i in range(2000)]
+
+        # when
+        shards = [ring.shard_for(key) for key in keys]
+
+        # then
+        self.assertEqual(shards, [HashRing(4).shard_for(key) for key in keys])
+        counts = Counter(shards)
+        self.assertEqual(set(counts), {0, 1, 2, 3})
+        self.assertTrue(all(count > 300 for count in counts.values()))
+
+    def test_shard_for__adding_a_shard_only_moves_keys_to_it(self):
+        # given
+        keys = [f'submission-{i}' for i in range(2000)]
+        before, after = HashRing(4), HashRing(5)
+
+        # when
+        moved = [key for key in keys if before.shard_for(key) != after.shard_for(key)]
+
+        # then
+        self.assertTrue(all(after.shard_for(key) == 4 for key in moved))
+        self.assertLess(len(moved), len(keys) / 3)
+
+    def test_shard_count__must_be_positive(self):
+        with self.assertRaises(ValueError):
+            HashRing(0)
+
+
+class ShardingConfigTest(TestCase):
+    def test_shard_queue_config(self):
+        # given
+        config = QueueConfig('ingest.terra.experiments.new', 'ingest.exporter.experiment.submitted',
+                             'ingest.exporter.exchange', 'topic', False, None)
+
+        # when
+        shard_config = shard_queue_config(config, 2)
+
+        # then
+        self.assertEqual(shard_config.name, 'ingest.terra.experiments.new.shard-2')
+        self.assertEqual(shard_config.routing_key, 'ingest.exporter.experiment.submitted.shard-2')
+        self.assertEqual(shard_config.exchange, config.exchange)
+
+    def test_shard_index_from_hostname(self):
+        self.assertEqual(shard_index_from_hostname('ingest-exporter-2'), 2)
+        self.assertIsNone(shard_index_from_hostname('ingest-exporter-6d8f9c-abcde'))
+        self.assertIsNone(shard_index_from_hostname(''))
+
+
+class ShardRouterTest(TestCase):
+    def setUp(self):
+        config = QueueConfig('ingest.terra.experiments.new', 'ingest.exporter.experiment.submitted',
+                             'ingest.exporter.exchange', 'topic', False, None)
+        self.ring = HashRing(3)
+        self.router = _ShardRouter(MagicMock(), self.ring, config)
+        self.producer = MagicMock()
+
+    def test_route__republishes_to_the_submission_shard(self):
+        # given
+        body = json.dumps({"envelopeUuid": "submission-1", "documentUuid": "process-1"})
+        msg = MagicMock()
+        shard = self.ring.shard_for('submission-1')
+
+        # when
+        with patch.object(_ShardRouter, 'producer', self.producer):
+            self.router.route(body, msg)
+
+        # then
+        _, kwargs = self.producer.publish.call_args
+        self.assertEqual(kwargs['routing_key'], f'ingest.exporter.experiment.submitted.shard-{shard}')
+        self.assertEqual(kwargs['declare'][0].name, f'ingest.terra.experiments.new.shard-{shard}')
+        msg.ack.assert_called_once()
+
+    def test_route__rejects_unroutable_message(self):
+        # given
+        msg = MagicMock()
+
+        # when
+        with patch.object(_ShardRouter, 'producer', self.producer):
+            self.router.route('{"documentUuid": "process-1"}', msg)
+
+        # then
+        self.producer.publish.assert_not_called()
+        msg.reject.assert_called_once_with(requeue=False)
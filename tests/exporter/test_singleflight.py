@@ -0,0 +1,41 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from unittest import TestCase
+
+from mock import Mock
+
+from exporter.singleflight import SingleFlight
+
+
+class SingleFlightTest(TestCase):
+    def test_concurrent_calls_share_one_result(self):
+        # given
+        single_flight = SingleFlight()
+        release = Event()
+        fetch = Mock(side_effect=lambda: release.wait(5) and ['result'])
+
+        # when
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            calls = [executor.submit(single_flight.do, 'key', fetch) for _ in range(4)]
+            # give every caller time to join the call in flight
+            time.sleep(0.2)
+            release.set()
+            results = [call.result() for call in calls]
+
+        # then
+        fetch.assert_called_once()
+        self.assertEqual([result for result, _ in results], [['result']] * 4)
+        self.assertEqual(sorted(shared for _, shared in results), [False, True, True, True])
+
+    def test_error_is_shared_and_not_kept(self):
+        # given
+        single_flight = SingleFlight()
+
+        # when
+        with self.assertRaises(ValueError):
+            single_flight.do('key', Mock(side_effect=ValueError('failed')))
+        result, shared = single_flight.do('key', Mock(return_value='retried'))
+
+        # then
+        self.assertEqual((result, shared), ('retried', False))
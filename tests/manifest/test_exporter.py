@@ -1,10 +1,12 @@
+import json
 from unittest import TestCase
 
 from ingest.api.ingestapi import IngestApi
-from mock import MagicMock
+from mock import MagicMock, patch
 
 from manifest.exporter import ManifestExporter
 from manifest.generator import ManifestGenerator
+from manifest.manifests import AssayManifest
 from tests.mocks.ingest import MockIngestAPI
 from tests.mocks.files import MockEntityFiles
 
@@ -34,3 +36,69 @@ class TestExporter(TestCase):
         # then:
         exporter.manifest_generator.generate_manifest.assert_called_with('process-uuid', 'submission-uuid')
         exporter.ingest_api.create_bundle_manifest.assert_called_with(generated_manifest)
+
+    def test_exporter_streams_large_manifest(self):
+        # given:
+        generator = MagicMock(spec=ManifestGenerator)
+        exporter = ManifestExporter(self.ingest, generator, stream_threshold=2)
+        manifest = AssayManifest('submission-uuid')
+        manifest.dataFiles = ['file-1', 'file-2']
+        manifest.fileProjectMap = {'project-uuid': ['project-uuid']}
+        generator.generate_manifest = MagicMock(return_value=manifest)
+
+        # and:
+        exporter.ingest_api.create_bundle_manifest = MagicMock()
+        exporter.ingest_api.get_resource_repository_url = MagicMock(return_value='http://mock-ingest-api/bundleManifests')
+        exporter.ingest_api.get_headers = MagicMock(return_value={'Content-type': 'application/json'})
+        response = MagicMock()
+        response.json = MagicMock(return_value={'_links': {'self': {'href': 'http://mock-ingest-api/bundleManifests/1'}}})
+
+        # when:
+        with patch('manifest.exporter.requests.post', return_value=response) as post:
+            exporter.export(process_uuid='process-uuid', submission_uuid='submission-uuid')
+
+        # then:
+        exporter.ingest_api.create_bundle_manifest.assert_not_called()
+        exporter.ingest_api.get_resource_repository_url.assert_called_once_with('bundleManifests')
+        post.assert_called_once()
+        self.assertEqual(post.call_args[0][0], 'http://mock-ingest-api/bundleManifests')
+        streamed = b''.join(post.call_args[1]['data'])
+        self.assertEqual(json.loads(streamed), manifest.__dict__)
+
+
+    def test_exporter_export_batch(self):
+        # given:
+        generator = MagicMock(spec=ManifestGenerator)
+        batch_generator = MagicMock(spec=ManifestGenerator)
+        generator.with_shared_crawl = MagicMock(return_value=batch_generator)
+        exporter = ManifestExporter(self.ingest, generator)
+        generated_manifest = self.files.get_entity('bundleManifests', 'generated-manifest')
+        batch_generator.generate_manifest = MagicMock(side_effect=[generated_manifest, Exception('crawl failed'), generated_manifest])
+
+        # and:
+        submitted_manifest = self.files.get_entity('bundleManifests', 'mock-input-manifest')
+        exporter.ingest_api.create_bundle_manifest = MagicMock(return_value=submitted_manifest)
+
+        # when:
+        failures = exporter.export_batch(['process-1', 'process-2', 'process-3'], 'submission-uuid')
+
+        # then:
+        generator.with_shared_crawl.assert_called_once()
+        generator.generate_manifest.assert_not_called()
+        self.assertEqual(batch_generator.generate_manifest.call_count, 3)
+        self.assertEqual(exporter.ingest_api.create_bundle_manifest.call_count, 2)
+        self.assertEqual(list(failures.keys()), ['process-2'])
+
+class TestAssayManifest(TestCase):
+    def test_to_json_chunks(self):
+        # given:
+        manifest = AssayManifest('submission-uuid')
+        manifest.dataFiles = [f'file-{i}' for i in range(1000)]
+        manifest.fileProcessMap = dict((f'process-{i}', [f'process-{i}']) for i in range(1000))
+
+        # when:
+        chunks = list(manifest.to_json_chunks(chunk_size=1024))
+
+        # then:
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(json.loads(b''.join(chunks)), json.loads(json.dumps(manifest.__dict__)))
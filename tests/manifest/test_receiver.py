@@ -1,5 +1,8 @@
 import datetime
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
 
 from unittest import TestCase
 from mock import MagicMock
@@ -51,7 +54,8 @@ class TestReceiver(TestCase):
         create_receiver.notify_state_tracker = MagicMock()
 
         # when
-        create_receiver.on_message(self.create_message_body, message)
+        create_receiver.on_message(self.create_message_body, message).result()
+        create_receiver.on_iteration()
 
         # then
         mock_exporter.export.assert_called_with(submission_uuid='submission-uuid', process_uuid='doc-uuid')
@@ -80,9 +84,157 @@ class TestReceiver(TestCase):
         # when
         mock_exporter.export.side_effect = Exception('unhandled exception')
 
-        create_receiver.on_message(self.create_message_body, message)
+        create_receiver.on_message(self.create_message_body, message).result()
+        create_receiver.on_iteration()
 
         # then
         mock_exporter.export.assert_called_with(submission_uuid='submission-uuid', process_uuid='doc-uuid')
-        message.ack.assert_called_once()
+        message.ack.assert_not_called()
+        message.reject.assert_called_once_with(requeue=False)
         create_receiver.notify_state_tracker.assert_not_called()
+
+    def test_manifest_receiver_does_not_ack_before_export_completes(self):
+        # given
+        export_started = Event()
+        export_released = Event()
+
+        def export(**kwargs):
+            export_started.set()
+            export_released.wait(5)
+
+        mock_exporter = MagicMock()
+        mock_exporter.export = MagicMock(side_effect=export)
+        receiver = ManifestReceiver(MagicMock(), MagicMock(), mock_exporter, self.publish_config,
+                                    executor=ThreadPoolExecutor(max_workers=2), prefetch_count=2)
+        receiver.notify_state_tracker = MagicMock()
+        message = MagicMock(name='message')
+
+        # when
+        future = receiver.on_message(self.create_message_body, message)
+        export_started.wait(5)
+        receiver.on_iteration()
+
+        # then
+        message.ack.assert_not_called()
+        receiver.notify_state_tracker.assert_not_called()
+
+        # when
+        export_released.set()
+        future.result()
+        receiver.on_iteration()
+
+        # then
+        receiver.notify_state_tracker.assert_called_once_with(json.loads(self.create_message_body))
+        message.ack.assert_called_once()
+
+    def test_manifest_receiver_retries_notification_without_exporting_again(self):
+        # given
+        mock_exporter = MagicMock()
+        receiver = ManifestReceiver(MagicMock(), MagicMock(), mock_exporter, self.publish_config)
+        receiver.notify_state_tracker = MagicMock(side_effect=[Exception('broker unavailable'), None])
+        message = MagicMock(name='message')
+
+        # when
+        receiver.on_message(self.create_message_body, message).result()
+        receiver.on_iteration()
+
+        # then
+        message.ack.assert_not_called()
+        message.reject.assert_not_called()
+
+        # when
+        receiver.on_iteration()
+
+        # then
+        self.assertEqual(receiver.notify_state_tracker.call_count, 2)
+        mock_exporter.export.assert_called_once()
+        message.ack.assert_called_once()
+        message.reject.assert_not_called()
+
+    def test_manifest_receiver_rejects_message_without_requeue_when_notification_keeps_failing(self):
+        # given
+        receiver = ManifestReceiver(MagicMock(), MagicMock(), MagicMock(), self.publish_config, max_notify_attempts=3)
+        receiver.notify_state_tracker = MagicMock(side_effect=Exception('broker unavailable'))
+        message = MagicMock(name='message')
+
+        # when
+        receiver.on_message(self.create_message_body, message).result()
+        for _ in range(4):
+            receiver.on_iteration()
+
+        # then
+        self.assertEqual(receiver.notify_state_tracker.call_count, 3)
+        message.ack.assert_not_called()
+        message.reject.assert_called_once_with(requeue=False)
+
+    def test_manifest_receiver_consumes_with_prefetch_count(self):
+        # given
+        receiver = ManifestReceiver(MagicMock(), ['queue'], MagicMock(), self.publish_config, prefetch_count=8)
+        consumer = MagicMock()
+
+        # when
+        receiver.get_consumers(consumer, MagicMock())
+
+        # then
+        consumer.assert_called_once_with(queues=['queue'], callbacks=[receiver.on_message], prefetch_count=8)
+
+    def test_manifest_receiver_batches_messages_of_a_submission(self):
+        # given
+        mock_exporter = MagicMock()
+        mock_exporter.export_batch = MagicMock(return_value={'doc-uuid-2': Exception('failed')})
+        receiver = ManifestReceiver(MagicMock(), MagicMock(), mock_exporter, self.publish_config,
+                                    prefetch_count=10, batch_window_sec=60, batch_size=2)
+        receiver.notify_state_tracker = MagicMock()
+        first_message = MagicMock(name='first_message')
+        second_message = MagicMock(name='second_message')
+        second_body = self.create_message_body.replace('"doc-uuid"', '"doc-uuid-2"')
+
+        # when
+        self.assertIsNone(receiver.on_message(self.create_message_body, first_message))
+        receiver.on_message(second_body, second_message).result()
+        receiver.on_iteration()
+
+        # then
+        mock_exporter.export_batch.assert_called_once_with(['doc-uuid', 'doc-uuid-2'], 'submission-uuid')
+        mock_exporter.export.assert_not_called()
+        first_message.ack.assert_called_once()
+        second_message.ack.assert_not_called()
+        second_message.reject.assert_called_once_with(requeue=False)
+        receiver.notify_state_tracker.assert_called_once_with(json.loads(self.create_message_body))
+
+    def test_manifest_receiver_rejects_batched_message_without_document_uuid(self):
+        # given
+        mock_exporter = MagicMock()
+        receiver = ManifestReceiver(MagicMock(), MagicMock(), mock_exporter, self.publish_config,
+                                    prefetch_count=10, batch_window_sec=60, batch_size=1)
+        message = MagicMock(name='message')
+        body = json.dumps(dict((k, v) for k, v in json.loads(self.create_message_body).items() if k != 'documentUuid'))
+
+        # when
+        result = receiver.on_message(body, message)
+
+        # then
+        self.assertIsNone(result)
+        message.reject.assert_called_once_with(requeue=False)
+        mock_exporter.export_batch.assert_not_called()
+        self.assertEqual(receiver.batches, {})
+
+    def test_manifest_receiver_exports_incomplete_batch_after_window(self):
+        # given
+        mock_exporter = MagicMock()
+        mock_exporter.export_batch = MagicMock(return_value={})
+        receiver = ManifestReceiver(MagicMock(), MagicMock(), mock_exporter, self.publish_config,
+                                    prefetch_count=10, batch_window_sec=0.01, batch_size=10)
+        receiver.notify_state_tracker = MagicMock()
+        message = MagicMock(name='message')
+
+        # when
+        receiver.on_message(self.create_message_body, message)
+        time.sleep(0.02)
+        receiver.on_iteration()
+        receiver.executor.shutdown(wait=True)
+        receiver.on_iteration()
+
+        # then
+        mock_exporter.export_batch.assert_called_once_with(['doc-uuid'], 'submission-uuid')
+        message.ack.assert_called_once()
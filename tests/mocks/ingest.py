@@ -1,10 +1,40 @@
 from typing import Iterator
 
+import requests
+
+
+class MockResponse:
+    def __init__(self, body: dict, status_code: int = 200):
+        self.body = body
+        self.status_code = status_code
+
+    def json(self) -> dict:
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f'HTTP {self.status_code}', response=self)
+
 
 class MockIngestAPI:
     def __init__(self, mock_entity_retriever):
         self.mock_entities = mock_entity_retriever
 
+    def get(self, url, **kwargs):
+        # only relation links, e.g. http://mock-ingest-api/processes/mock-assay-process/derivedFiles, are served
+        base_entity_uri = url.rsplit('/', 1)[0]
+        entities = list(self.mock_entities.get_related_entities(base_entity_uri, url))
+        entity_type = self.collection_of(entities[0]) if entities else 'entities'
+        return MockResponse(self.related_entity_search(base_entity_uri, url, entity_type, entities))
+
+    def get_headers(self):
+        return {'Content-type': 'application/json'}
+
+    @staticmethod
+    def collection_of(entity: dict) -> str:
+        entity_type = entity["type"].lower()
+        return entity_type + 'es' if entity_type.endswith('s') else entity_type + 's'
+
     def get_entity_by_uuid(self, entity_type, uuid):
         return self.mock_entities.get_entity(entity_type, uuid)
 
@@ -17,9 +47,9 @@ class MockIngestAPI:
                 return search_result["_embedded"][entity_type]
         return []
 
-    def related_entity_search(self, base_entity_uri, search_uri, related_entity_type) -> dict:
+    def related_entity_search(self, base_entity_uri, search_uri, related_entity_type, entities=None) -> dict:
         search_result = IngestEntitySearchResult(related_entity_type, search_uri)
-        search_result.add_entities(self.mock_entities.get_related_entities(base_entity_uri, search_uri))
+        search_result.add_entities(entities if entities is not None else self.mock_entities.get_related_entities(base_entity_uri, search_uri))
         return search_result.result
 
 